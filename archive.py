@@ -0,0 +1,165 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FIELDS = ("comic_url", "side_profile_url", "headshot_url")
+SUMMARY_FIELDS = ("id", "protagonist", "circumstance", "created_at", "comic_url")
+MAX_PAGE_SIZE = 100
+
+
+def circumstance_hash(circumstance):
+    # Case and spacing don't make a circumstance a different one
+    return hashlib.sha256(" ".join(circumstance.lower().split()).encode("utf-8")).hexdigest()
+
+
+class StoryArchive:
+    """Every finished generation, kept in SQLite so it can be viewed and
+    shared again without calling the APIs.
+
+    Story, snippet and circumstance text are indexed with FTS5 for
+    search; the index is kept in step with the table by triggers. The
+    listing indexes carry every summary field, so pages are read from the
+    index alone (archives created before they did keep their narrower
+    indexes, which give the same results).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """CREATE TABLE IF NOT EXISTS stories (
+                id TEXT PRIMARY KEY,
+                protagonist TEXT NOT NULL,
+                circumstance TEXT NOT NULL,
+                circumstance_hash TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                char_style_info TEXT,
+                situation_setup TEXT,
+                story TEXT,
+                snippet TEXT,
+                visual_summary TEXT,
+                comic_url TEXT,
+                side_profile_url TEXT,
+                headshot_url TEXT,
+                trace TEXT
+            );
+            CREATE INDEX IF NOT EXISTS stories_protagonist
+                ON stories (protagonist, created_at, id, circumstance, comic_url);
+            CREATE INDEX IF NOT EXISTS stories_created_at
+                ON stories (created_at, id, protagonist, circumstance, comic_url);
+            CREATE INDEX IF NOT EXISTS stories_circumstance_hash ON stories (circumstance_hash, created_at, id);
+
+            CREATE VIRTUAL TABLE IF NOT EXISTS stories_fts USING fts5(
+                story, snippet, circumstance, content='stories', content_rowid='rowid'
+            );
+            CREATE TRIGGER IF NOT EXISTS stories_fts_insert AFTER INSERT ON stories BEGIN
+                INSERT INTO stories_fts (rowid, story, snippet, circumstance)
+                VALUES (new.rowid, new.story, new.snippet, new.circumstance);
+            END;
+            CREATE TRIGGER IF NOT EXISTS stories_fts_delete AFTER DELETE ON stories BEGIN
+                INSERT INTO stories_fts (stories_fts, rowid, story, snippet, circumstance)
+                VALUES ('delete', old.rowid, old.story, old.snippet, old.circumstance);
+            END;"""
+        )
+        self.conn.commit()
+
+    def save(self, protagonist, circumstance, results, trace=None):
+        """Archive the results of StoryGenerator.generate_all and return
+        the new story's id."""
+        story_id = uuid.uuid4().hex
+        record = {
+            "id": story_id,
+            "protagonist": protagonist,
+            "circumstance": circumstance,
+            "circumstance_hash": circumstance_hash(circumstance),
+            "created_at": time.time(),
+            "char_style_info": results.get("char_style_info"),
+            "situation_setup": results.get("situation_setup"),
+            "story": results["story_parts"][0],
+            "snippet": results.get("derivative_story"),
+            "visual_summary": results["story_parts"][1],
+            "trace": json.dumps(trace) if trace is not None else None,
+        }
+        record.update({field: results.get(field) for field in IMAGE_FIELDS})
+        with self.lock:
+            self.conn.execute(
+                f"INSERT INTO stories ({', '.join(record)}) VALUES ({', '.join('?' for _ in record)})",
+                list(record.values()),
+            )
+            self.conn.commit()
+        logger.info("Archived story %s for %s", story_id, protagonist)
+        return story_id
+
+    def get(self, story_id):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM stories WHERE id = ?", (story_id,)).fetchone()
+        if row is None:
+            return None
+        story = dict(row)
+        story["trace"] = json.loads(story["trace"]) if story["trace"] else None
+        return story
+
+    def list(self, protagonist=None, limit=20, cursor=None, circumstance=None):
+        """Newest first. Pages are keyed on (created_at, id) rather than an
+        offset, so each page is an index range scan however deep it is;
+        pass the returned `next_cursor` back to get the following page.
+        `circumstance` only lists exact repeats of it, ignoring case and
+        spacing. `limit` is clamped to 1..MAX_PAGE_SIZE."""
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        clauses, params = [], []
+        if protagonist:
+            clauses.append("protagonist = ?")
+            params.append(protagonist)
+        if circumstance:
+            clauses.append("circumstance_hash = ?")
+            params.append(circumstance_hash(circumstance))
+        if cursor:
+            created_at, _, story_id = cursor.partition(":")
+            clauses.append("(created_at < ? OR (created_at = ? AND id < ?))")
+            params.extend([float(created_at), float(created_at), story_id])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self.lock:
+            rows = self.conn.execute(
+                f"""SELECT {', '.join(SUMMARY_FIELDS)} FROM stories {where}
+                ORDER BY created_at DESC, id DESC LIMIT ?""",
+                params + [limit + 1],
+            ).fetchall()
+        stories = [dict(row) for row in rows[:limit]]
+        next_cursor = f"{stories[-1]['created_at']!r}:{stories[-1]['id']}" if len(rows) > limit else None
+        return {"stories": stories, "next_cursor": next_cursor}
+
+    def search(self, query, limit=20, offset=0):
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        offset = max(0, offset)
+        # Quoted per word, so user input is matched as plain terms rather
+        # than parsed as FTS5 query syntax
+        terms = " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+        if not terms:
+            return {"stories": [], "total": 0}
+        with self.lock:
+            total = self.conn.execute(
+                "SELECT count(*) FROM stories_fts WHERE stories_fts MATCH ?", (terms,)
+            ).fetchone()[0]
+            rows = self.conn.execute(
+                f"""SELECT {', '.join(f's.{field}' for field in SUMMARY_FIELDS)},
+                    snippet(stories_fts, -1, '[', ']', '...', 16) AS excerpt
+                FROM stories_fts JOIN stories s ON s.rowid = stories_fts.rowid
+                WHERE stories_fts MATCH ?
+                ORDER BY bm25(stories_fts) LIMIT ? OFFSET ?""",
+                (terms, limit, offset),
+            ).fetchall()
+        return {"stories": [dict(row) for row in rows], "total": total}
+
+    def delete(self, story_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM stories WHERE id = ?", (story_id,))
+            self.conn.commit()
@@ -0,0 +1,206 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import traceback
+from pathlib import Path
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; without it only originals are kept
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+EXTENSIONS = {"image/png": "png", "image/jpeg": "jpg", "image/webp": "webp"}
+THUMBNAIL_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+MIMETYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+# <sha256>.<ext> for originals, <sha256>_<size>.<ext> for thumbnails
+ARTIFACT_NAME = re.compile(r"^(?P<digest>[0-9a-f]{64})(?:_(?P<size>\d+))?\.(?P<ext>png|jpg|webp)$")
+
+
+class ArtifactStore:
+    """Local mirror of generated images.
+
+    Each image is downloaded once, streamed to disk while it is hashed,
+    and kept under its SHA-256 so identical renders share one file.
+    WebP and JPEG thumbnails are written next to it when Pillow is
+    installed. Files never change once written, so they can be served
+    with a strong ETag and a long-lived Cache-Control header.
+
+    With a `shared` backend (see shared.py) originals are also copied
+    there for `shared_ttl` seconds, and a node asked for an artifact it
+    doesn't have fetches it from the backend, so any node can serve any
+    artifact URL while its shared copy lasts.
+    """
+
+    def __init__(self, root, url_prefix="/artifacts", thumbnail_sizes=(256, 512), timeout=30.0,
+                 max_bytes=50 * 1024 * 1024, chunk_size=64 * 1024, shared=None, shared_ttl=7 * 24 * 3600.0):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.url_prefix = url_prefix.rstrip("/")
+        self.thumbnail_sizes = tuple(thumbnail_sizes)
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._session = None
+        self.shared = shared
+        # Images are far bigger than anything else in the backend, so they
+        # don't stay there for good
+        self.shared_ttl = shared_ttl
+        if Image is None:
+            logger.warning("Pillow is not installed, artifact thumbnails are disabled")
+
+    @property
+    def session(self):
+        # Created with the first download, to keep requests out of startup
+        if self._session is None:
+            import requests
+            self._session = requests.Session()
+        return self._session
+
+    def path(self, name):
+        match = ARTIFACT_NAME.match(name)
+        if match is None:
+            return None
+        return self.root / match.group("digest")[:2] / name
+
+    def url(self, name):
+        return f"{self.url_prefix}/{name}"
+
+    def mirror(self, source_url):
+        """Download `source_url` into the store and return its local URL."""
+        try:
+            with self.session.get(source_url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                content_type = response.headers.get("Content-Type", "").split(";")[0].strip()
+                ext = EXTENSIONS.get(content_type) or EXTENSIONS.get(f"image/{Path(source_url).suffix.lstrip('.')}", "png")
+
+                digest = hashlib.sha256()
+                size = 0
+                fd, temp_path = tempfile.mkstemp(dir=self.root, suffix=".part")
+                try:
+                    with os.fdopen(fd, "wb") as temp_file:
+                        for chunk in response.iter_content(chunk_size=self.chunk_size):
+                            size += len(chunk)
+                            if size > self.max_bytes:
+                                raise ValueError(f"Image at {source_url} is larger than {self.max_bytes} bytes")
+                            digest.update(chunk)
+                            temp_file.write(chunk)
+
+                    name = f"{digest.hexdigest()}.{ext}"
+                    path = self.path(name)
+                    path.parent.mkdir(exist_ok=True)
+                    if path.exists():
+                        logger.debug("Artifact %s already stored", name)
+                    else:
+                        os.replace(temp_path, path)
+                        logger.info("Stored artifact %s (%s bytes)", name, size)
+                finally:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+            self.share(name)
+
+            # The original is already safe; a thumbnail that fails here is
+            # rendered again the first time it is requested
+            try:
+                for thumbnail_size in self.thumbnail_sizes:
+                    for thumbnail_ext in THUMBNAIL_FORMATS:
+                        self.thumbnail(name, thumbnail_size, thumbnail_ext)
+            except Exception as e:
+                logger.warning("Could not make thumbnails for %s: %s", name, e)
+            return self.url(name)
+        except Exception as e:
+            logger.error("Error in mirror: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    def share(self, name):
+        # Only the first node to store an image uploads it
+        if self.shared is None:
+            return
+        try:
+            self.shared.add(f"artifact:{name}", self.path(name).read_bytes(), self.shared_ttl)
+        except Exception as e:
+            logger.warning("Could not share artifact %s: %s", name, e)
+
+    def local_path(self, name):
+        """Path of original `name` on this node, fetched from the shared
+        backend first if only another node has it; None if nobody does."""
+        path = self.path(name)
+        if path is None:
+            return None
+        if path.exists():
+            return path
+        if self.shared is None:
+            return None
+        try:
+            data = self.shared.get(f"artifact:{name}")
+        except Exception as e:
+            logger.warning("Could not fetch shared artifact %s: %s", name, e)
+            return None
+        if data is None:
+            return None
+        path.parent.mkdir(exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logger.info("Fetched shared artifact %s (%s bytes)", name, len(data))
+        return path
+
+    def thumbnail(self, name, size, ext):
+        """Path of the `size` px thumbnail of original `name`, rendering it
+        if needed; None when it can't be made (no Pillow, unknown original)."""
+        thumbnail_path = self.path(f"{Path(name).stem}_{size}.{ext}")
+        if thumbnail_path is None or thumbnail_path.exists():
+            return thumbnail_path
+        original_path = self.path(name)
+        if Image is None or ext not in THUMBNAIL_FORMATS or original_path is None or not original_path.exists():
+            return None
+
+        with Image.open(original_path) as image:
+            image.thumbnail((size, size))
+            if ext == "jpg" and image.mode != "RGB":
+                image = image.convert("RGB")
+            # Written under a temporary name so readers never see half a file
+            fd, temp_path = tempfile.mkstemp(dir=thumbnail_path.parent, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as temp_file:
+                    image.save(temp_file, THUMBNAIL_FORMATS[ext], quality=82)
+                os.replace(temp_path, thumbnail_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return thumbnail_path
+
+    def resolve(self, name):
+        """Map a requested artifact name to a file on disk, or None.
+
+        Missing thumbnails are rendered on demand; without Pillow the
+        original is served in their place, so pages can always ask for them.
+        """
+        match = ARTIFACT_NAME.match(name)
+        if match is None:
+            return None
+        if match.group("size") is None:
+            return self.local_path(name)
+
+        digest, size, ext = match.group("digest"), int(match.group("size")), match.group("ext")
+        if size not in self.thumbnail_sizes:
+            return None
+        for original_ext in MIMETYPES:
+            original = f"{digest}.{original_ext}"
+            if self.local_path(original) is not None:
+                try:
+                    return self.thumbnail(original, size, ext) or self.path(original)
+                except Exception as e:
+                    logger.warning("Serving %s in place of its thumbnail: %s", original, e)
+                    return self.path(original)
+        return None
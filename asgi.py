@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import traceback
+import urllib.parse
+
+from asgiref.wsgi import WsgiToAsgi
+
+import image_profiles
+import main
+import metrics
+from async_story_generator import AsyncStoryGenerator
+from predictions import Consumer, consuming
+from protagonists import protagonists
+
+# ASGI entry point: `uvicorn asgi:app`. POST /generate runs on the event
+# loop through AsyncStoryGenerator, so in-flight generations don't each
+# hold an OS thread; every other route is served by the Flask app.
+
+logger = logging.getLogger(__name__)
+
+wsgi_app = main.create_app()
+services = wsgi_app.extensions["story"]
+story_generator = AsyncStoryGenerator(profile_cache=services.profile_cache, character_store=services.character_store,
+                                      scheduler=services.scheduler, artifact_store=services.artifact_store,
+                                      fused=services.story_generator.fused,
+                                      circumstance_cache=services.circumstance_cache,
+                                      speculative=services.story_generator.speculative,
+                                      speculative_rerender_below=services.story_generator.speculative_rerender_below,
+                                      predictions=services.prediction_manager,
+                                      portrait_cache=services.portrait_cache,
+                                      coalesce_stages=services.story_generator.char_style_flights is not None,
+                                      image_profile=services.story_generator.image_profile)
+flask_app = WsgiToAsgi(wsgi_app)
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def coalesce_options(scope):
+    # Same rules as main.coalesce_options, read from the ASGI scope
+    query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("utf-8"))
+    value = query.get("coalesce", [None])[0]
+    coalesce = services.coalesce_requests if value is None else value.lower() in ('1', 'true', 'yes')
+    variety = None
+    if coalesce and services.coalesce_per_user:
+        client = scope.get("client")
+        variety = dict(scope.get("headers", [])).get(b"x-user-id", b"").decode() or (client[0] if client else None)
+    return {"coalesce": coalesce, "variety": variety}
+
+
+async def generate_story(scope, receive, send):
+    try:
+        logger.info("Async generate story route called")
+        form = urllib.parse.parse_qs((await read_body(receive)).decode("utf-8"))
+        circumstance = form.get("circumstance", [None])[0]
+        protagonist_name = form.get("protagonist", [None])[0]
+        if not circumstance or not protagonist_name:
+            await send_json(send, 400, {"error": "circumstance and protagonist are required"})
+            return
+
+        protagonist_info = next((p for p in protagonists if p['Protagonist'] == protagonist_name), None)
+        if not protagonist_info:
+            logger.error("Protagonist not found: %s", protagonist_name)
+            await send_json(send, 400, {"error": "Protagonist not found"})
+            return
+
+        query = urllib.parse.parse_qs(scope.get("query_string", b"").decode("utf-8"))
+        image_profile = (query.get("image_profile") or form.get("image_profile") or [story_generator.image_profile])[0]
+        if image_profile not in image_profiles.PROFILES:
+            await send_json(send, 400, {"error": "Unknown image profile"})
+            return
+
+        # Each request runs in its own task, so the trace stays per request
+        trace = metrics.start_trace(dict(scope.get("headers", [])).get(b"x-request-id", b"").decode() or None)
+        # SQLite writes block, so keep them off the event loop
+        archive = services.archiver(protagonist_name, circumstance)
+
+        async def on_finish(results):
+            return await asyncio.to_thread(archive, results)
+
+        with consuming(Consumer(services.prediction_deadline)):
+            generation = asyncio.ensure_future(story_generator.generate_all(
+                protagonist_name, protagonist_info['Original Story'], protagonist_info['Author'], circumstance,
+                image_profile=image_profile, on_finish=on_finish, **coalesce_options(scope)))
+            disconnect = asyncio.ensure_future(wait_for_disconnect(receive))
+            await asyncio.wait({generation, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+            disconnect.cancel()
+            if not generation.done():
+                # Cancelling the pipeline's tasks releases their predictions
+                logger.info("Client disconnected, cancelling generation")
+                generation.cancel()
+                return
+            results = generation.result()
+        await send_json(send, 200, {
+            "comic_url": results["comic_url"],
+            "story": results["derivative_story"],
+            "visual_summary": results["visual_summary"],
+            "side_profile_url": results["side_profile_url"],
+            "headshot_url": results["headshot_url"],
+            "usage": trace.to_dict()["usage"],
+            "trace_id": trace.id,
+            "story_id": results.get("story_id"),
+        })
+    except Exception as e:
+        logger.error("An error occurred in async generate_story route: %s", e)
+        logger.error(traceback.format_exc())
+        await send_json(send, 500, {"error": str(e)})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await story_generator.aclose()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+    elif scope["type"] == "http" and scope["path"] == "/generate" and scope["method"] == "POST":
+        await generate_story(scope, receive, send)
+    else:
+        await flask_app(scope, receive, send)
@@ -0,0 +1,572 @@
+import asyncio
+import logging
+import os
+import time
+import traceback
+
+import httpx
+import replicate
+from anthropic import AsyncAnthropic
+
+import image_profiles
+import metrics
+import prompts
+from cache import make_cache_key
+from pipeline import AsyncPipeline
+from predictions import PredictionCancelled, PredictionManager
+from scheduler import Scheduler, estimate_tokens
+from similarity import HashingVectorizer
+from singleflight import AsyncSingleFlight
+from story_generator import OUTPUTS
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStoryGenerator:
+    """Coroutine counterpart of StoryGenerator.
+
+    Anthropic calls share one keep-alive connection pool, Replicate
+    predictions are awaited through the PredictionManager, and each
+    provider has its own semaphore so a burst of generations queues inside
+    the process instead of opening unbounded upstream requests.
+    """
+
+    def __init__(self, anthropic_concurrency=16, replicate_concurrency=8, max_connections=64,
+                 profile_cache=None, character_store=None, scheduler=None, artifact_store=None, fused=False,
+                 circumstance_cache=None, speculative=False, speculative_rerender_below=None, predictions=None,
+                 portrait_cache=None, coalesce_stages=True, image_profile=image_profiles.DEFAULT_PROFILE):
+        logger.info("Initializing AsyncStoryGenerator")
+        self.circumstance_cache = circumstance_cache
+        self.fused = fused
+        self.speculative = speculative
+        self.speculative_rerender_below = speculative_rerender_below
+        self.summary_vectorizer = HashingVectorizer()
+        self.profile_cache = profile_cache
+        self.portrait_cache = portrait_cache
+        self.char_style_flights = AsyncSingleFlight("char_style") if coalesce_stages else None
+        self.portrait_flights = AsyncSingleFlight("portrait") if coalesce_stages else None
+        self.request_flights = AsyncSingleFlight("generate")
+        if image_profile not in image_profiles.PROFILES:
+            raise ValueError(f"Unknown image profile: {image_profile}")
+        self.image_profile = image_profile
+        self.character_store = character_store
+        self.artifact_store = artifact_store
+        self.scheduler = scheduler or Scheduler.from_env()
+
+        anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
+        if not anthropic_api_key:
+            logger.error("ANTHROPIC_API_KEY not found in environment variables")
+            raise ValueError("ANTHROPIC_API_KEY is not set")
+        replicate_api_token = os.environ.get("REPLICATE_API_TOKEN")
+        if not replicate_api_token:
+            logger.error("REPLICATE_API_TOKEN not found in environment variables")
+            raise ValueError("REPLICATE_API_TOKEN is not set")
+
+        # One transport (and so one connection pool) for every Anthropic call
+        self.transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+        )
+        self.anthropic = AsyncAnthropic(
+            api_key=anthropic_api_key,
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=self.transport, timeout=httpx.Timeout(600.0, connect=5.0)),
+        )
+        # Creating, polling and cancelling are short calls made from worker
+        # threads; waiting for the result happens on the event loop
+        self.predictions = predictions or PredictionManager(replicate.Client(api_token=replicate_api_token))
+
+        self.anthropic_semaphore = asyncio.Semaphore(anthropic_concurrency)
+        self.replicate_semaphore = asyncio.Semaphore(replicate_concurrency)
+
+        logger.info("AsyncStoryGenerator initialized successfully")
+
+    async def aclose(self):
+        await self.anthropic.close()
+        await self.transport.aclose()
+
+    async def _send_message(self, **params):
+        async def create():
+            async with self.anthropic_semaphore:
+                return await self.anthropic.beta.prompt_caching.messages.create(model=prompts.CLAUDE_MODEL, **params)
+
+        response = await self.scheduler.acall(
+            "anthropic", prompts.CLAUDE_MODEL, create,
+            input_tokens=estimate_tokens(params["messages"], params.get("system")),
+            output_tokens=params["max_tokens"],
+        )
+        return response
+
+    async def _create_message(self, **params):
+        response = await self._send_message(**params)
+        return response.content[0].text
+
+    @staticmethod
+    async def get_or_create(cache, key, create):
+        """ResponseCache.get_or_create with a coroutine function `create`.
+
+        The cache reads from disk or another node and, when it is shared,
+        holds the node-wide lock while the value is made, so it runs on a
+        worker thread; `create` itself still runs on the loop. The thread
+        is held until the value is ready, which is what keeps two nodes
+        from making the same profile or portrait at once."""
+        loop = asyncio.get_running_loop()
+        return await asyncio.to_thread(cache.get_or_create, key,
+                                       lambda: asyncio.run_coroutine_threadsafe(create(), loop).result())
+
+    @metrics.instrumented("char_style")
+    async def generate_char_style_info(self, protagonist_name, original_story, author):
+        try:
+            logger.info("Generating character style info for %s", protagonist_name)
+            char_style_prompt = prompts.char_style_prompt(protagonist_name, original_story, author)
+            messages = [{"role": "user", "content": char_style_prompt}]
+            cache_key = make_cache_key(prompts.CLAUDE_MODEL, char_style_prompt, max_tokens=1000)
+
+            async def create():
+                return await self._create_message(max_tokens=1000, messages=messages)
+
+            async def lookup():
+                if self.profile_cache is None:
+                    return await create()
+                return await self.get_or_create(self.profile_cache, cache_key, create)
+
+            if self.char_style_flights is None:
+                char_style_info = await lookup()
+            else:
+                char_style_info = await self.char_style_flights.do(cache_key, lookup)
+            logger.info("Character style info generated: %s...", char_style_info[:100])
+            return char_style_info
+        except Exception as e:
+            logger.error("Error in generate_char_style_info: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @metrics.instrumented("situation")
+    async def generate_situation_setup(self, circumstance, char_style_info):
+        try:
+            logger.info("Generating situation setup for circumstance: %s...", circumstance[:50])
+            situation_prompt = prompts.situation_prompt(circumstance)
+            situation_setup = await self._create_message(
+                max_tokens=300,
+                system=prompts.character_system(char_style_info),
+                messages=[{"role": "user", "content": situation_prompt}],
+            )
+            logger.info("Situation setup generated: %s...", situation_setup[:100])
+            return situation_setup
+        except Exception as e:
+            logger.error("Error in generate_situation_setup: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @metrics.instrumented("story")
+    async def generate_story(self, char_style_info, situation_setup, on_text=None):
+        try:
+            logger.info("Starting story generation")
+            story_prompt = prompts.story_prompt(situation_setup)
+            system = prompts.character_system(char_style_info)
+            messages = [{"role": "user", "content": story_prompt}]
+
+            if on_text is not None:
+                emitted = []
+
+                async def stream_story():
+                    async with self.anthropic_semaphore, self.anthropic.beta.prompt_caching.messages.stream(
+                        model=prompts.CLAUDE_MODEL,
+                        max_tokens=2500,
+                        temperature=0.7,
+                        system=system,
+                        messages=messages,
+                    ) as stream:
+                        async for text in stream.text_stream:
+                            emitted.append(text)
+                            on_text(text)
+                        return await stream.get_final_message()
+
+                response = await self.scheduler.acall(
+                    "anthropic", prompts.CLAUDE_MODEL, stream_story,
+                    input_tokens=estimate_tokens(messages, system), output_tokens=2500,
+                    can_retry=lambda: not emitted,
+                )
+                story = response.content[0].text
+            else:
+                story = await self._create_message(max_tokens=2500, temperature=0.7, system=system, messages=messages)
+            logger.info("Story generated successfully")
+            return story
+        except Exception as e:
+            logger.error("Unexpected error in generate_story: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @metrics.instrumented("derivative")
+    async def generate_derivative_story(self, original_story, visual_summary, char_style_info):
+        try:
+            logger.info("Starting generation of 1-minute read-aloud snippet")
+            snippet_prompt = prompts.snippet_prompt(original_story, visual_summary)
+            snippet = await self._create_message(
+                max_tokens=1000,
+                temperature=0.7,
+                system=prompts.character_system(char_style_info),
+                messages=[{"role": "user", "content": snippet_prompt}],
+            )
+            logger.info("1-minute read-aloud snippet generated successfully")
+            return snippet
+        except Exception as e:
+            logger.error("Unexpected error in generate_derivative_story: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @metrics.instrumented("fused_story")
+    async def generate_fused_story(self, char_style_info, situation_setup):
+        try:
+            logger.info("Starting fused story, visual summary and snippet generation")
+            response = await self._send_message(
+                max_tokens=4000,
+                temperature=0.7,
+                system=prompts.character_system(char_style_info),
+                tools=[prompts.STORY_TOOL],
+                tool_choice={"type": "tool", "name": prompts.STORY_TOOL["name"]},
+                messages=[{"role": "user", "content": prompts.fused_story_prompt(situation_setup)}],
+            )
+        except Exception as e:
+            logger.error("Error in generate_fused_story: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+        story_result = prompts.story_result_from_message(response)
+        logger.info("Fused story generated successfully")
+        return story_result
+
+    async def generate_story_result(self, char_style_info, situation_setup, on_text=None, fused=None):
+        if self.fused if fused is None else fused:
+            try:
+                story_result = await self.generate_fused_story(char_style_info, situation_setup)
+                metrics.FUSED_RESULTS.inc(result="ok")
+                return story_result
+            except ValueError as e:
+                metrics.FUSED_RESULTS.inc(result="fallback")
+                logger.warning("Fused generation failed validation, falling back to separate calls: %s", e)
+
+        full_story = await self.generate_story(char_style_info, situation_setup, on_text=on_text)
+        original_story, visual_summary = self.split_story(full_story)
+        snippet = await self.generate_derivative_story(original_story, visual_summary, char_style_info)
+        return prompts.StoryResult(original_story, visual_summary, snippet)
+
+    async def generate_image_with_replicate(self, prompt, role="comic", profile=None):
+        try:
+            profile = profile or self.image_profile
+            spec = image_profiles.image_spec(profile, role)
+            logger.info("Generating %s %s image with %s. Prompt: %s...", profile, role, spec.model, prompt[:100])
+            async def run():
+                async with self.replicate_semaphore:
+                    return await self.predictions.arun(spec.model, spec.input(prompt))
+
+            started = time.perf_counter()
+            output = await self.scheduler.acall("replicate", spec.model, run)
+            metrics.record_image(profile, role, spec.model, time.perf_counter() - started, spec.cost)
+            # Newer replicate clients return FileOutput objects rather than URL strings
+            image_url = str(output[0])
+            logger.info("Image generated successfully. URL: %s", image_url)
+            return await self.mirror_image(image_url)
+        except PredictionCancelled as e:
+            logger.info("Image generation stopped: %s", e)
+            raise
+        except Exception as e:
+            logger.error("Error in generate_image_with_replicate: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    async def mirror_image(self, image_url):
+        if self.artifact_store is None:
+            return image_url
+        try:
+            with metrics.stage("mirror"):
+                # Blocking download and thumbnailing stay off the event loop
+                return await asyncio.to_thread(self.artifact_store.mirror, image_url)
+        except Exception as e:
+            logger.warning("Keeping upstream URL, mirroring failed: %s", e)
+            return image_url
+
+    async def generate_portrait(self, prompt, role, profile=None):
+        with metrics.stage(role):
+            spec = image_profiles.image_spec(profile or self.image_profile, role)
+            cache_key = make_cache_key(spec.model, spec.input(prompt))
+
+            async def render():
+                return await self.generate_image_with_replicate(prompt, role, profile)
+
+            async def lookup():
+                if self.portrait_cache is None:
+                    return await render()
+                return await self.get_or_create(self.portrait_cache, cache_key, render)
+
+            if self.portrait_flights is None:
+                return await lookup()
+            return await self.portrait_flights.do(cache_key, lookup)
+
+    def extract_key_traits(self, char_style_info):
+        return prompts.extract_key_traits(char_style_info)
+
+    def character_image_prompts(self, char_style_info):
+        return prompts.character_image_prompts(self.extract_key_traits(char_style_info))
+
+    def split_story(self, full_story):
+        return prompts.split_story(full_story)
+
+    def speculative_visual_summary(self, situation_setup, char_style_info):
+        return prompts.speculative_visual_summary(situation_setup, self.extract_key_traits(char_style_info))
+
+    async def generate_character_images(self, char_style_info, profile=None):
+        try:
+            logger.info("Starting character image generation with Replicate")
+            side_profile_prompt, headshot_prompt = self.character_image_prompts(char_style_info)
+            side_profile_url, headshot_url = await asyncio.gather(
+                self.generate_portrait(side_profile_prompt, "side_profile", profile),
+                self.generate_portrait(headshot_prompt, "headshot", profile),
+            )
+            logger.info("Character images generated successfully with Replicate")
+            return side_profile_url, headshot_url
+        except Exception as e:
+            logger.error("Error in generate_character_images: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @metrics.instrumented("comic")
+    async def generate_comic(self, story, profile=None):
+        try:
+            logger.info("Starting comic generation with Replicate")
+            comic_url = await self.generate_image_with_replicate(prompts.comic_prompt(prompts.comic_visual_summary(story)),
+                                                                 "comic", profile)
+            logger.info("Comic image generated successfully with Replicate")
+            return comic_url
+        except Exception as e:
+            logger.error("Error in generate_comic: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @metrics.instrumented("speculative_comic")
+    async def generate_speculative_comic(self, situation_setup, char_style_info, profile=None):
+        try:
+            logger.info("Starting speculative comic generation from the situation setup")
+            prompt = prompts.comic_prompt(self.speculative_visual_summary(situation_setup, char_style_info))
+            comic_url = await self.generate_image_with_replicate(prompt, "comic", profile)
+            logger.info("Speculative comic image generated successfully with Replicate")
+            return comic_url
+        except Exception as e:
+            logger.error("Error in generate_speculative_comic: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    async def accept_speculative_comic(self, speculative_comic_url):
+        metrics.SPECULATIVE_COMICS.inc(result="unchecked")
+        return speculative_comic_url
+
+    async def check_speculative_comic(self, speculative_comic_url, situation_setup, char_style_info, visual_summary,
+                                      profile=None):
+        similarity = self.summary_vectorizer.similarity(
+            self.speculative_visual_summary(situation_setup, char_style_info), visual_summary)
+        metrics.SPECULATIVE_SIMILARITY.observe(similarity)
+        if similarity >= self.speculative_rerender_below:
+            metrics.SPECULATIVE_COMICS.inc(result="kept")
+            return speculative_comic_url
+        logger.info("Re-rendering comic from the story, speculative summary similarity %.2f is below %s",
+                    similarity, self.speculative_rerender_below)
+        metrics.SPECULATIVE_COMICS.inc(result="rerendered")
+        return await self.generate_comic(visual_summary, profile)
+
+    def build_pipeline(self, protagonist_name=None, original_story=None, author=None, circumstance=None, on_story_text=None,
+                       fused=None, speculative=None, image_profile=None):
+        # Same graph as StoryGenerator.build_pipeline, with coroutine steps
+        pipeline = AsyncPipeline()
+        speculative = self.speculative if speculative is None else speculative
+        image_profile = image_profile or self.image_profile
+        pipeline.add_step(
+            "char_style_info",
+            lambda: self.generate_char_style_info(protagonist_name, original_story, author))
+        pipeline.add_step(
+            "situation_setup",
+            lambda char_style_info: self.situation_setup_for(protagonist_name, circumstance, char_style_info),
+            deps=["char_style_info"])
+        if self.fused if fused is None else fused:
+            pipeline.add_step(
+                "story_result",
+                lambda char_style_info, situation_setup: self.generate_story_result(
+                    char_style_info, situation_setup, on_text=on_story_text, fused=True),
+                deps=["char_style_info", "situation_setup"])
+            pipeline.add_step(
+                "story_parts",
+                self._story_parts_step,
+                deps=["story_result"])
+            pipeline.add_step(
+                "derivative_story",
+                self._snippet_step,
+                deps=["story_result"])
+            if not speculative:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda story_parts: self.generate_comic(story_parts[1], image_profile),
+                    deps=["story_parts"])
+        else:
+            pipeline.add_step(
+                "full_story",
+                lambda char_style_info, situation_setup: self.generate_story(char_style_info, situation_setup, on_text=on_story_text),
+                deps=["char_style_info", "situation_setup"])
+            pipeline.add_step(
+                "story_parts",
+                self._split_story_step,
+                deps=["full_story"])
+            pipeline.add_step(
+                "derivative_story",
+                lambda story_parts, char_style_info: self.generate_derivative_story(story_parts[0], story_parts[1], char_style_info),
+                deps=["story_parts", "char_style_info"])
+            if not speculative:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda full_story: self.generate_comic(full_story, image_profile),
+                    deps=["full_story"])
+        if speculative:
+            pipeline.add_step(
+                "speculative_comic_url",
+                lambda char_style_info, situation_setup: self.generate_speculative_comic(situation_setup, char_style_info,
+                                                                                         image_profile),
+                deps=["char_style_info", "situation_setup"])
+            if self.speculative_rerender_below is None:
+                pipeline.add_step(
+                    "comic_url",
+                    self.accept_speculative_comic,
+                    deps=["speculative_comic_url"])
+            else:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda speculative_comic_url, story_parts, situation_setup, char_style_info: self.check_speculative_comic(
+                        speculative_comic_url, situation_setup, char_style_info, story_parts[1], image_profile),
+                    deps=["speculative_comic_url", "story_parts", "situation_setup", "char_style_info"])
+        pipeline.add_step(
+            "character_prompts",
+            self._character_prompts_step,
+            deps=["char_style_info"])
+        pipeline.add_step(
+            "side_profile_url",
+            lambda character_prompts: self.generate_portrait(character_prompts[0], "side_profile", image_profile),
+            deps=["character_prompts"])
+        pipeline.add_step(
+            "headshot_url",
+            lambda character_prompts: self.generate_portrait(character_prompts[1], "headshot", image_profile),
+            deps=["character_prompts"])
+        return pipeline
+
+    async def _split_story_step(self, full_story):
+        return self.split_story(full_story)
+
+    async def _story_parts_step(self, story_result):
+        return story_result.story_parts
+
+    async def _snippet_step(self, story_result):
+        return story_result.snippet
+
+    async def _character_prompts_step(self, char_style_info):
+        return self.character_image_prompts(char_style_info)
+
+    async def stored_character_artifacts(self, protagonist_name, image_profile=None):
+        if self.character_store is None:
+            return {}
+        record = await asyncio.to_thread(self.character_store.get, protagonist_name,
+                                         image_profile or self.image_profile) or {}
+        metrics.record_cache("character_store", bool(record))
+        return {name: record[name] for name in ("char_style_info", "side_profile_url", "headshot_url") if name in record}
+
+    async def situation_setup_for(self, protagonist_name, circumstance, char_style_info):
+        cache = self.circumstance_cache
+        if cache is None or cache.mode != "situation" or protagonist_name is None:
+            return await self.generate_situation_setup(circumstance, char_style_info)
+        situation_setup = cache.lookup(protagonist_name, circumstance)
+        if situation_setup is None:
+            situation_setup = await self.generate_situation_setup(circumstance, char_style_info)
+            cache.store(protagonist_name, circumstance, situation_setup)
+        return situation_setup
+
+    def cached_story(self, protagonist_name, circumstance, fused, image_profile):
+        # Stories rendered another way (fused, or with another image
+        # profile) are kept apart, as they are when coalescing
+        if self.circumstance_cache is None or self.circumstance_cache.mode != "story":
+            return None
+        return self.circumstance_cache.lookup(protagonist_name, circumstance, variant=(fused, image_profile))
+
+    async def generate_all(self, protagonist_name, original_story, author, circumstance, on_result=None, on_story_text=None, on_start=None,
+                           fused=None, speculative=None, coalesce=False, variety=None, image_profile=None, on_finish=None):
+        """Like StoryGenerator.generate_all, except that only calls without
+        callbacks are coalesced, there are no progressive drafts and
+        `on_finish` is a coroutine function."""
+        try:
+            logger.info("Starting full generation pipeline for %s", protagonist_name)
+            fused = self.fused if fused is None else fused
+            image_profile = image_profile or self.image_profile
+            cached = self.cached_story(protagonist_name, circumstance, fused, image_profile)
+            if cached is not None:
+                if on_result is not None:
+                    for name in OUTPUTS:
+                        on_result(name, cached[name])
+                return await self.finish(dict(cached, visual_summary=cached["story_parts"][1]), on_finish)
+
+            if coalesce and on_result is None and on_story_text is None and on_start is None:
+                speculative = self.speculative if speculative is None else speculative
+                key = make_cache_key("generate_all", [protagonist_name, original_story, author, circumstance],
+                                     fused=fused, speculative=speculative, variety=variety, image_profile=image_profile,
+                                     progressive=False)
+                trace = metrics.current_trace()
+
+                async def run():
+                    # The shared task has its own context: its stages go to
+                    # a trace of their own, merged into each caller's below
+                    run_trace = metrics.Trace(trace.id if trace is not None else None)
+                    metrics.set_trace(run_trace)
+                    results = await self.generate_all(
+                        protagonist_name, original_story, author, circumstance, fused=fused, speculative=speculative,
+                        image_profile=image_profile, on_finish=on_finish)
+                    return results, run_trace, trace
+
+                results, run_trace, leader = await self.request_flights.do(key, run)
+                if trace is not None:
+                    trace.merge(run_trace, coalesced=leader is not trace)
+                return dict(results)
+
+            stored = await self.stored_character_artifacts(protagonist_name, image_profile)
+            if on_result is not None:
+                for name, value in stored.items():
+                    on_result(name, value)
+
+            pipeline = self.build_pipeline(protagonist_name, original_story, author, circumstance, on_story_text=on_story_text,
+                                           fused=fused, speculative=speculative, image_profile=image_profile)
+            results = await pipeline.run(
+                inputs=stored,
+                outputs=OUTPUTS,
+                on_result=on_result,
+                on_start=on_start,
+            )
+            if self.circumstance_cache is not None and self.circumstance_cache.mode == "story":
+                self.circumstance_cache.store(protagonist_name, circumstance, {name: results[name] for name in OUTPUTS},
+                                              variant=(fused, image_profile))
+            results["visual_summary"] = results["story_parts"][1]
+            logger.info("Full generation pipeline finished")
+            return await self.finish(results, on_finish)
+        except Exception as e:
+            logger.error("Error in generate_all: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @staticmethod
+    async def finish(results, on_finish):
+        if on_finish is not None:
+            results.update(await on_finish(results) or {})
+        return results
+
+    async def generate_story_and_images(self, char_style_info, situation_setup, author):
+        try:
+            logger.info("Starting story and image generation")
+            results = await self.build_pipeline(author=author).run(
+                inputs={"char_style_info": char_style_info, "situation_setup": situation_setup}
+            )
+            return (results["comic_url"], results["derivative_story"], results["story_parts"][1],
+                    results["side_profile_url"], results["headshot_url"])
+        except Exception as e:
+            logger.error("Error in generate_story_and_images: %s", e)
+            logger.error(traceback.format_exc())
+            raise
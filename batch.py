@@ -0,0 +1,262 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import image_profiles
+
+logger = logging.getLogger(__name__)
+
+ITEM_OUTPUTS = ["situation_setup", "story_parts", "derivative_story", "comic_url"]
+
+
+class BatchRunner:
+    """Generates many (protagonist, circumstance) stories in one go.
+
+    Work that only depends on the protagonist (the character profile and
+    both portraits) runs once per protagonist and is shared by every item
+    that uses it; the per-circumstance steps run with bounded parallelism.
+    """
+
+    def __init__(self, story_generator, protagonists, concurrency=4, image_profile=None):
+        self.story_generator = story_generator
+        self.protagonists = {p['Protagonist']: p for p in protagonists}
+        self.concurrency = concurrency
+        # None renders with the story generator's own profile
+        self.image_profile = image_profile
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+
+    def validate(self, items):
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise ValueError("A batch is a list of objects")
+        unknown = sorted({item.get('protagonist') for item in items} - set(self.protagonists))
+        if unknown:
+            raise ValueError(f"Unknown protagonists: {', '.join(str(name) for name in unknown)}")
+        if any(not item.get('circumstance') for item in items):
+            raise ValueError("Every item needs a circumstance")
+        if self.image_profile is not None and self.image_profile not in image_profiles.PROFILES:
+            raise ValueError(f"Unknown image profile: {self.image_profile}")
+
+    def _character(self, protagonist_name):
+        protagonist_info = self.protagonists[protagonist_name]
+        stored = self.story_generator.stored_character_artifacts(protagonist_name, self.image_profile)
+        char_style_info = stored.get('char_style_info') or self.story_generator.generate_char_style_info(
+            protagonist_name, protagonist_info['Original Story'], protagonist_info['Author'])
+        return char_style_info, stored
+
+    def _portraits(self, char_style_info, stored):
+        if 'side_profile_url' in stored and 'headshot_url' in stored:
+            return stored['side_profile_url'], stored['headshot_url']
+        return self.story_generator.generate_character_images(char_style_info, self.image_profile)
+
+    def run(self, items, output=None):
+        self.validate(items)
+        protagonist_names = sorted({item['protagonist'] for item in items})
+        logger.info("Starting batch of %s items over %s protagonists", len(items), len(protagonist_names))
+
+        # Shared per-protagonist work gets its own pool so items waiting on
+        # it can never starve it of threads
+        with ThreadPoolExecutor(max_workers=self.concurrency) as shared, \
+                ThreadPoolExecutor(max_workers=self.concurrency) as per_item:
+            characters = {name: shared.submit(self._character, name) for name in protagonist_names}
+            portraits = {}
+            for name in protagonist_names:
+                portraits[name] = shared.submit(lambda future: self._portraits(*future.result()), characters[name])
+
+            futures = {
+                per_item.submit(self._run_item, item, characters[item['protagonist']], portraits[item['protagonist']]): item
+                for item in items
+            }
+            for future in as_completed(futures):
+                record = future.result()
+                with self.lock:
+                    if record['status'] == 'ok':
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                    if output is not None:
+                        output.write(json.dumps(record) + "\n")
+                        output.flush()
+                    logger.info("[%s/%s] %s: %s", self.completed + self.failed, len(items), record['id'],
+                                record['status'])
+
+        return {"total": len(items), "completed": self.completed, "failed": self.failed}
+
+    def _run_item(self, item, character, portraits):
+        record = {
+            "id": item.get('id') or uuid.uuid4().hex,
+            "protagonist": item['protagonist'],
+            "circumstance": item['circumstance'],
+        }
+        started = time.perf_counter()
+        try:
+            char_style_info, _ = character.result()
+            protagonist_info = self.protagonists[item['protagonist']]
+            results = self.story_generator.build_pipeline(
+                item['protagonist'], protagonist_info['Original Story'], protagonist_info['Author'], item['circumstance'],
+                image_profile=self.image_profile,
+            ).run(inputs={"char_style_info": char_style_info}, outputs=ITEM_OUTPUTS)
+            side_profile_url, headshot_url = portraits.result()
+            record.update({
+                "status": "ok",
+                "comic_url": results["comic_url"],
+                "story": results["derivative_story"],
+                "visual_summary": results["story_parts"][1],
+                "side_profile_url": side_profile_url,
+                "headshot_url": headshot_url,
+            })
+        except Exception as e:
+            logger.error("Batch item %s failed: %s", record['id'], e)
+            logger.debug(traceback.format_exc())
+            record.update({"status": "error", "error": str(e)})
+        record["seconds"] = time.perf_counter() - started
+        return record
+
+
+class BatchManager:
+    """Runs batches submitted over HTTP in the background, writing each
+    one's results to `<output_dir>/<batch_id>.jsonl` as items finish.
+
+    At most `max_batches` batches run at once; the rest wait, queued, for
+    a free worker. A batch is forgotten `finished_ttl` seconds after it
+    finishes; its results file stays in `output_dir`.
+    """
+
+    def __init__(self, story_generator, protagonists, output_dir, concurrency=4, max_batches=2,
+                 finished_ttl=24 * 3600.0):
+        self.story_generator = story_generator
+        self.protagonists = protagonists
+        self.output_dir = Path(output_dir)
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.concurrency = concurrency
+        self.executor = ThreadPoolExecutor(max_workers=max_batches, thread_name_prefix="batch")
+        self.batches = {}
+        self.finished_ttl = finished_ttl
+        self.lock = threading.Lock()
+
+    def _evict(self):
+        # Called with the lock held
+        cutoff = time.time() - self.finished_ttl
+        for batch_id in [batch_id for batch_id, batch in self.batches.items()
+                         if batch["finished_at"] is not None and batch["finished_at"] < cutoff]:
+            del self.batches[batch_id]
+
+    def results_path(self, batch_id):
+        return self.output_dir / f"{batch_id}.jsonl"
+
+    def submit(self, items, image_profile=None):
+        runner = BatchRunner(self.story_generator, self.protagonists, self.concurrency, image_profile=image_profile)
+        runner.validate(items)
+        batch_id = uuid.uuid4().hex
+        with self.lock:
+            self._evict()
+            self.batches[batch_id] = {"batch_id": batch_id, "status": "queued", "total": len(items),
+                                      "runner": runner, "error": None, "created_at": time.time(),
+                                      "finished_at": None}
+        self.executor.submit(self._run, batch_id, runner, items)
+        return batch_id
+
+    def get(self, batch_id):
+        with self.lock:
+            self._evict()
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            runner = batch["runner"]
+            return {
+                "batch_id": batch_id,
+                "status": batch["status"],
+                "total": batch["total"],
+                "completed": runner.completed,
+                "failed": runner.failed,
+                "error": batch["error"],
+                "created_at": batch["created_at"],
+                "finished_at": batch["finished_at"],
+            }
+
+    def _set_status(self, batch_id, status, error=None):
+        with self.lock:
+            self.batches[batch_id]["status"] = status
+            self.batches[batch_id]["error"] = error
+            if status in ("finished", "failed"):
+                self.batches[batch_id]["finished_at"] = time.time()
+
+    def _run(self, batch_id, runner, items):
+        self._set_status(batch_id, "running")
+        try:
+            with open(self.results_path(batch_id), "w") as output:
+                runner.run(items, output)
+            self._set_status(batch_id, "finished")
+        except Exception as e:
+            logger.error("Batch %s failed: %s", batch_id, e)
+            logger.error(traceback.format_exc())
+            self._set_status(batch_id, "failed", str(e))
+
+
+def read_items(path):
+    items = []
+    with open(path) as source:
+        for line_number, line in enumerate(source, 1):
+            if line.strip():
+                item = json.loads(line)
+                item.setdefault('id', f"line-{line_number}")
+                items.append(item)
+    return items
+
+
+def finished_ids(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as existing:
+        return {record['id'] for record in map(json.loads, filter(str.strip, existing)) if record.get('status') == 'ok'}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate stories for every line of a JSONL file")
+    parser.add_argument("input", help='JSONL file with {"protagonist": ..., "circumstance": ..., "id": ...} per line')
+    parser.add_argument("output", help="JSONL file results are appended to as they finish")
+    parser.add_argument("--concurrency", type=int, default=4, help="Items generated at the same time")
+    parser.add_argument("--resume", action="store_true", help="Skip items already written to the output with status ok")
+    parser.add_argument("--image-profile", default=None, help="Image profile to render with: draft, standard or hero")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path=Path(__file__).resolve().parent / 'jawn.env')
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    from artifacts import ArtifactStore
+    from character_store import CharacterStore
+    from protagonists import protagonists
+    from story_generator import StoryGenerator
+
+    items = read_items(args.input)
+    if args.resume:
+        done = finished_ids(args.output)
+        items = [item for item in items if item['id'] not in done]
+        logger.info("Resuming: %s items already done", len(done))
+
+    character_store_path = os.environ.get("CHARACTER_STORE_PATH", "characters.db")
+    artifact_store_path = os.environ.get("ARTIFACT_STORE_PATH", "artifacts")
+    story_generator = StoryGenerator(
+        character_store=CharacterStore(character_store_path) if os.path.exists(character_store_path) else None,
+        artifact_store=ArtifactStore(artifact_store_path) if artifact_store_path else None)
+    runner = BatchRunner(story_generator, protagonists, concurrency=args.concurrency, image_profile=args.image_profile)
+    with open(args.output, "a" if args.resume else "w") as output:
+        summary = runner.run(items, output)
+    logger.info("Batch finished: %s ok, %s failed of %s", summary['completed'], summary['failed'], summary['total'])
+    return 1 if summary['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,384 @@
+import json
+import logging
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-ins for the Anthropic Messages API and Replicate predictions
+# API. They speak just enough of each protocol for the official clients,
+# with configurable latency, error rate and 429 rate.
+
+logger = logging.getLogger(__name__)
+
+CANNED_PROFILE = """1. Character Essence:
+   a) Core personality traits:
+   - Quietly stubborn
+   - Observant and wry
+   - Loyal to a fault
+   f) Basic physical characteristics:
+   Late twenties, lean build, usually in a worn canvas jacket
+"""
+
+CANNED_STORY = """The train doors hiss open and I step onto the platform with a box of everything I own. """ * 30 + """
+
+VISUAL SUMMARY:
+- Setting: A rain-slicked elevated train platform at dusk
+- Protagonist: A lean figure in a worn canvas jacket holding a cardboard box
+- Key Object: A cracked office badge clipped to the box
+- Action: Tossing the badge into a bin as the train pulls away
+- Mood: Cold light giving way to warm streetlamps
+"""
+
+CANNED_TOOL_INPUT = {
+    "story": CANNED_STORY.split("VISUAL SUMMARY:")[0].strip(),
+    "visual_summary": {
+        "setting": "A rain-slicked elevated train platform at dusk",
+        "protagonist": "A lean figure in a worn canvas jacket holding a cardboard box",
+        "key_object": "A cracked office badge clipped to the box",
+        "action": "Tossing the badge into a bin as the train pulls away",
+        "mood": "Cold light giving way to warm streetlamps",
+    },
+    "snippet": "The train doors hiss open and I step onto the platform with a box of everything I own.",
+}
+
+# Anthropic caches nothing shorter than this, marked or not
+MIN_CACHEABLE_TOKENS = 1024
+
+# Small solid-colour PNG served for every generated image
+PNG_IMAGE = bytes.fromhex(
+    "89504e470d0a1a0a0000000d49484452000000080000000808020000004b6d29dc000000154944415478da633c51a1c180"
+    "0d3031e000835302001e2701782596ca350000000049454e44ae426082"
+)
+
+
+def parse_latency(spec):
+    """Build a latency sampler from a spec such as "fixed:2",
+    "uniform:1,3" or "lognormal:2,0.5" (median seconds, sigma)."""
+    kind, _, args = spec.partition(":")
+    values = [float(value) for value in args.split(",") if value]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class BackendBehaviour:
+
+    def __init__(self, latency="fixed:0.1", error_rate=0.0, rate_limit_rate=0.0, retry_after=1.0, time_scale=1.0,
+                 webhook_drop_rate=0.0):
+        self.sample_latency = parse_latency(latency)
+        # Share of prediction webhooks never sent, to exercise polling fallbacks
+        self.webhook_drop_rate = webhook_drop_rate
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "errors": 0, "rate_limited": 0, "webhooks": 0}
+
+    def latency(self):
+        return self.sample_latency() * self.time_scale
+
+    def outcome(self):
+        # Decided up front for each request: "ok", "error" or "rate_limited"
+        roll = random.random()
+        with self.lock:
+            self.counts["requests"] += 1
+            if roll < self.rate_limit_rate:
+                self.counts["rate_limited"] += 1
+                return "rate_limited"
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.counts["errors"] += 1
+                return "error"
+        return "ok"
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeBackend/1.0"
+
+    def log_message(self, format, *args):
+        logger.debug("%s: %s", self.server.name, format % args)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_failure(self, outcome):
+        behaviour = self.server.behaviour
+        if outcome == "rate_limited":
+            self.send_json(429, {"type": "error", "error": {"type": "rate_limit_error", "message": "Simulated rate limit"},
+                                 "detail": "Simulated rate limit"},
+                           {"Retry-After": str(behaviour.retry_after * behaviour.time_scale)})
+        else:
+            self.send_json(500, {"type": "error", "error": {"type": "api_error", "message": "Simulated failure"},
+                                 "detail": "Simulated failure"})
+
+
+class AnthropicHandler(FakeHandler):
+
+    def do_POST(self):
+        # The prompt-caching beta posts to /v1/messages?beta=prompt_caching
+        if self.path.split("?")[0] != "/v1/messages":
+            self.send_json(404, {"type": "error", "error": {"type": "not_found_error", "message": self.path}})
+            return
+        request = self.read_json()
+        behaviour = self.server.behaviour
+        outcome = behaviour.outcome()
+        if outcome != "ok":
+            self.send_failure(outcome)
+            return
+
+        prompt = json.dumps(request.get("messages", []))
+        text = CANNED_STORY if "VISUAL SUMMARY" in prompt else CANNED_PROFILE
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": min(request.get("max_tokens", 1000), len(text) // 4)}
+        usage.update(self.prompt_cache_usage(request.get("system")))
+        content = [{"type": "text", "text": text}]
+        if request.get("tools"):
+            # Forced tool calls get a canned, schema-valid tool input
+            tool = request["tools"][0]["name"]
+            content = [{"type": "tool_use", "id": f"toolu_{uuid.uuid4().hex[:24]}", "name": tool, "input": CANNED_TOOL_INPUT}]
+            usage["output_tokens"] = min(request.get("max_tokens", 1000), len(json.dumps(CANNED_TOOL_INPUT)) // 4)
+        message = {
+            "id": f"msg_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": request.get("model"),
+            "content": content,
+            "stop_reason": "tool_use" if request.get("tools") else "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+        latency = behaviour.latency()
+        if request.get("stream"):
+            self.stream_message(message, latency)
+        else:
+            time.sleep(latency)
+            self.send_json(200, message)
+
+    def prompt_cache_usage(self, system):
+        # System blocks up to each cache_control marker are a cacheable
+        # prefix, if at least MIN_CACHEABLE_TOKENS long: written on first
+        # sight, read for the next five minutes. The longest one already
+        # cached is read and the rest of the longest one is written.
+        if not isinstance(system, list):
+            return {}
+        prefixes = []
+        for i, block in enumerate(system):
+            if block.get("cache_control"):
+                prefix = json.dumps(system[:i + 1], sort_keys=True)
+                if len(prefix) // 4 >= MIN_CACHEABLE_TOKENS:
+                    prefixes.append(prefix)
+        if not prefixes:
+            return {}
+        now = time.time()
+        read = 0
+        with self.server.lock:
+            for prefix in prefixes:
+                written_at = self.server.prompt_cache.get(prefix)
+                if written_at is not None and now - written_at < 300:
+                    read = len(prefix) // 4
+                self.server.prompt_cache[prefix] = now
+        return {"cache_creation_input_tokens": len(prefixes[-1]) // 4 - read, "cache_read_input_tokens": read}
+
+    def stream_message(self, message, latency):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        text = message["content"][0]["text"]
+        chunks = [text[i:i + 40] for i in range(0, len(text), 40)]
+        start = dict(message, content=[], stop_reason=None, usage=dict(message["usage"], output_tokens=1))
+
+        def event(name, payload):
+            self.wfile.write(f"event: {name}\ndata: {json.dumps(payload)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        event("message_start", {"type": "message_start", "message": start})
+        event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for chunk in chunks:
+            time.sleep(latency / len(chunks))
+            event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}})
+        event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+        event("message_stop", {"type": "message_stop"})
+
+
+class ReplicateHandler(FakeHandler):
+
+    def base_url(self):
+        return f"http://{self.server.server_address[0]}:{self.server.server_address[1]}"
+
+    def prediction_payload(self, prediction):
+        now = time.time()
+        if prediction["status"] == "starting" and now >= prediction["ready_at"]:
+            prediction["status"] = prediction["final_status"]
+            prediction["completed_at"] = now
+        payload = {
+            "id": prediction["id"],
+            "model": prediction["model"],
+            "version": "fake",
+            "input": prediction["input"],
+            "status": prediction["status"],
+            "output": None,
+            "error": None,
+            "logs": "",
+            "metrics": {},
+            "created_at": datetime.fromtimestamp(prediction["created_at"], timezone.utc).isoformat(),
+            "urls": {
+                "get": f"{self.base_url()}/v1/predictions/{prediction['id']}",
+                "cancel": f"{self.base_url()}/v1/predictions/{prediction['id']}/cancel",
+            },
+        }
+        if prediction["status"] == "succeeded":
+            payload["output"] = [f"{self.base_url()}/outputs/{prediction['id']}.png"]
+            payload["metrics"] = {"predict_time": prediction["completed_at"] - prediction["created_at"]}
+        elif prediction["status"] == "failed":
+            payload["error"] = "Simulated prediction failure"
+        return payload
+
+    def send_webhook(self, prediction):
+        # Like Replicate's "completed" event: the final prediction, POSTed once
+        time.sleep(max(0.0, prediction["ready_at"] - time.time()))
+        payload = self.prediction_payload(prediction)
+        if payload["status"] not in ("succeeded", "failed"):
+            return
+        request = urllib.request.Request(prediction["webhook"], data=json.dumps(payload).encode("utf-8"),
+                                         headers={"Content-Type": "application/json"}, method="POST")
+        try:
+            urllib.request.urlopen(request, timeout=5).close()
+            with self.server.behaviour.lock:
+                self.server.behaviour.counts["webhooks"] += 1
+        except Exception as e:
+            logger.debug("Webhook for %s failed: %s", prediction['id'], e)
+
+    def do_POST(self):
+        parts = self.path.strip("/").split("/")
+        behaviour = self.server.behaviour
+
+        # POST /v1/models/{owner}/{name}/predictions
+        if len(parts) == 5 and parts[:2] == ["v1", "models"] and parts[4] == "predictions":
+            request = self.read_json()
+            outcome = behaviour.outcome()
+            if outcome == "rate_limited":
+                self.send_failure(outcome)
+                return
+            now = time.time()
+            # Render time grows with the step count; latency specs are for 28 steps
+            steps = request.get("input", {}).get("num_inference_steps", 28)
+            prediction = {
+                "id": uuid.uuid4().hex[:20],
+                "model": f"{parts[2]}/{parts[3]}",
+                "input": request.get("input", {}),
+                "webhook": request.get("webhook"),
+                "status": "starting",
+                # Model failures surface as a failed prediction, not an HTTP error
+                "final_status": "failed" if outcome == "error" else "succeeded",
+                "created_at": now,
+                "ready_at": now + behaviour.latency() * steps / 28,
+            }
+            with self.server.lock:
+                self.server.predictions[prediction["id"]] = prediction
+            if prediction["webhook"] and random.random() >= behaviour.webhook_drop_rate:
+                timer = threading.Timer(prediction["ready_at"] - now, self.send_webhook, args=(prediction,))
+                timer.daemon = True
+                timer.start()
+            if "wait" in (self.headers.get("Prefer") or ""):
+                time.sleep(max(0.0, prediction["ready_at"] - time.time()))
+            self.send_json(201, self.prediction_payload(prediction))
+            return
+
+        # POST /v1/predictions/{id}/cancel
+        if len(parts) == 4 and parts[:2] == ["v1", "predictions"] and parts[3] == "cancel":
+            with self.server.lock:
+                prediction = self.server.predictions.get(parts[2])
+            if prediction is None:
+                self.send_json(404, {"detail": "Not found"})
+                return
+            if prediction["status"] == "starting":
+                prediction["status"] = "canceled"
+                self.server.cancelled += 1
+            self.send_json(200, self.prediction_payload(prediction))
+            return
+
+        self.send_json(404, {"detail": "Not found"})
+
+    def do_GET(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) == 3 and parts[:2] == ["v1", "predictions"]:
+            with self.server.lock:
+                prediction = self.server.predictions.get(parts[2])
+            if prediction is None:
+                self.send_json(404, {"detail": "Not found"})
+                return
+            self.send_json(200, self.prediction_payload(prediction))
+            return
+        if len(parts) == 2 and parts[0] == "outputs":
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(PNG_IMAGE)))
+            self.end_headers()
+            self.wfile.write(PNG_IMAGE)
+            return
+        self.send_json(404, {"detail": "Not found"})
+
+
+class FakeServer:
+
+    def __init__(self, handler, behaviour, name, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.behaviour = behaviour
+        self.httpd.name = name
+        self.httpd.lock = threading.Lock()
+        self.httpd.predictions = {}
+        self.httpd.cancelled = 0
+        self.httpd.prompt_cache = {}
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=name, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def behaviour(self):
+        return self.httpd.behaviour
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fake_anthropic(**behaviour):
+    return FakeServer(AnthropicHandler, BackendBehaviour(**behaviour), "fake-anthropic")
+
+
+def fake_replicate(**behaviour):
+    return FakeServer(ReplicateHandler, BackendBehaviour(**behaviour), "fake-replicate")
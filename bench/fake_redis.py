@@ -0,0 +1,211 @@
+import socketserver
+import threading
+import time
+
+# In-process stand-in for a Redis server: RESP2 over TCP with just the
+# commands shared.RedisBackend uses (GET, SET with PX/EX/NX/XX, DEL and
+# WATCH/MULTI/EXEC), so several app nodes can share state in tests and
+# benchmarks without a real server.
+
+
+
+class CommandError(Exception):
+    pass
+
+
+class Status(bytes):
+    # Sent as a simple string (+OK) rather than a bulk string
+    pass
+
+
+OK = Status(b"OK")
+QUEUED = Status(b"QUEUED")
+# What EXEC returns when a watched key has changed
+ABORTED = object()
+
+
+class Store:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.expires = {}
+        # Bumped on every write, for WATCH
+        self.versions = {}
+        self.counts = {}
+
+    def _live(self, key):
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self._delete(key)
+        return key in self.values
+
+    def _delete(self, key):
+        existed = self.values.pop(key, None) is not None
+        self.expires.pop(key, None)
+        self.versions[key] = self.versions.get(key, 0) + 1
+        return existed
+
+    def version(self, key):
+        self._live(key)
+        return self.versions.get(key, 0)
+
+    def get(self, key):
+        return self.values[key] if self._live(key) else None
+
+    def set(self, key, value, options):
+        ttl, nx, xx = None, False, False
+        options = [option.upper() for option in options]
+        i = 0
+        while i < len(options):
+            if options[i] in (b"PX", b"EX"):
+                ttl = int(options[i + 1]) / (1000.0 if options[i] == b"PX" else 1.0)
+                i += 2
+                continue
+            if options[i] == b"NX":
+                nx = True
+            elif options[i] == b"XX":
+                xx = True
+            else:
+                raise CommandError("ERR syntax error")
+            i += 1
+        exists = self._live(key)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self.values[key] = value
+        self.versions[key] = self.versions.get(key, 0) + 1
+        if ttl:
+            self.expires[key] = time.monotonic() + ttl
+        else:
+            self.expires.pop(key, None)
+        return OK
+
+    def execute(self, args):
+        """Run one command under the store lock; returns a RESP value."""
+        name = args[0].upper()
+        self.counts[name.decode()] = self.counts.get(name.decode(), 0) + 1
+        if name == b"PING":
+            return Status(b"PONG") if len(args) == 1 else args[1]
+        if name in (b"CLIENT", b"SELECT"):
+            return OK
+        if name == b"HELLO":
+            if len(args) > 1 and args[1] != b"2":
+                raise CommandError("NOPROTO only RESP2 is supported")
+            return [b"server", b"redis", b"version", b"7.0.0", b"proto", 2, b"mode", b"standalone"]
+        if name == b"GET":
+            return self.get(args[1])
+        if name == b"SET":
+            return self.set(args[1], args[2], args[3:])
+        if name == b"DEL":
+            return sum(1 for key in args[1:] if self._delete(key))
+        if name == b"EXISTS":
+            return sum(1 for key in args[1:] if self._live(key))
+        if name == b"DBSIZE":
+            return sum(1 for key in list(self.values) if self._live(key))
+        if name in (b"FLUSHDB", b"FLUSHALL"):
+            for key in list(self.values):
+                self._delete(key)
+            return OK
+        raise CommandError(f"ERR unknown command '{name.decode()}'")
+
+
+class RESPHandler(socketserver.StreamRequestHandler):
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def encode(self, value):
+        if value is None:
+            return b"$-1\r\n"
+        if value is ABORTED:
+            return b"*-1\r\n"
+        if isinstance(value, CommandError):
+            return f"-{value}\r\n".encode()
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode() + b"".join(self.encode(item) for item in value)
+        if isinstance(value, Status):
+            return b"+" + value + b"\r\n"
+        return b"$" + str(len(value)).encode() + b"\r\n" + value + b"\r\n"
+
+    def handle(self):
+        store = self.server.store
+        watched = {}
+        queued = None
+        while True:
+            args = self.read_command()
+            if not args:
+                return
+            name = args[0].upper()
+            with store.lock:
+                try:
+                    if name == b"WATCH":
+                        for key in args[1:]:
+                            watched[key] = store.version(key)
+                        reply = OK
+                    elif name == b"UNWATCH":
+                        watched.clear()
+                        reply = OK
+                    elif name == b"MULTI":
+                        queued = []
+                        reply = OK
+                    elif name == b"DISCARD":
+                        queued = None
+                        watched.clear()
+                        reply = OK
+                    elif name == b"EXEC":
+                        if queued is None:
+                            raise CommandError("ERR EXEC without MULTI")
+                        if any(store.version(key) != version for key, version in watched.items()):
+                            reply = ABORTED
+                        else:
+                            reply = [store.execute(command) for command in queued]
+                        queued = None
+                        watched.clear()
+                    elif queued is not None:
+                        queued.append(args)
+                        reply = QUEUED
+                    else:
+                        reply = store.execute(args)
+                except CommandError as e:
+                    reply = e
+                except (IndexError, ValueError):
+                    reply = CommandError(f"ERR wrong arguments for '{name.decode()}' command")
+            self.wfile.write(self.encode(reply))
+            self.wfile.flush()
+
+
+class FakeRedis:
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.server = socketserver.ThreadingTCPServer((host, port), RESPHandler)
+        self.server.daemon_threads = True
+        self.server.store = Store()
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-redis", daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    @property
+    def counts(self):
+        return self.server.store.counts
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
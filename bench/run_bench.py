@@ -0,0 +1,232 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from bench.fake_backends import fake_anthropic, fake_replicate
+from bench.fake_redis import FakeRedis
+
+# Hermetic benchmark: drives /generate through main.create_app() against the
+# fake backends and writes machine-readable results that can be compared across
+# commits, e.g.
+#
+#   python -m bench.run_bench --concurrency 1,8,32 --output before.json
+#   python -m bench.run_bench --concurrency 1,8,32 --compare before.json
+#
+# --nodes N builds N separate apps and spreads requests over them, like N
+# instances behind a load balancer; --shared-backend redis gives them a
+# stand-in Redis server to share caches, locks and jobs through.
+
+logger = logging.getLogger(__name__)
+
+CIRCUMSTANCES = [
+    "I just lost my job",
+    "My landlord is selling the building",
+    "I found a wallet full of cash on the subway",
+    "My best friend is moving across the country",
+    "I have to give a speech at my sister's wedding",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def rss_mb():
+    # Current resident set size on Linux, peak RSS elsewhere
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).resolve().parent.parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure_environment(anthropic_url, replicate_url, args):
+    os.environ["ANTHROPIC_API_KEY"] = "bench-key"
+    os.environ["REPLICATE_API_TOKEN"] = "bench-token"
+    os.environ["ANTHROPIC_BASE_URL"] = anthropic_url
+    os.environ["REPLICATE_BASE_URL"] = replicate_url
+    os.environ["PREDICTION_POLL_INTERVAL"] = str(args.poll_interval)
+    if not args.keep_rate_limits:
+        # Measure the pipeline, not our own quota settings
+        for name in ("ANTHROPIC_RPM", "ANTHROPIC_INPUT_TPM", "ANTHROPIC_OUTPUT_TPM", "REPLICATE_RPM"):
+            os.environ[name] = "100000000"
+    os.environ.setdefault("UPSTREAM_MAX_RETRIES", str(args.max_retries))
+
+
+def cache_totals(apps, name):
+    hits = misses = 0
+    for app in apps:
+        cache = getattr(app.extensions["story"], name)
+        if cache is not None:
+            stats = cache.stats()
+            hits += stats["hits"]
+            misses += stats["misses"]
+    return hits, misses
+
+
+def run_level(apps, protagonists, concurrency, requests, endpoint):
+    def one_request(i):
+        # Round robin, as a load balancer would
+        client = apps[i % len(apps)].test_client()
+        protagonist = protagonists[i % len(protagonists)]['Protagonist']
+        start = time.perf_counter()
+        response = client.post(endpoint, data={
+            "protagonist": protagonist,
+            "circumstance": random.choice(CIRCUMSTANCES),
+        })
+        # Drain streamed bodies so the whole generation is timed
+        body = response.get_data(as_text=True)
+        status = response.status_code
+        if status == 200 and '"event": "error"' in body:
+            status = 500
+        return time.perf_counter() - start, status
+
+    caches_before = {name: cache_totals(apps, name) for name in ("profile_cache", "portrait_cache")}
+    rss_before = rss_mb()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one_request, range(requests)))
+    wall = time.perf_counter() - start
+
+    latencies = [latency for latency, status in outcomes if status == 200]
+    errors = sum(1 for _, status in outcomes if status != 200)
+    hit_rates = {}
+    for name, (hits_before, misses_before) in caches_before.items():
+        hits, misses = cache_totals(apps, name)
+        lookups = hits - hits_before + misses - misses_before
+        hit_rates[name.replace("_cache", "_hit_rate")] = (hits - hits_before) / lookups if lookups else None
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "wall_seconds": wall,
+        "throughput_rps": len(latencies) / wall if wall else None,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        "latency_p99": percentile(latencies, 99),
+        "latency_max": max(latencies) if latencies else None,
+        "rss_mb_before": rss_before,
+        "rss_mb_after": rss_mb(),
+        "peak_rss_mb": peak_rss_mb(),
+        **hit_rates,
+    }
+
+
+def compare(baseline, current):
+    print(f"{'concurrency':>11} {'metric':>15} {'baseline':>10} {'current':>10} {'change':>8}")
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in current["levels"]:
+        before = baseline_levels.get(level["concurrency"])
+        if before is None:
+            continue
+        for metric in ("throughput_rps", "latency_p50", "latency_p95", "latency_p99", "peak_rss_mb"):
+            old, new = before.get(metric), level.get(metric)
+            if old is None or new is None:
+                continue
+            change = f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{level['concurrency']:>11} {metric:>15} {old:>10.3f} {new:>10.3f} {change:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark /generate against simulated Anthropic and Replicate backends")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--endpoint", default="/generate", help="Route to exercise (/generate or /generate/stream)")
+    parser.add_argument("--anthropic-latency", default="lognormal:2,0.4", help="Latency spec per Claude call")
+    parser.add_argument("--replicate-latency", default="lognormal:6,0.3", help="Latency spec per prediction")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream calls that fail")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Fraction of upstream calls answered with 429")
+    parser.add_argument("--time-scale", type=float, default=0.1, help="Multiplier applied to every simulated latency")
+    parser.add_argument("--poll-interval", type=float, default=0.05, help="Replicate client poll interval")
+    parser.add_argument("--max-retries", type=int, default=4, help="Scheduler retries per upstream call")
+    parser.add_argument("--protagonists", type=int, default=58, help="How many distinct protagonists to cycle through")
+    parser.add_argument("--keep-rate-limits", action="store_true", help="Keep the scheduler's configured quotas")
+    parser.add_argument("--nodes", type=int, default=1, help="App instances to spread requests over")
+    parser.add_argument("--shared-backend", choices=("none", "redis", "sqlite"), default="none",
+                        help="State shared by the nodes: a stand-in Redis server, a SQLite file, or nothing")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for latencies and inputs")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Baseline results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s %(levelname)s: %(message)s')
+    random.seed(args.seed)
+
+    behaviour = {"error_rate": args.error_rate, "rate_limit_rate": args.rate_limit_rate, "time_scale": args.time_scale}
+    anthropic = fake_anthropic(latency=args.anthropic_latency, **behaviour).start()
+    replicate = fake_replicate(latency=args.replicate_latency, **behaviour).start()
+    configure_environment(anthropic.url, replicate.url, args)
+    shared = None
+    if args.shared_backend == "redis":
+        shared = FakeRedis().start()
+        os.environ["SHARED_BACKEND_URL"] = shared.url
+    elif args.shared_backend == "sqlite":
+        os.environ["SHARED_BACKEND_URL"] = os.path.join(tempfile.mkdtemp(prefix="bench-shared-"), "shared.db")
+
+    # Built only now, so the apps pick up the fake endpoints
+    import main as app_module
+    apps = [app_module.create_app() for _ in range(args.nodes)]
+    logging.getLogger().setLevel(logging.WARNING)
+    protagonists = app_module.protagonists[:args.protagonists]
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "levels": [],
+    }
+    try:
+        for concurrency in (int(level) for level in args.concurrency.split(",")):
+            level = run_level(apps, protagonists, concurrency, args.requests, args.endpoint)
+            results["levels"].append(level)
+            print(f"concurrency={concurrency:<4} rps={level['throughput_rps'] or 0:.2f} "
+                  f"p50={level['latency_p50'] or 0:.2f}s p95={level['latency_p95'] or 0:.2f}s "
+                  f"p99={level['latency_p99'] or 0:.2f}s errors={level['errors']} rss={level['rss_mb_after']:.0f}MB "
+                  f"profile_hits={level['profile_hit_rate'] or 0:.0%}")
+    finally:
+        results["backends"] = {"anthropic": anthropic.behaviour.counts, "replicate": replicate.behaviour.counts}
+        anthropic.stop()
+        replicate.stop()
+        if shared is not None:
+            results["backends"]["shared"] = shared.counts
+            shared.stop()
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(results, indent=2))
+    if args.compare:
+        compare(json.loads(Path(args.compare).read_text()), results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
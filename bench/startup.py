@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Cold start check: in a fresh interpreter, times `import main`,
+# create_app() and the first /generate against the fake backends, and
+# fails when the median of any of them is over budget, e.g.
+#
+#   python -m bench.startup --import-budget 0.5 --first-request-budget 1.5
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def measure_once():
+    # Runs in the child process, so nothing is imported yet
+    started = time.perf_counter()
+    import main
+    imported = time.perf_counter()
+    app = main.create_app()
+    created = time.perf_counter()
+    sdk_loaded = "anthropic" in sys.modules or "replicate" in sys.modules
+
+    client = app.test_client()
+    if os.environ.get("STARTUP_WARM") == "1":
+        client.get("/ready?warm=1")
+    warmed = time.perf_counter()
+    response = client.post("/generate", data={
+        "protagonist": main.protagonists[0]['Protagonist'],
+        "circumstance": "I just lost my job",
+    })
+    finished = time.perf_counter()
+    if response.status_code != 200:
+        raise RuntimeError(f"First request failed with {response.status_code}: {response.get_data(as_text=True)}")
+    return {
+        "import_seconds": imported - started,
+        "create_app_seconds": created - imported,
+        "warm_seconds": warmed - created,
+        "first_request_seconds": finished - warmed,
+        "sdk_loaded_at_startup": sdk_loaded,
+    }
+
+
+def run_child(env):
+    result = subprocess.run([sys.executable, "-m", "bench.startup", "--child"], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Startup measurement failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure import time and first-request latency of the app")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters to measure")
+    parser.add_argument("--import-budget", type=float, default=0.5, help="Seconds allowed for `import main`")
+    parser.add_argument("--first-request-budget", type=float, default=1.5,
+                        help="Seconds allowed from create_app() returning to the first /generate response")
+    parser.add_argument("--latency", default="fixed:0.05", help="Latency spec for every simulated upstream call")
+    parser.add_argument("--warm", action="store_true", help="Call /ready?warm=1 before the first request")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure_once()))
+        return 0
+
+    from bench.fake_backends import fake_anthropic, fake_replicate
+
+    anthropic = fake_anthropic(latency=args.latency).start()
+    replicate = fake_replicate(latency=args.latency).start()
+    env = dict(os.environ)
+    env.update({
+        "ANTHROPIC_API_KEY": "bench-key",
+        "REPLICATE_API_TOKEN": "bench-token",
+        "ANTHROPIC_BASE_URL": anthropic.url,
+        "REPLICATE_BASE_URL": replicate.url,
+        "PREDICTION_POLL_INTERVAL": "0.05",
+        "LOG_LEVEL": "WARNING",
+        # No state from earlier runs: every run starts cold
+        "CHARACTER_STORE_PATH": "",
+        "PROFILE_CACHE_PATH": "",
+        "ARTIFACT_STORE_PATH": "",
+        "STORY_ARCHIVE_PATH": "",
+        "STARTUP_WARM": "1" if args.warm else "0",
+    })
+    try:
+        runs = [run_child(env) for _ in range(args.runs)]
+    finally:
+        anthropic.stop()
+        replicate.stop()
+
+    over_budget = []
+    for metric, budget in (("import_seconds", args.import_budget), ("create_app_seconds", None),
+                           ("warm_seconds", None), ("first_request_seconds", args.first_request_budget)):
+        median = statistics.median(run[metric] for run in runs)
+        status = "" if budget is None else f" (budget {budget:.3f}s{', OVER' if median > budget else ''})"
+        print(f"{metric:>22} median={median:.3f}s max={max(run[metric] for run in runs):.3f}s{status}")
+        if budget is not None and median > budget:
+            over_budget.append(metric)
+    if any(run["sdk_loaded_at_startup"] for run in runs):
+        print("anthropic or replicate was imported before the first request")
+        over_budget.append("sdk_loaded_at_startup")
+    return 1 if over_budget else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
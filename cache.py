@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model, prompt, **params):
+    # Content-addressed: the same prompt, model and parameters always map
+    # to the same key, whatever the caller's arguments looked like
+    payload = json.dumps({"model": model, "prompt": prompt, "params": params}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class MemoryTier:
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteTier:
+
+    def __init__(self, path, max_entries=10000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self.conn.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.conn.commit()
+                return None
+            self.conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+        return json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), expires_at, now),
+            )
+            self._evict(now)
+            self.conn.commit()
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM cache")
+            self.conn.commit()
+
+    def _evict(self, now):
+        self.conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        # Least recently used rows go first once the table is over its limit
+        self.conn.execute(
+            """DELETE FROM cache WHERE key IN (
+                SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_entries,),
+        )
+
+
+class SharedTier:
+    """Persistent tier on a shared backend (see shared.py), so every node
+    reads what any node has cached. Backend errors count as misses."""
+
+    def __init__(self, backend, prefix="cache:"):
+        self.backend = backend
+        self.prefix = prefix
+
+    def get(self, key):
+        try:
+            value = self.backend.get(self.prefix + key)
+        except Exception as e:
+            logger.warning("Shared cache read failed for %s: %s", key[:12], e)
+            return None
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.backend.set(self.prefix + key, json.dumps(value).encode("utf-8"), ttl)
+        except Exception as e:
+            logger.warning("Shared cache write failed for %s: %s", key[:12], e)
+
+    def delete(self, key):
+        self.backend.delete(self.prefix + key)
+
+
+class ResponseCache:
+    """Two-tier cache for model responses.
+
+    Lookups go to the in-memory LRU first and then to the optional
+    persistent tier; persistent hits are copied back into memory. With
+    `variants` > 1 each key holds a pool of up to that many responses:
+    the pool is filled on the first few lookups and a random member is
+    returned after that, so repeated requests don't always read the same
+    text. With `locks` (a shared.SharedLocks), a miss that another node is
+    already filling waits for that node's value.
+    """
+
+    def __init__(self, memory_size=256, ttl=None, persistent=None, variants=1, name="profile", locks=None):
+        self.name = name
+        self.memory = MemoryTier(memory_size)
+        self.persistent = persistent
+        self.locks = locks
+        self.ttl = ttl
+        self.variants = max(1, variants)
+        self.counters = defaultdict(lambda: {"hits": 0, "misses": 0})
+        self.lock = threading.Lock()
+
+    def _load_pool(self, key):
+        pool = self.memory.get(key)
+        if pool is None and self.persistent is not None:
+            pool = self.persistent.get(key)
+            if pool is not None:
+                self.memory.set(key, pool, self.ttl)
+        return pool or []
+
+    def _store_pool(self, key, pool):
+        self.memory.set(key, pool, self.ttl)
+        if self.persistent is not None:
+            self.persistent.set(key, pool, self.ttl)
+
+    def _record(self, key, hit):
+        metrics.record_cache(self.name, hit)
+        with self.lock:
+            self.counters[key]["hits" if hit else "misses"] += 1
+
+    def get(self, key):
+        pool = self._load_pool(key)
+        if len(pool) < self.variants:
+            self._record(key, hit=False)
+            return None
+        self._record(key, hit=True)
+        return random.choice(pool)
+
+    def set(self, key, value):
+        pool = self._load_pool(key)
+        pool = (pool + [value])[-self.variants:]
+        self._store_pool(key, pool)
+
+    def peek(self, key):
+        # Like get, but not counted as a lookup
+        pool = self._load_pool(key)
+        return random.choice(pool) if len(pool) >= self.variants else None
+
+    def get_or_create(self, key, create):
+        value = self.get(key)
+        if value is not None:
+            logger.debug("Cache hit for key %s", key[:12])
+            return value
+        logger.debug("Cache miss for key %s", key[:12])
+
+        def create_and_store():
+            value = create()
+            self.set(key, value)
+            return value
+
+        if self.locks is None:
+            return create_and_store()
+        return self.locks.coalesce(key, lambda: self.peek(key), create_and_store, name=self.name)
+
+    def invalidate(self, key):
+        self.memory.delete(key)
+        if self.persistent is not None:
+            self.persistent.delete(key)
+
+    def stats(self):
+        with self.lock:
+            per_key = {key: dict(counts) for key, counts in self.counters.items()}
+        hits = sum(counts["hits"] for counts in per_key.values())
+        misses = sum(counts["misses"] for counts in per_key.values())
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / total if total else 0.0,
+            "keys": per_key,
+        }
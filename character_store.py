@@ -0,0 +1,100 @@
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Fields of the character itself, and of its portraits in one image profile
+CHARACTER_FIELDS = ("char_style_info", "key_traits")
+PORTRAIT_FIELDS = ("side_profile_url", "headshot_url")
+FIELDS = CHARACTER_FIELDS + PORTRAIT_FIELDS
+
+
+class CharacterStore:
+    """Precomputed character artifacts keyed by protagonist name.
+
+    Portraits are kept per image profile, since each profile renders them
+    differently. Rows are filled in field by field, so a warm-up run that
+    dies halfway through a character keeps whatever it had already
+    produced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # Stores from before portraits were per profile also have portrait
+        # columns here; they are no longer read
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS characters (
+                protagonist TEXT PRIMARY KEY,
+                char_style_info TEXT,
+                key_traits TEXT,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS portraits (
+                protagonist TEXT NOT NULL,
+                image_profile TEXT NOT NULL,
+                side_profile_url TEXT,
+                headshot_url TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (protagonist, image_profile)
+            )"""
+        )
+        self.conn.commit()
+
+    def get(self, protagonist, image_profile):
+        with self.lock:
+            character = self.conn.execute(
+                f"SELECT {', '.join(CHARACTER_FIELDS)} FROM characters WHERE protagonist = ?", (protagonist,)
+            ).fetchone()
+            portraits = self.conn.execute(
+                f"SELECT {', '.join(PORTRAIT_FIELDS)} FROM portraits WHERE protagonist = ? AND image_profile = ?",
+                (protagonist, image_profile),
+            ).fetchone()
+        if character is None and portraits is None:
+            return None
+        record = {}
+        for fields, row in ((CHARACTER_FIELDS, character), (PORTRAIT_FIELDS, portraits)):
+            if row is not None:
+                record.update({field: value for field, value in zip(fields, row, strict=True) if value is not None})
+        return record
+
+    def update(self, protagonist, image_profile=None, **fields):
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown character store fields: {', '.join(sorted(unknown))}")
+        character = {field: value for field, value in fields.items() if field in CHARACTER_FIELDS}
+        portraits = {field: value for field, value in fields.items() if field in PORTRAIT_FIELDS}
+        if portraits and image_profile is None:
+            raise ValueError("Portraits are stored per image profile")
+        with self.lock:
+            if character:
+                self._upsert("characters", {"protagonist": protagonist}, character)
+            if portraits:
+                self._upsert("portraits", {"protagonist": protagonist, "image_profile": image_profile}, portraits)
+            self.conn.commit()
+
+    def _upsert(self, table, key, fields):
+        columns = [*key, *fields, "updated_at"]
+        values = [*key.values(), *fields.values(), time.time()]
+        assignments = ", ".join(f"{column} = excluded.{column}" for column in columns[len(key):])
+        self.conn.execute(
+            f"""INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})
+            ON CONFLICT ({', '.join(key)}) DO UPDATE SET {assignments}""",
+            values,
+        )
+
+    def is_complete(self, protagonist, image_profile):
+        record = self.get(protagonist, image_profile)
+        return record is not None and all(field in record for field in FIELDS)
+
+    def delete(self, protagonist):
+        with self.lock:
+            self.conn.execute("DELETE FROM characters WHERE protagonist = ?", (protagonist,))
+            self.conn.execute("DELETE FROM portraits WHERE protagonist = ?", (protagonist,))
+            self.conn.commit()
@@ -0,0 +1,80 @@
+# Named quality/latency tiers for the three images of a story. Each
+# profile picks the model, step count, size and format per image role;
+# the portraits are only shown as thumbnails, so they never need as much
+# as the comic does.
+
+FLUX_DEV = "black-forest-labs/flux-dev"
+FLUX_SCHNELL = "black-forest-labs/flux-schnell"
+
+# Replicate's list price per output image, for the cost estimates in metrics
+PRICES = {FLUX_DEV: 0.025, FLUX_SCHNELL: 0.003}
+
+ROLES = ("comic", "side_profile", "headshot")
+
+
+class ImageSpec:
+
+    def __init__(self, model, steps, aspect_ratio="1:1", megapixels=None, output_format=None, guidance=None):
+        self.model = model
+        self.steps = steps
+        self.aspect_ratio = aspect_ratio
+        self.megapixels = megapixels
+        self.output_format = output_format
+        self.guidance = guidance
+
+    @property
+    def cost(self):
+        return PRICES.get(self.model, 0.0)
+
+    def input(self, prompt):
+        params = {
+            "prompt": prompt,
+            "num_outputs": 1,
+            "aspect_ratio": self.aspect_ratio,
+            "num_inference_steps": self.steps,
+        }
+        # Unset options are left to the model's defaults
+        for name in ("megapixels", "output_format", "guidance"):
+            value = getattr(self, name)
+            if value is not None:
+                params[name] = value
+        return params
+
+
+PROFILES = {
+    # Seconds-fast previews, e.g. shown while a better render is on its way
+    "draft": {
+        "comic": ImageSpec(FLUX_SCHNELL, 4, megapixels="1", output_format="webp"),
+        "side_profile": ImageSpec(FLUX_SCHNELL, 4, megapixels="0.25", output_format="webp"),
+        "headshot": ImageSpec(FLUX_SCHNELL, 4, megapixels="0.25", output_format="webp"),
+    },
+    # The comic as it has always been rendered; portraits from the fast model
+    "standard": {
+        "comic": ImageSpec(FLUX_DEV, 28, guidance=3),
+        "side_profile": ImageSpec(FLUX_SCHNELL, 4, megapixels="1", output_format="webp"),
+        "headshot": ImageSpec(FLUX_SCHNELL, 4, megapixels="1", output_format="webp"),
+    },
+    "hero": {
+        "comic": ImageSpec(FLUX_DEV, 40, megapixels="1", output_format="png", guidance=3),
+        "side_profile": ImageSpec(FLUX_DEV, 28, megapixels="1", output_format="png", guidance=3),
+        "headshot": ImageSpec(FLUX_DEV, 28, megapixels="1", output_format="png", guidance=3),
+    },
+}
+
+DEFAULT_PROFILE = "standard"
+# What progressive generation shows before the requested profile's render
+DRAFT_PROFILE = "draft"
+
+
+def image_spec(profile, role):
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown image profile: {profile}")
+    return PROFILES[profile][role]
+
+
+def drafts_faster(profile, role):
+    # Whether a DRAFT_PROFILE render of `role` arrives well before the
+    # `profile` one. Drafts use the fastest model, and at these sizes the
+    # step count matters far more than the resolution.
+    spec, draft = image_spec(profile, role), image_spec(DRAFT_PROFILE, role)
+    return spec.model != draft.model or spec.steps > draft.steps
@@ -0,0 +1,381 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+import image_profiles
+import metrics
+from predictions import Consumer, consuming
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+UNFINISHED = (QUEUED, RUNNING)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+
+    def __init__(self, params, job_id=None, status=QUEUED, stages=None, result=None, error=None,
+                 created_at=None, updated_at=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.params = params
+        self.status = status
+        # Pipeline step -> pending, running, done or skipped
+        self.stages = stages or {}
+        self.result = result or {}
+        self.error = error
+        self.created_at = created_at or time.time()
+        self.updated_at = updated_at or self.created_at
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "params": self.params,
+            "status": self.status,
+            "stages": self.stages,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["params"], job_id=data["job_id"], status=data["status"], stages=data["stages"],
+                   result=data["result"], error=data["error"], created_at=data["created_at"],
+                   updated_at=data["updated_at"])
+
+
+class InMemoryJobStore:
+
+    def __init__(self, max_finished=1000):
+        self.max_finished = max_finished
+        self.jobs = {}
+        self.cancel_requests = set()
+        self.lock = threading.Lock()
+
+    def save(self, job):
+        with self.lock:
+            self.jobs[job.id] = Job.from_dict(job.to_dict())
+            finished = [j for j in self.jobs.values() if j.status in FINISHED]
+            if len(finished) > self.max_finished:
+                finished.sort(key=lambda j: j.updated_at)
+                for old in finished[:len(finished) - self.max_finished]:
+                    del self.jobs[old.id]
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return Job.from_dict(job.to_dict()) if job else None
+
+    def delete(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def request_cancel(self, job_id):
+        with self.lock:
+            self.cancel_requests.add(job_id)
+
+    def cancel_requested(self, job_id):
+        with self.lock:
+            return job_id in self.cancel_requests
+
+    def clear_cancel(self, job_id):
+        with self.lock:
+            self.cancel_requests.discard(job_id)
+
+    def unfinished(self):
+        # Nothing survives a restart here
+        return []
+
+
+class SQLiteJobStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                data TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS job_cancellations (id TEXT PRIMARY KEY)")
+        self.conn.commit()
+
+    def save(self, job):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, data, updated_at) VALUES (?, ?, ?, ?)",
+                (job.id, job.status, json.dumps(job.to_dict()), job.updated_at),
+            )
+            self.conn.commit()
+
+    def get(self, job_id):
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job.from_dict(json.loads(row[0])) if row else None
+
+    def delete(self, job_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            self.conn.commit()
+
+    def request_cancel(self, job_id):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO job_cancellations (id) VALUES (?)", (job_id,))
+            self.conn.commit()
+
+    def cancel_requested(self, job_id):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM job_cancellations WHERE id = ?", (job_id,)).fetchone() is not None
+
+    def clear_cancel(self, job_id):
+        with self.lock:
+            self.conn.execute("DELETE FROM job_cancellations WHERE id = ?", (job_id,))
+            self.conn.commit()
+
+    def unfinished(self):
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM jobs WHERE status IN (?, ?) ORDER BY updated_at",
+                                     UNFINISHED).fetchall()
+        return [Job.from_dict(json.loads(row[0])) for row in rows]
+
+
+class SharedJobStore:
+    """Jobs on a shared backend (see shared.py), so any node can report on
+    or cancel a job that another node is running. Finished jobs expire
+    after `finished_ttl` seconds."""
+
+    def __init__(self, backend, finished_ttl=7 * 24 * 3600):
+        self.backend = backend
+        self.finished_ttl = finished_ttl
+
+    def save(self, job):
+        self.backend.set(f"job:{job.id}", json.dumps(job.to_dict()).encode("utf-8"),
+                         self.finished_ttl if job.status in FINISHED else None)
+
+    def get(self, job_id):
+        data = self.backend.get(f"job:{job_id}")
+        return Job.from_dict(json.loads(data)) if data is not None else None
+
+    def delete(self, job_id):
+        self.backend.delete(f"job:{job_id}")
+
+    def request_cancel(self, job_id):
+        self.backend.set(f"job-cancel:{job_id}", b"1", self.finished_ttl)
+
+    def cancel_requested(self, job_id):
+        return self.backend.get(f"job-cancel:{job_id}") is not None
+
+    def clear_cancel(self, job_id):
+        self.backend.delete(f"job-cancel:{job_id}")
+
+    def unfinished(self):
+        # Other nodes may still be running theirs, so none are recovered
+        return []
+
+
+class JobManager:
+    """Runs story generations on a fixed pool of background workers.
+
+    Submissions beyond `max_queue` waiting jobs are rejected with
+    QueueFullError instead of piling up, so callers can back off.
+    Cancellations go through the store, so with a shared store a job can
+    be cancelled from any node; the node running it stops at its next
+    stage boundary. Each job's images share a `prediction_deadline`.
+
+    Jobs a previous process left unfinished in a persistent store are
+    picked up on startup: queued ones are queued again and running ones
+    failed, since their progress is lost. A SQLite store must therefore
+    belong to a single process.
+    """
+
+    def __init__(self, story_generator, protagonists, store=None, workers=4, max_queue=32, archiver=None,
+                 prediction_deadline=None):
+        self.story_generator = story_generator
+        # Services.archiver: makes the on_finish that archives a finished story
+        self.archiver = archiver
+        self.prediction_deadline = prediction_deadline
+        self.protagonists = {p['Protagonist']: p for p in protagonists}
+        self.store = store or InMemoryJobStore()
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.consumers = {}
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name=f"job-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        self._recover()
+
+    def _recover(self):
+        for job in self.store.unfinished():
+            if job.status == QUEUED:
+                try:
+                    self.queue.put_nowait(job.id)
+                    logger.info("Queued job %s again after a restart", job.id)
+                    continue
+                except queue.Full:
+                    error = "Job queue was full after a restart"
+            else:
+                error = "Interrupted by a restart"
+            logger.warning("Job %s failed: %s", job.id, error)
+            self._finish(job, FAILED, error)
+
+    def stages(self, image_profile=None):
+        # The steps generate_all runs for a job, in the order they were added
+        pipeline = self.story_generator.build_pipeline(image_profile=image_profile)
+        return dict.fromkeys(pipeline.steps, "pending")
+
+    def submit(self, protagonist_name, circumstance, image_profile=None):
+        if protagonist_name not in self.protagonists:
+            raise ValueError("Protagonist not found")
+        if image_profile is not None and image_profile not in image_profiles.PROFILES:
+            raise ValueError("Unknown image profile")
+        job = Job({"protagonist": protagonist_name, "circumstance": circumstance, "image_profile": image_profile},
+                  stages=self.stages(image_profile))
+        self.store.save(job)
+        try:
+            self.queue.put_nowait(job.id)
+        except queue.Full as e:
+            self.store.delete(job.id)
+            raise QueueFullError(f"Job queue is full ({self.queue.maxsize} waiting)") from e
+        logger.info("Queued job %s for %s", job.id, protagonist_name)
+        return job
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.store.get(job_id)
+        if job is None or job.status in FINISHED:
+            return job
+        self.store.request_cancel(job_id)
+        with self.lock:
+            consumer = self.consumers.get(job_id)
+        if consumer is not None:
+            # Stops the job's image predictions instead of waiting them out
+            consumer.abandon()
+        if job.status == QUEUED:
+            # The flag stays set until a worker dequeues the job and drops it
+            job.status = CANCELLED
+            job.updated_at = time.time()
+            self.store.save(job)
+        logger.info("Cancellation requested for job %s", job_id)
+        return self.store.get(job_id)
+
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _is_cancelled(self, job_id):
+        return self.store.cancel_requested(job_id)
+
+    def _finish(self, job, status, error=None):
+        job.status = status
+        job.error = error
+        job.updated_at = time.time()
+        self.store.save(job)
+        self.store.clear_cancel(job.id)
+
+    def _work(self):
+        while True:
+            job_id = self.queue.get()
+            try:
+                self._run(job_id)
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        if self._is_cancelled(job_id):
+            self._finish(job, CANCELLED)
+            return
+        if job.status != QUEUED:
+            return
+
+        job.status = RUNNING
+        job.updated_at = time.time()
+        self.store.save(job)
+        protagonist_info = self.protagonists[job.params["protagonist"]]
+
+        def on_start(name):
+            if self._is_cancelled(job_id):
+                raise JobCancelled(job_id)
+            if name in job.stages:
+                job.stages[name] = RUNNING
+                job.updated_at = time.time()
+                self.store.save(job)
+
+        def on_result(name, value):
+            if name in job.stages:
+                job.stages[name] = "done"
+            if name == "story_parts":
+                job.result["visual_summary"] = value[1]
+            elif name == "derivative_story":
+                job.result["story"] = value
+            elif name in ("comic_url", "side_profile_url", "headshot_url"):
+                job.result[name] = value
+            job.updated_at = time.time()
+            self.store.save(job)
+            # Steps already in flight finish, but nothing new is started
+            if self._is_cancelled(job_id):
+                raise JobCancelled(job_id)
+
+        consumer = Consumer(self.prediction_deadline)
+        with self.lock:
+            self.consumers[job_id] = consumer
+        try:
+            logger.info("Running job %s", job_id)
+            # The job's stages are timed on a trace of its own, which is
+            # archived with the story
+            metrics.start_trace(job_id)
+            on_finish = self.archiver(job.params["protagonist"], job.params["circumstance"]) if self.archiver else None
+            with consuming(consumer):
+                results = self.story_generator.generate_all(
+                    job.params["protagonist"], protagonist_info['Original Story'], protagonist_info['Author'],
+                    job.params["circumstance"], on_result=on_result, on_start=on_start,
+                    image_profile=job.params.get("image_profile"), on_finish=on_finish)
+            if results.get("story_id") is not None:
+                job.result["story_id"] = results["story_id"]
+            for name, state in job.stages.items():
+                if state == "pending":
+                    # e.g. a portrait step, with the portraits already stored
+                    job.stages[name] = "skipped"
+            self._finish(job, SUCCEEDED)
+            logger.info("Job %s succeeded", job_id)
+        except Exception as e:
+            if isinstance(e, JobCancelled) or self._is_cancelled(job_id):
+                self._finish(job, CANCELLED)
+                logger.info("Job %s cancelled", job_id)
+                return
+            logger.error("Job %s failed: %s", job_id, e)
+            logger.error(traceback.format_exc())
+            self._finish(job, FAILED, str(e))
+        finally:
+            with self.lock:
+                self.consumers.pop(job_id, None)
@@ -1,108 +1,664 @@
-import urllib.parse
-from dotenv import load_dotenv
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
 import os
+import queue
+import sys
+import threading
+import time
+import traceback
 from pathlib import Path
 
+from flask import Blueprint, Flask, Response, current_app, render_template, request, jsonify, send_file, send_from_directory, stream_with_context
+
+from story_generator import StoryGenerator
+from cache import ResponseCache, SQLiteTier, SharedTier
+from character_store import CharacterStore
+from artifacts import ArtifactStore
+from archive import StoryArchive
+from scheduler import Scheduler
+from predictions import PredictionManager, Consumer, consuming
+import metrics
+import image_profiles
+from jobs import JobManager, InMemoryJobStore, SQLiteJobStore, SharedJobStore, QueueFullError
+from batch import BatchManager
+from protagonists import protagonists
+
+# Nothing here talks to Anthropic or Replicate, or even imports their SDKs:
+# create_app() builds the app, the clients are created on first use, and
+# GET /ready?warm=1 (or READY_PREWARM=1) does that ahead of the first request.
+#
+#   gunicorn 'main:create_app()'
+
+logger = logging.getLogger(__name__)
+
 # Get the directory of the current script
 script_dir = Path(__file__).resolve().parent
 
 # Construct the path to the jawn.env file
 env_path = script_dir / 'jawn.env'
 
-# Load environment variables from .env file
-load_dotenv(dotenv_path=env_path)
+_log_listener = None
 
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import logging
-import sys
-from story_generator import StoryGenerator
-from protagonists import protagonists
-import traceback
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG, 
-                    format='%(asctime)s %(levelname)s: %(message)s',
-                    handlers=[logging.StreamHandler(sys.stdout)])
-logger = logging.getLogger(__name__)
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread unformatted, so request threads
+    only pay for putting them on the queue."""
+
+    def prepare(self, record):
+        return record
+
+
+def configure_logging():
+    # Records below LOG_LEVEL are dropped before their message is built;
+    # the rest are formatted and written by a background thread
+    global _log_listener
+    if _log_listener is not None:
+        return
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s'))
+    log_queue = queue.SimpleQueue()
+    _log_listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    root.handlers = [DeferredQueueHandler(log_queue)]
+
+
+class Services:
+    """Everything the routes share, built once per app by create_app."""
+
+    def __init__(self):
+        try:
+            # Initialize StoryGenerator
+            logger.info("Attempting to initialize StoryGenerator")
+            # SHARED_BACKEND_URL (redis://host:6379/0, or a SQLite path every node
+            # can reach) holds cached profiles and portraits, artifacts and jobs
+            # for all nodes, and lets only one node at a time fill a cache entry
+            shared_backend_url = os.environ.get("SHARED_BACKEND_URL")
+            if shared_backend_url:
+                from shared import SharedLocks, backend_from_url
+                self.shared_backend = backend_from_url(shared_backend_url)
+                shared_locks = SharedLocks(self.shared_backend, ttl=float(os.environ.get("SHARED_LOCK_TTL", "120")))
+            else:
+                self.shared_backend = shared_locks = None
+
+            # Character profiles only depend on the fixed protagonist list, so they
+            # are cached; PROFILE_CACHE_PATH adds a persistent tier that survives restarts
+            profile_cache_path = os.environ.get("PROFILE_CACHE_PATH")
+            if self.shared_backend is not None:
+                profile_tier = SharedTier(self.shared_backend, "profile:")
+            else:
+                profile_tier = SQLiteTier(profile_cache_path) if profile_cache_path else None
+            self.profile_cache = ResponseCache(
+                memory_size=int(os.environ.get("PROFILE_CACHE_SIZE", "128")),
+                ttl=float(os.environ.get("PROFILE_CACHE_TTL", "0")) or None,
+                persistent=profile_tier,
+                variants=int(os.environ.get("PROFILE_CACHE_VARIANTS", "1")),
+                locks=shared_locks,
+            )
+
+            # Filled ahead of time by warmup.py; the request path only calls the
+            # APIs for characters missing from it
+            character_store_path = os.environ.get("CHARACTER_STORE_PATH", "characters.db")
+            self.character_store = CharacterStore(character_store_path) if os.path.exists(character_store_path) else None
+
+            # Every Anthropic and Replicate call goes through this one scheduler, so
+            # rate limits and circuit breakers are shared by all requests
+            self.scheduler = Scheduler.from_env()
+
+            # Generated images are copied here and served from /artifacts, since
+            # Replicate's delivery URLs expire; set ARTIFACT_STORE_PATH empty to disable
+            artifact_store_path = os.environ.get("ARTIFACT_STORE_PATH", "artifacts")
+            self.artifact_store = ArtifactStore(
+                artifact_store_path,
+                # e.g. https://stories.example.com, for absolute URLs in API responses
+                url_prefix=os.environ.get("ARTIFACT_BASE_URL", "").rstrip("/") + "/artifacts",
+                thumbnail_sizes=[int(size) for size in os.environ.get("ARTIFACT_THUMBNAIL_SIZES", "256,512").split(",")],
+                shared=self.shared_backend,
+                shared_ttl=float(os.environ.get("ARTIFACT_SHARED_TTL", str(7 * 24 * 3600))),
+            ) if artifact_store_path else None
+
+            # Portraits are reused for the same profile when the cache is shared,
+            # or with PORTRAIT_CACHE=1. Unmirrored Replicate URLs expire after an
+            # hour, so without an artifact store entries only live 50 minutes;
+            # shared ones last as long as the shared copy of the image
+            if self.shared_backend is not None or os.environ.get("PORTRAIT_CACHE") == "1":
+                if self.artifact_store is None:
+                    portrait_ttl = 3000.0
+                else:
+                    portrait_ttl = self.artifact_store.shared_ttl if self.shared_backend is not None else None
+                self.portrait_cache = ResponseCache(
+                    memory_size=int(os.environ.get("PORTRAIT_CACHE_SIZE", "256")),
+                    ttl=float(os.environ.get("PORTRAIT_CACHE_TTL", "0")) or portrait_ttl,
+                    persistent=SharedTier(self.shared_backend, "portrait:") if self.shared_backend is not None else None,
+                    name="portrait",
+                    locks=shared_locks,
+                )
+            else:
+                self.portrait_cache = None
+
+            # Optional near-duplicate cache for circumstances: SIMILARITY_CACHE=situation
+            # reuses situation setups, SIMILARITY_CACHE=story reuses finished stories
+            similarity_mode = os.environ.get("SIMILARITY_CACHE")
+            if similarity_mode:
+                # Only imported when enabled; numpy adds to startup time
+                from similarity import SimilarityCache
+                self.circumstance_cache = SimilarityCache(
+                    threshold=float(os.environ.get("SIMILARITY_THRESHOLD", "0.85")),
+                    max_entries=int(os.environ.get("SIMILARITY_MAX_ENTRIES", "256")),
+                    ttl=float(os.environ.get("SIMILARITY_TTL", "0")) or None,
+                    mode=similarity_mode,
+                )
+            else:
+                self.circumstance_cache = None
+
+            # Tracks every Replicate prediction. With REPLICATE_WEBHOOK_URL (this app's
+            # public base URL) they complete by webhook and polling is only a fallback.
+            # PREDICTION_DEADLINE bounds how long a request waits for its images before
+            # they are cancelled
+            webhook_base_url = os.environ.get("REPLICATE_WEBHOOK_URL", "").rstrip("/")
+            self.prediction_manager = PredictionManager(
+                webhook_url=webhook_base_url + "/replicate/webhook" if webhook_base_url else None,
+                poll_interval=float(os.environ.get("PREDICTION_POLL_INTERVAL", "1")),
+                webhook_poll_interval=float(os.environ.get("PREDICTION_WEBHOOK_POLL_INTERVAL", "10")),
+                max_wait=float(os.environ.get("PREDICTION_MAX_WAIT", "600")),
+            )
+            self.prediction_deadline = float(os.environ.get("PREDICTION_DEADLINE", "300")) or None
+
+            # FUSED_GENERATION=1 writes story, visual summary and snippet in one
+            # tool-use call instead of two; ?fused=0/1 overrides it per request.
+            # SPECULATIVE_COMIC=1 draws the comic from the situation setup while the
+            # story is written (?speculative=0/1 per request); SPECULATIVE_RERENDER_BELOW
+            # redraws it from the story when the two summaries are less similar than that
+            # COALESCE_STAGES=0 stops identical concurrent profile and portrait calls
+            # from sharing one upstream call. IMAGE_PROFILE (draft, standard or hero,
+            # see image_profiles.py) picks the image models unless ?image_profile= does
+            speculative_rerender_below = os.environ.get("SPECULATIVE_RERENDER_BELOW")
+            self.story_generator = StoryGenerator(
+                profile_cache=self.profile_cache, character_store=self.character_store, scheduler=self.scheduler,
+                artifact_store=self.artifact_store, fused=os.environ.get("FUSED_GENERATION") == "1",
+                circumstance_cache=self.circumstance_cache,
+                speculative=os.environ.get("SPECULATIVE_COMIC") == "1",
+                speculative_rerender_below=float(speculative_rerender_below) if speculative_rerender_below else None,
+                predictions=self.prediction_manager, portrait_cache=self.portrait_cache,
+                coalesce_stages=os.environ.get("COALESCE_STAGES", "1") == "1",
+                image_profile=os.environ.get("IMAGE_PROFILE", image_profiles.DEFAULT_PROFILE))
+            logger.info("StoryGenerator initialized successfully")
+
+            # Identical /generate requests made while one is running get its story
+            # rather than their own (?coalesce=0 opts out). With COALESCE_PER_USER=1
+            # only requests from the same user (X-User-ID, else client address) are
+            # merged, so different users still get different stories
+            self.coalesce_requests = os.environ.get("COALESCE_REQUESTS", "1") == "1"
+            self.coalesce_per_user = os.environ.get("COALESCE_PER_USER") == "1"
+
+            # IMAGE_PROGRESSIVE=1 (or ?progressive=1) streams quick draft images
+            # first and replaces them as the final renders arrive
+            self.progressive_images = os.environ.get("IMAGE_PROGRESSIVE") == "1"
+        except Exception as e:
+            logger.error("Failed to initialize StoryGenerator: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+        # Finished stories are kept here for /stories permalinks and search; set
+        # STORY_ARCHIVE_PATH empty to disable
+        story_archive_path = os.environ.get("STORY_ARCHIVE_PATH", "stories.db")
+        self.story_archive = StoryArchive(story_archive_path) if story_archive_path else None
+
+        # Background workers for /jobs, so long generations don't hold request threads
+        job_store_path = os.environ.get("JOB_STORE_PATH")
+        if self.shared_backend is not None:
+            job_store = SharedJobStore(self.shared_backend)
+        else:
+            job_store = SQLiteJobStore(job_store_path) if job_store_path else InMemoryJobStore()
+        self.job_manager = JobManager(
+            self.story_generator,
+            protagonists,
+            store=job_store,
+            workers=int(os.environ.get("JOB_WORKERS", "4")),
+            max_queue=int(os.environ.get("JOB_QUEUE_SIZE", "32")),
+            archiver=self.archiver,
+            prediction_deadline=self.prediction_deadline,
+        )
+
+        # Bulk generation for /batch; results are written to BATCH_OUTPUT_DIR as they finish
+        self.batch_manager = BatchManager(
+            self.story_generator,
+            protagonists,
+            output_dir=os.environ.get("BATCH_OUTPUT_DIR", "batches"),
+            concurrency=int(os.environ.get("BATCH_CONCURRENCY", "4")),
+            max_batches=int(os.environ.get("BATCH_MAX_RUNNING", "2")),
+            finished_ttl=float(os.environ.get("BATCH_FINISHED_TTL", str(24 * 3600))),
+        )
+
+        self.warmed = threading.Event()
+        self.warm_lock = threading.Lock()
+
+    def warm(self):
+        with self.warm_lock:
+            if self.warmed.is_set():
+                return
+            started = time.perf_counter()
+            self.story_generator.warm()
+            self.warmed.set()
+            logger.info("Provider clients warmed in %.2fs", time.perf_counter() - started)
+
+    def archive_story(self, protagonist_name, circumstance, results, trace):
+        # A failed write shouldn't cost the user the story they just waited for
+        if self.story_archive is None:
+            return None
+        try:
+            return self.story_archive.save(protagonist_name, circumstance, results,
+                                           trace.to_dict() if trace is not None else None)
+        except Exception as e:
+            logger.error("Error archiving story: %s", e)
+            logger.error(traceback.format_exc())
+            return None
+
+    def archiver(self, protagonist_name, circumstance):
+        # generate_all's on_finish: archives the story once, however many
+        # callers it was coalesced for, with the trace of the run that made it
+        return lambda results: {"story_id": self.archive_story(protagonist_name, circumstance, results,
+                                                               metrics.current_trace())}
+
+
+bp = Blueprint("story", __name__)
+
+
+def create_app():
+    started = time.perf_counter()
+    configure_logging()
+    logger.info("Starting application initialization")
+
+    # Imported here so a process that never builds the app doesn't load it
+    from dotenv import load_dotenv
+
+    # Load environment variables from .env file
+    load_dotenv(dotenv_path=env_path)
+
+    # Check for ANTHROPIC_API_KEY
+    if not os.environ.get("ANTHROPIC_API_KEY"):
+        logger.error("ANTHROPIC_API_KEY not found in environment variables")
+        raise ValueError("ANTHROPIC_API_KEY is not set")
+
+    # Check for REPLICATE_API_TOKEN
+    if not os.environ.get("REPLICATE_API_TOKEN"):
+        logger.error("REPLICATE_API_TOKEN not found in environment variables")
+        raise ValueError("REPLICATE_API_TOKEN is not set")
+
+    services = Services()
 
-logger.info("Starting application initialization")
-
-# Check for ANTHROPIC_API_KEY
-anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
-if not anthropic_api_key:
-    logger.error("ANTHROPIC_API_KEY not found in environment variables")
-    raise ValueError("ANTHROPIC_API_KEY is not set")
-
-# Check for REPLICATE_API_TOKEN
-replicate_api_token = os.environ.get("REPLICATE_API_TOKEN")
-if not replicate_api_token:
-    logger.error("REPLICATE_API_TOKEN not found in environment variables")
-    raise ValueError("REPLICATE_API_TOKEN is not set")
-
-try:
-    # Initialize StoryGenerator
-    logger.info("Attempting to initialize StoryGenerator")
-    story_generator = StoryGenerator()
-    logger.info("StoryGenerator initialized successfully")
-except Exception as e:
-    logger.error(f"Failed to initialize StoryGenerator: {str(e)}")
-    logger.error(traceback.format_exc())
-    raise
-
-# Initialize Flask app
-logger.info("Initializing Flask app")
-app = Flask(__name__)
-logger.info("Flask app initialized")
-
-@app.route('/')
+    # Initialize Flask app
+    logger.info("Initializing Flask app")
+    app = Flask(__name__)
+    app.extensions["story"] = services
+    app.register_blueprint(bp)
+
+    # READY_PREWARM=1 keeps /ready at 503 until the clients are warm, so the
+    # load balancer only sends traffic to an instance that has paid that cost
+    app.config["READY_PREWARM"] = os.environ.get("READY_PREWARM") == "1"
+    if app.config["READY_PREWARM"]:
+        threading.Thread(target=services.warm, name="prewarm", daemon=True).start()
+
+    logger.info("Flask app initialized in %.2fs", time.perf_counter() - started)
+    return app
+
+
+def services():
+    return current_app.extensions["story"]
+
+
+def flag_option(name):
+    value = request.values.get(name)
+    return None if value is None else value.lower() in ('1', 'true', 'yes')
+
+
+def coalesce_options():
+    # generate_all's coalesce and variety arguments for this request
+    coalesce = flag_option('coalesce')
+    if coalesce is None:
+        coalesce = services().coalesce_requests
+    variety = None
+    if coalesce and services().coalesce_per_user:
+        variety = request.headers.get('X-User-ID') or request.remote_addr
+    return {"coalesce": coalesce, "variety": variety}
+
+
+def image_profile_option():
+    # ?image_profile= for this request; None if it names no profile
+    image_profile = request.values.get('image_profile') or services().story_generator.image_profile
+    return image_profile if image_profile in image_profiles.PROFILES else None
+
+@bp.route('/')
 def index():
     logger.info("Index route accessed")
     return render_template('index.html', protagonists=protagonists)
 
-@app.route('/generate', methods=['POST'])
+@bp.route('/ready')
+def ready():
+    # ?warm=1 warms the clients before answering, for a readiness probe
+    # that should only pass once the first request will be fast
+    if flag_option('warm'):
+        services().warm()
+    warm = services().warmed.is_set()
+    if current_app.config["READY_PREWARM"] and not warm:
+        return jsonify({"ready": False, "warm": warm}), 503
+    return jsonify({"ready": True, "warm": warm})
+
+@bp.route('/generate', methods=['POST'])
 def generate_story():
+    started = time.perf_counter()
+    trace = metrics.start_trace(request.headers.get('X-Request-ID'))
     try:
-        logger.info("Generate story route called")
+        logger.info("Generate story route called (trace %s)", trace.id)
         circumstance = request.form['circumstance']
         protagonist_name = request.form['protagonist']
-        logger.info(f"Generating story for {protagonist_name} in circumstance: {circumstance}")
+        logger.info("Generating story for %s in circumstance: %s", protagonist_name, circumstance)
 
         protagonist_info = next((p for p in protagonists if p['Protagonist'] == protagonist_name), None)
         if not protagonist_info:
-            logger.error(f"Protagonist not found: {protagonist_name}")
+            logger.error("Protagonist not found: %s", protagonist_name)
             return jsonify({"error": "Protagonist not found"}), 400
 
         original_story = protagonist_info['Original Story']
         author = protagonist_info['Author']
 
-        char_style_info = story_generator.generate_char_style_info(protagonist_name, original_story, author)
-        situation_setup = story_generator.generate_situation_setup(circumstance, char_style_info)
-        
-        comic_url, derivative_story, visual_summary, side_profile_url, headshot_url = story_generator.generate_story_and_images(char_style_info, situation_setup, author)
-        
-        return jsonify({
+        image_profile = image_profile_option()
+        if image_profile is None:
+            return jsonify({"error": "Unknown image profile"}), 400
+
+        # Runs the generation steps as a dependency graph, so independent
+        # Replicate renders overlap with the Claude calls they don't need
+        # Images still rendering when the request ends (e.g. another step
+        # failed) are cancelled on the way out
+        with consuming(Consumer(services().prediction_deadline)):
+            results = services().story_generator.generate_all(
+                protagonist_name, original_story, author, circumstance,
+                fused=flag_option('fused'), speculative=flag_option('speculative'), image_profile=image_profile,
+                on_finish=services().archiver(protagonist_name, circumstance), **coalesce_options())
+        comic_url = results["comic_url"]
+        derivative_story = results["derivative_story"]
+        visual_summary = results["visual_summary"]
+        side_profile_url = results["side_profile_url"]
+        headshot_url = results["headshot_url"]
+
+        response = {
             "comic_url": comic_url,
             "story": derivative_story,
             "visual_summary": visual_summary,
             "side_profile_url": side_profile_url,
             "headshot_url": headshot_url
-        })
+        }
+        usage = trace.to_dict()["usage"]
+        logger.info("Token usage for trace %s: %s", trace.id, usage)
+        response["usage"] = usage
+        story_id = results.get("story_id")
+        if story_id:
+            response["story_id"] = story_id
+        # Per-stage timings are only returned when asked for with ?trace=1
+        if request.values.get('trace'):
+            response["trace"] = trace.to_dict()
+            response["trace_id"] = trace.id
+        return jsonify(response)
 
     except Exception as e:
-        logger.error(f"An error occurred in generate_story route: {str(e)}")
+        logger.error("An error occurred in generate_story route: %s", e)
         logger.error(traceback.format_exc())
-        return jsonify({"error": str(e)}), 500
+        return jsonify({"error": str(e), "trace_id": trace.id}), 500
+    finally:
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - started, route="/generate")
+
+# Pipeline step name -> (event name, how to pull the payload out of the result)
+STREAM_EVENTS = {
+    "char_style_info": [("character_profile", lambda value: value)],
+    "situation_setup": [("situation", lambda value: value)],
+    "story_parts": [("story", lambda value: value[0]), ("visual_summary", lambda value: value[1])],
+    "derivative_story": [("snippet", lambda value: value)],
+    "speculative_comic_url": [("comic_preview", lambda value: value)],
+    "comic_draft_url": [("comic_preview", lambda value: value)],
+    "comic_url": [("comic_url", lambda value: value)],
+    "side_profile_draft_url": [("side_profile_preview", lambda value: value)],
+    "side_profile_url": [("side_profile_url", lambda value: value)],
+    "headshot_draft_url": [("headshot_preview", lambda value: value)],
+    "headshot_url": [("headshot_url", lambda value: value)],
+}
+
+@bp.route('/generate/stream', methods=['POST'])
+def generate_story_stream():
+    logger.info("Generate story stream route called")
+    circumstance = request.form['circumstance']
+    protagonist_name = request.form['protagonist']
+
+    protagonist_info = next((p for p in protagonists if p['Protagonist'] == protagonist_name), None)
+    if not protagonist_info:
+        logger.error("Protagonist not found: %s", protagonist_name)
+        return jsonify({"error": "Protagonist not found"}), 400
+
+    image_profile = image_profile_option()
+    if image_profile is None:
+        return jsonify({"error": "Unknown image profile"}), 400
+
+    app_services = services()
+    trace = metrics.start_trace(request.headers.get('X-Request-ID'))
+    fused = flag_option('fused')
+    speculative = flag_option('speculative')
+    progressive = flag_option('progressive')
+    if progressive is None:
+        progressive = app_services.progressive_images
+    coalesce = coalesce_options()
+    events = queue.Queue()
+    done = object()
+    consumer = Consumer(app_services.prediction_deadline)
+
+    def on_result(name, value):
+        if value is None:
+            # A draft that failed; the final image follows all the same
+            return
+        for event, extract in STREAM_EVENTS.get(name, []):
+            events.put({"event": event, "data": extract(value)})
+
+    def on_story_text(text):
+        events.put({"event": "story_delta", "data": text})
+
+    def run():
+        started = time.perf_counter()
+        try:
+            with consuming(consumer):
+                results = app_services.story_generator.generate_all(
+                    protagonist_name, protagonist_info['Original Story'], protagonist_info['Author'], circumstance,
+                    on_result=on_result, on_story_text=on_story_text, fused=fused, speculative=speculative,
+                    image_profile=image_profile, progressive=progressive,
+                    on_finish=app_services.archiver(protagonist_name, circumstance), **coalesce)
+            events.put({"event": "done", "data": {"trace_id": trace.id, "usage": trace.to_dict()["usage"],
+                                                  "story_id": results.get("story_id")}})
+        except Exception as e:
+            logger.error("An error occurred in generate_story_stream: %s", e)
+            logger.error(traceback.format_exc())
+            events.put({"event": "error", "data": str(e)})
+        finally:
+            metrics.REQUEST_DURATION.observe(time.perf_counter() - started, route="/generate/stream")
+            events.put(done)
+
+    # Run in a copy of this context so the worker thread records into the trace
+    threading.Thread(target=contextvars.copy_context().run, args=(run,), daemon=True).start()
+
+    def stream():
+        # One JSON object per line, flushed as soon as each artifact exists
+        try:
+            while True:
+                event = events.get()
+                if event is done:
+                    return
+                yield json.dumps(event) + "\n"
+        finally:
+            # Runs when the client disconnects too, so its images are cancelled
+            consumer.abandon()
 
-@app.route('/static/<path:path>')
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/jobs', methods=['POST'])
+def create_job():
+    try:
+        circumstance = request.form['circumstance']
+        protagonist_name = request.form['protagonist']
+        job = services().job_manager.submit(protagonist_name, circumstance,
+                                            image_profile=request.form.get('image_profile'))
+        return jsonify({"job_id": job.id, "status": job.status}), 202
+    except QueueFullError as e:
+        logger.warning("Rejecting job: %s", e)
+        return jsonify({"error": str(e)}), 429, {'Retry-After': '30'}
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = services().job_manager.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = services().job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job.to_dict())
+
+@bp.route('/batch', methods=['POST'])
+def create_batch():
+    # Accepts {"items": [...]} or the same JSONL the batch.py CLI reads
+    try:
+        # ?image_profile= (or "image_profile" in the JSON body) applies to the whole batch
+        image_profile = request.args.get('image_profile')
+        if request.is_json:
+            body = request.get_json()
+            items = body['items']
+            image_profile = body.get('image_profile', image_profile)
+        else:
+            items = [json.loads(line) for line in request.get_data(as_text=True).splitlines() if line.strip()]
+        if not items:
+            return jsonify({"error": "Batch is empty"}), 400
+        batch_id = services().batch_manager.submit(items, image_profile=image_profile)
+        return jsonify({"batch_id": batch_id, "total": len(items)}), 202
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+@bp.route('/batch/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    batch = services().batch_manager.get(batch_id)
+    if batch is None:
+        return jsonify({"error": "Batch not found"}), 404
+    return jsonify(batch)
+
+@bp.route('/batch/<batch_id>/results', methods=['GET'])
+def get_batch_results(batch_id):
+    batch_manager = services().batch_manager
+    if batch_manager.get(batch_id) is None or not batch_manager.results_path(batch_id).exists():
+        return jsonify({"error": "Batch not found"}), 404
+    # Partial while the batch is still running: one line per finished item
+    return send_from_directory(batch_manager.output_dir.resolve(), f"{batch_id}.jsonl",
+                               mimetype='application/x-ndjson', max_age=0)
+
+@bp.route('/stories', methods=['GET'])
+def list_stories():
+    story_archive = services().story_archive
+    if story_archive is None:
+        return jsonify({"error": "Story archive is disabled"}), 404
+    # ?circumstance= lists earlier stories for exactly that circumstance
+    try:
+        return jsonify(story_archive.list(protagonist=request.args.get('protagonist'),
+                                          limit=int(request.args.get('limit', '20')),
+                                          cursor=request.args.get('cursor'),
+                                          circumstance=request.args.get('circumstance')))
+    except ValueError:
+        return jsonify({"error": "limit must be an integer and cursor one returned by /stories"}), 400
+
+@bp.route('/stories/search', methods=['GET'])
+def search_stories():
+    story_archive = services().story_archive
+    if story_archive is None:
+        return jsonify({"error": "Story archive is disabled"}), 404
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "Missing search query"}), 400
+    try:
+        limit = int(request.args.get('limit', '20'))
+        offset = int(request.args.get('offset', '0'))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    return jsonify(story_archive.search(query, limit=limit, offset=offset))
+
+@bp.route('/stories/<story_id>', methods=['GET'])
+def get_story(story_id):
+    story_archive = services().story_archive
+    story = story_archive.get(story_id) if story_archive is not None else None
+    if story is None:
+        return jsonify({"error": "Story not found"}), 404
+    # Archived stories never change, so permalinks can be cached
+    response = jsonify(story)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+@bp.route('/artifacts/<name>')
+def send_artifact(name):
+    artifact_store = services().artifact_store
+    path = artifact_store.resolve(name) if artifact_store is not None else None
+    if path is None:
+        return jsonify({"error": "Artifact not found"}), 404
+    # Content-addressed, so a name always means the same bytes
+    response = send_file(path, etag=name, conditional=True, max_age=31536000)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@bp.route('/replicate/webhook', methods=['POST'])
+def replicate_webhook():
+    payload = request.get_json(silent=True) or {}
+    if not services().prediction_manager.handle_webhook(request.args.get('token'), payload):
+        return jsonify({"error": "Unknown prediction"}), 404
+    return '', 204
+
+@bp.route('/predictions')
+def prediction_stats():
+    return jsonify(services().prediction_manager.stats())
+
+@bp.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/cache/stats')
+def cache_stats():
+    return jsonify(services().story_generator.profile_cache.stats())
+
+@bp.route('/cache/portraits/stats')
+def portrait_cache_stats():
+    portrait_cache = services().story_generator.portrait_cache
+    if portrait_cache is None:
+        return jsonify({"error": "Portrait cache is disabled"}), 404
+    return jsonify(portrait_cache.stats())
+
+@bp.route('/cache/similarity/stats')
+def similarity_cache_stats():
+    circumstance_cache = services().story_generator.circumstance_cache
+    if circumstance_cache is None:
+        return jsonify({"error": "Similarity cache is disabled"}), 404
+    return jsonify(circumstance_cache.stats())
+
+@bp.route('/static/<path:path>')
 def send_static(path):
     return send_from_directory('static', path)
 if __name__ == '__main__':
     try:
+        app = create_app()
         logger.info("Starting Flask application")
-        app.run(host='0.0.0.0', port=8080, debug=True)
+        # The debug reloader imports everything twice, so it is opt-in
+        app.run(host='0.0.0.0', port=8080, debug=os.environ.get("FLASK_DEBUG") == "1")
     except Exception as e:
-        logger.error(f"Failed to start Flask application: {str(e)}")
+        logger.error("Failed to start Flask application: %s", e)
         logger.error(traceback.format_exc())
         sys.exit(1)
-
-logger.info("End of main.py file reached")
\ No newline at end of file
@@ -0,0 +1,308 @@
+import bisect
+import contextvars
+import functools
+import inspect
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values, strict=True)) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped, strict=True)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts, strict=True):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else _format_value(bound)
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_DURATION = REGISTRY.register(Histogram(
+    "story_stage_duration_seconds", "Wall time of each generation stage", ["stage"]))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "story_stage_errors_total", "Generation stages that raised", ["stage"]))
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    "story_upstream_queue_wait_seconds", "Time spent waiting on the rate limiter before an upstream call",
+    ["stage", "provider"], buckets=(0.0, 0.01, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)))
+UPSTREAM_DURATION = REGISTRY.register(Histogram(
+    "story_upstream_duration_seconds", "Time inside the upstream call, e.g. Replicate prediction time",
+    ["stage", "provider"]))
+RETRIES = REGISTRY.register(Counter(
+    "story_upstream_retries_total", "Upstream calls retried by the scheduler", ["stage", "provider"]))
+TOKENS = REGISTRY.register(Counter(
+    "story_tokens_total", "Anthropic tokens reported in response usage; direction is input, output, "
+    "cache_write or cache_read", ["stage", "direction"]))
+FUSED_RESULTS = REGISTRY.register(Counter(
+    "story_fused_results_total", "Fused story generations that validated (ok) or fell back to separate calls",
+    ["result"]))
+CACHE_REQUESTS = REGISTRY.register(Counter(
+    "story_cache_requests_total", "Cache lookups", ["cache", "result"]))
+CACHE_EVICTIONS = REGISTRY.register(Counter(
+    "story_cache_evictions_total", "Entries evicted to make room in a cache", ["cache"]))
+SIMILARITY_SCORE = REGISTRY.register(Histogram(
+    "story_similarity_score", "Best cosine similarity found by similarity cache lookups", ["cache"],
+    buckets=(0.5, 0.6, 0.7, 0.75, 0.8, 0.85, 0.9, 0.95, 0.99, 1.0)))
+SPECULATIVE_COMICS = REGISTRY.register(Counter(
+    "story_speculative_comics_total", "Comics rendered from the situation setup that were kept, re-rendered "
+    "from the story, or used unchecked", ["result"]))
+SPECULATIVE_SIMILARITY = REGISTRY.register(Histogram(
+    "story_speculative_similarity", "Cosine similarity between a speculative comic's summary and the story's "
+    "visual summary", buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)))
+PREDICTIONS = REGISTRY.register(Counter(
+    "story_predictions_total", "Replicate predictions by final status and how it was learned "
+    "(webhook, poll, create or cancel)", ["status", "via"]))
+PREDICTIONS_SHARED = REGISTRY.register(Counter(
+    "story_predictions_shared_total", "Image requests that joined an identical in-flight prediction"))
+PREDICTIONS_ABANDONED = REGISTRY.register(Counter(
+    "story_predictions_abandoned_total", "Predictions cancelled because their last consumer left (gone) "
+    "or ran out of time (deadline)", ["reason"]))
+COALESCED = REGISTRY.register(Counter(
+    "story_coalesced_total", "Calls that used the result of an identical in-flight call instead of making "
+    "their own; scope is node or cluster", ["key", "scope"]))
+IMAGE_DURATION = REGISTRY.register(Histogram(
+    "story_image_duration_seconds", "Time to render one image, by image profile, role and model",
+    ["profile", "role", "model"]))
+IMAGE_COST = REGISTRY.register(Counter(
+    "story_image_cost_dollars_total", "Estimated Replicate spend on rendered images, at list price",
+    ["profile", "role"]))
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "story_request_duration_seconds", "End-to-end duration of HTTP generation requests", ["route"]))
+
+
+class StageSpan:
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.started_at = time.time()
+        self.duration = None
+        self.queue_wait = 0.0
+        self.upstream_seconds = 0.0
+        self.retries = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_write_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache = None
+        self.image_profile = None
+        self.image_cost = None
+        self.error = None
+
+    def to_dict(self):
+        return {name: value for name, value in vars(self).items() if value is not None}
+
+
+class Trace:
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id or uuid.uuid4().hex
+        self.spans = []
+        self.lock = threading.Lock()
+        # Set when the spans came from another caller's identical request
+        self.coalesced_from = None
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def merge(self, other, coalesced=False):
+        """Add the spans of `other`, e.g. a shared run made on this trace's
+        behalf. With `coalesced`, the work was started by another caller."""
+        with other.lock:
+            spans = list(other.spans)
+        with self.lock:
+            self.spans.extend(spans)
+            if coalesced:
+                self.coalesced_from = other.id
+
+    def to_dict(self):
+        with self.lock:
+            spans = list(self.spans)
+        usage = {kind: sum(getattr(span, kind) for span in spans)
+                 for kind in ("input_tokens", "output_tokens", "cache_write_tokens", "cache_read_tokens")}
+        usage["image_cost"] = round(sum(span.image_cost or 0.0 for span in spans), 6)
+        result = {"trace_id": self.id, "usage": usage, "stages": [span.to_dict() for span in spans]}
+        if self.coalesced_from is not None:
+            result["coalesced_from"] = self.coalesced_from
+        return result
+
+
+# Context variables follow each stage into pipeline threads and asyncio
+# tasks, so the scheduler can attribute its numbers to the right stage
+_current_trace = contextvars.ContextVar("story_trace", default=None)
+_current_span = contextvars.ContextVar("story_stage", default=None)
+
+
+def start_trace(trace_id=None):
+    trace = Trace(trace_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def set_trace(trace):
+    _current_trace.set(trace)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def stage(name):
+    span = StageSpan(name)
+    token = _current_span.set(span)
+    start = time.perf_counter()
+    try:
+        yield span
+    except Exception as e:
+        span.error = str(e)
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        span.duration = time.perf_counter() - start
+        _current_span.reset(token)
+        STAGE_DURATION.observe(span.duration, stage=name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(span)
+
+
+def instrumented(name):
+    """Decorator that runs a (sync or async) method inside `stage(name)`."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with stage(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_upstream(provider, queue_wait, upstream_seconds, retries, usage=None):
+    span = _current_span.get()
+    stage_name = span.stage if span else "none"
+    QUEUE_WAIT.observe(queue_wait, stage=stage_name, provider=provider)
+    UPSTREAM_DURATION.observe(upstream_seconds, stage=stage_name, provider=provider)
+    if retries:
+        RETRIES.inc(retries, stage=stage_name, provider=provider)
+    input_tokens = getattr(usage, "input_tokens", None) or 0
+    output_tokens = getattr(usage, "output_tokens", None) or 0
+    cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+    cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+    for direction, tokens in (("input", input_tokens), ("output", output_tokens),
+                              ("cache_write", cache_write_tokens), ("cache_read", cache_read_tokens)):
+        if tokens:
+            TOKENS.inc(tokens, stage=stage_name, direction=direction)
+    if span is not None:
+        span.queue_wait += queue_wait
+        span.upstream_seconds += upstream_seconds
+        span.retries += retries
+        span.input_tokens += input_tokens
+        span.output_tokens += output_tokens
+        span.cache_write_tokens += cache_write_tokens
+        span.cache_read_tokens += cache_read_tokens
+
+
+def record_image(profile, role, model, seconds, cost):
+    IMAGE_DURATION.observe(seconds, profile=profile, role=role, model=model)
+    IMAGE_COST.inc(cost, profile=profile, role=role)
+    span = _current_span.get()
+    if span is not None:
+        span.image_profile = profile
+        span.image_cost = (span.image_cost or 0.0) + cost
+
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+    span = _current_span.get()
+    if span is not None:
+        span.cache = "hit" if hit else "miss"
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,158 @@
+import asyncio
+import contextvars
+import logging
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class PipelineStep:
+
+    def __init__(self, name, func, deps=()):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+
+
+class Pipeline:
+    """Runs a set of named steps as a dependency graph.
+
+    Each step is called with the results of its dependencies as keyword
+    arguments and is submitted to the thread pool as soon as all of them
+    are available.
+    """
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        self.steps = {}
+
+    def add_step(self, name, func, deps=()):
+        if name in self.steps:
+            raise ValueError(f"Duplicate pipeline step: {name}")
+        self.steps[name] = PipelineStep(name, func, deps)
+        return self
+
+    def _validate(self, available):
+        for step in self.steps.values():
+            for dep in step.deps:
+                if dep not in self.steps and dep not in available:
+                    raise ValueError(f"Step '{step.name}' depends on unknown step '{dep}'")
+
+        # Kahn's algorithm, only to detect cycles before anything is submitted
+        remaining = {name: set(step.deps) - set(available) for name, step in self.steps.items() if name not in available}
+        while remaining:
+            ready = [name for name, deps in remaining.items() if not deps]
+            if not ready:
+                raise ValueError(f"Pipeline has a dependency cycle between: {', '.join(sorted(remaining))}")
+            for name in ready:
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+
+    def run(self, inputs=None, outputs=None, on_result=None, on_start=None):
+        """Run the graph and return a dict of step name -> result.
+
+        Values in `inputs` are treated as already-finished steps, so a step
+        with the same name is skipped. If `outputs` is given, only the steps
+        needed to produce those names are run. `on_start(name)` and
+        `on_result(name, value)` are called as each step is submitted and
+        as it finishes.
+        """
+        results = dict(inputs or {})
+        self._validate(results)
+
+        pending = self._required_steps(outputs, results)
+        if not pending:
+            return results
+
+        running = {}
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while pending or running:
+                for name in list(pending):
+                    step = self.steps[name]
+                    if all(dep in results for dep in step.deps):
+                        kwargs = {dep: results[dep] for dep in step.deps}
+                        logger.debug("Starting pipeline step: %s", name)
+                        if on_start is not None:
+                            on_start(name)
+                        # Each step runs in a copy of the caller's context, so
+                        # context variables (e.g. the request trace) follow it
+                        context = contextvars.copy_context()
+                        running[executor.submit(context.run, step.func, **kwargs)] = name
+                        pending.discard(name)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name] = future.result()
+                    logger.debug("Finished pipeline step: %s", name)
+                    if on_result is not None:
+                        on_result(name, results[name])
+        except Exception as e:
+            # Running steps can't be interrupted, but the error isn't held
+            # back until they finish; they wind down in the background
+            executor.shutdown(wait=False, cancel_futures=True)
+            logger.error("Pipeline step failed: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+        executor.shutdown()
+
+        return results
+
+    def _required_steps(self, outputs, available):
+        if outputs is None:
+            return {name for name in self.steps if name not in available}
+
+        required = set()
+        stack = [name for name in outputs if name not in available]
+        while stack:
+            name = stack.pop()
+            if name in required:
+                continue
+            if name not in self.steps:
+                raise ValueError(f"Unknown pipeline output: {name}")
+            required.add(name)
+            stack.extend(dep for dep in self.steps[name].deps if dep not in available)
+        return required
+
+
+class AsyncPipeline(Pipeline):
+    """Pipeline whose steps are coroutine functions, run as asyncio tasks."""
+
+    async def run(self, inputs=None, outputs=None, on_result=None, on_start=None):
+        results = dict(inputs or {})
+        self._validate(results)
+
+        pending = self._required_steps(outputs, results)
+        running = {}
+        try:
+            while pending or running:
+                for name in list(pending):
+                    step = self.steps[name]
+                    if all(dep in results for dep in step.deps):
+                        kwargs = {dep: results[dep] for dep in step.deps}
+                        logger.debug("Starting pipeline step: %s", name)
+                        if on_start is not None:
+                            on_start(name)
+                        running[asyncio.ensure_future(step.func(**kwargs))] = name
+                        pending.discard(name)
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    name = running.pop(task)
+                    results[name] = task.result()
+                    logger.debug("Finished pipeline step: %s", name)
+                    if on_result is not None:
+                        on_result(name, results[name])
+        except BaseException as e:
+            # Unlike threads, tasks can actually be stopped mid-flight
+            for task in running:
+                task.cancel()
+            if not isinstance(e, asyncio.CancelledError):
+                logger.error("Pipeline step failed: %s", e)
+                logger.error(traceback.format_exc())
+            raise
+
+        return results
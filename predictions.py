@@ -0,0 +1,350 @@
+import asyncio
+import contextvars
+import logging
+import secrets
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import metrics
+from cache import make_cache_key
+
+logger = logging.getLogger(__name__)
+
+TERMINAL = ("succeeded", "failed", "canceled")
+
+
+class PredictionFailed(Exception):
+    pass
+
+
+class PredictionCancelled(Exception):
+    pass
+
+
+class PredictionDeadlineExceeded(Exception):
+    pass
+
+
+class Consumer:
+    """Whoever is waiting on a request's images. Every prediction the
+    request waits on shares its deadline, and `abandon()` (client gone,
+    job cancelled, request finished) releases them all at once."""
+
+    def __init__(self, timeout=None):
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.gone = threading.Event()
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def abandon(self):
+        self.gone.set()
+
+
+# Like the metrics trace, the consumer follows the request into pipeline
+# threads and asyncio tasks
+_current_consumer = contextvars.ContextVar("prediction_consumer", default=None)
+
+
+@contextmanager
+def consuming(consumer):
+    token = _current_consumer.set(consumer)
+    try:
+        yield consumer
+    finally:
+        consumer.abandon()
+        _current_consumer.reset(token)
+
+
+def current_consumer():
+    return _current_consumer.get()
+
+
+class TrackedPrediction:
+
+    def __init__(self, key, model, input):
+        self.key = key
+        self.model = model
+        self.input = input
+        self.id = None
+        self.token = secrets.token_urlsafe(16)
+        self.status = "starting"
+        self.output = None
+        self.error = None
+        self.consumers = 0
+        self.cancel_requested = False
+        self.created_at = time.time()
+        self.next_poll = 0.0
+        # A status request or cancel for it is on the poller pool
+        self.busy = False
+        self.done = threading.Event()
+        self.callbacks = []
+
+    def result(self):
+        if self.status == "succeeded":
+            return self.output
+        if self.status == "canceled":
+            raise PredictionCancelled(f"Prediction {self.id} was cancelled")
+        if isinstance(self.error, Exception):
+            raise self.error
+        raise PredictionFailed(f"Prediction {self.id} failed: {self.error}")
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "model": self.model,
+            "status": self.status,
+            "consumers": self.consumers,
+            "created_at": self.created_at,
+        }
+
+
+class PredictionManager:
+    """Owns every Replicate prediction the app starts.
+
+    Predictions are created without blocking and kept in a registry until
+    they finish. Completion normally arrives at the webhook receiver
+    (`handle_webhook`); a watcher thread polls as a fallback, every
+    `poll_interval` seconds without a webhook and every
+    `webhook_poll_interval` with one. Identical model and input share one
+    in-flight prediction, and a prediction is cancelled upstream once its
+    last consumer has gone or run out of time. Callers without a deadline
+    of their own give up after `max_wait` seconds.
+
+    The watcher hands its status requests and cancels to a pool of
+    `poll_workers` threads, so one slow request doesn't hold up the rest;
+    the client it creates itself also times out each request after
+    `request_timeout` seconds.
+    """
+
+    def __init__(self, client=None, webhook_url=None, poll_interval=1.0, webhook_poll_interval=10.0, tick=0.25,
+                 max_wait=600.0, poll_workers=8, request_timeout=10.0):
+        self._client = client
+        self.webhook_url = webhook_url
+        self.poll_interval = webhook_poll_interval if webhook_url else poll_interval
+        self.tick = tick
+        self.max_wait = max_wait
+        self.request_timeout = request_timeout
+        self.pollers = ThreadPoolExecutor(max_workers=poll_workers, thread_name_prefix="prediction-poll")
+        self.predictions = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.watcher = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self.lock:
+                if self._client is None:
+                    # Imported on first use; the replicate package is slow to load
+                    import httpx
+                    import replicate
+                    self._client = replicate.Client(timeout=httpx.Timeout(self.request_timeout))
+        return self._client
+
+    def warm(self):
+        try:
+            self.client.predictions.list()
+        except Exception as e:
+            logger.debug("Replicate warm-up request: %s", e)
+
+    def _ensure_watcher(self):
+        with self.lock:
+            if self.watcher is None:
+                self.watcher = threading.Thread(target=self._watch, name="prediction-watcher", daemon=True)
+                self.watcher.start()
+
+    def acquire(self, model, input):
+        key = make_cache_key(model, input)
+        with self.lock:
+            prediction = self.in_flight.get(key)
+            if prediction is not None:
+                prediction.consumers += 1
+                metrics.PREDICTIONS_SHARED.inc()
+                logger.info("Joining in-flight prediction %s (%s consumers)", prediction.id, prediction.consumers)
+                return prediction
+            prediction = self.in_flight[key] = TrackedPrediction(key, model, input)
+            prediction.consumers = 1
+        self._ensure_watcher()
+
+        params = {}
+        if self.webhook_url:
+            params = {"webhook": f"{self.webhook_url}?token={prediction.token}", "webhook_events_filter": ["completed"]}
+        try:
+            created = self.client.predictions.create(model=model, input=input, **params)
+        except Exception as e:
+            self._complete(prediction, "failed", error=e)
+            raise
+        with self.lock:
+            prediction.id = created.id
+            prediction.next_poll = time.monotonic() + self.poll_interval
+            self.predictions[created.id] = prediction
+        logger.info("Created prediction %s for %s", created.id, model)
+        if created.status in TERMINAL:
+            self._complete(prediction, created.status, created.output, created.error, via="create")
+        return prediction
+
+    def release(self, prediction, reason=None):
+        with self.lock:
+            prediction.consumers -= 1
+            orphaned = prediction.consumers == 0 and not prediction.done.is_set()
+            if orphaned:
+                # Nobody new may join a prediction that is being cancelled
+                prediction.cancel_requested = True
+                if self.in_flight.get(prediction.key) is prediction:
+                    del self.in_flight[prediction.key]
+        if orphaned:
+            metrics.PREDICTIONS_ABANDONED.inc(reason=reason or "gone")
+            logger.info("Cancelling prediction %s, its last consumer is %s", prediction.id, reason or 'gone')
+            self.wakeup.set()
+
+    def _waiter(self, consumer):
+        # Checked on every tick while a caller waits: the reason to give
+        # up, if there is one
+        give_up_at = time.monotonic() + self.max_wait if self.max_wait else None
+
+        def check():
+            if consumer is not None and consumer.gone.is_set():
+                return "gone"
+            remaining = consumer.remaining() if consumer is not None else None
+            if remaining is None and give_up_at is not None:
+                remaining = give_up_at - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return "deadline"
+            return None
+        return check
+
+    def _abandoned(self, prediction, reason):
+        if reason == "gone":
+            return PredictionCancelled(f"Consumer of prediction {prediction.id} is gone")
+        return PredictionDeadlineExceeded(f"Prediction {prediction.id} missed its deadline")
+
+    def run(self, model, input, consumer=None):
+        """Blocking equivalent of replicate.run for the current consumer."""
+        consumer = consumer or current_consumer()
+        check = self._waiter(consumer)
+        prediction = self.acquire(model, input)
+        reason = None
+        try:
+            while not prediction.done.wait(self.tick):
+                reason = check()
+                if reason is not None:
+                    raise self._abandoned(prediction, reason)
+            return prediction.result()
+        finally:
+            self.release(prediction, reason)
+
+    async def arun(self, model, input, consumer=None):
+        """Coroutine version of `run`; cancelling the task releases the
+        prediction like a consumer that has gone."""
+        consumer = consumer or current_consumer()
+        loop = asyncio.get_running_loop()
+        prediction = await asyncio.to_thread(self.acquire, model, input)
+        finished = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: finished.done() or finished.set_result(None))
+
+        with self.lock:
+            if prediction.done.is_set():
+                finished.set_result(None)
+            else:
+                prediction.callbacks.append(notify)
+        check = self._waiter(consumer)
+        reason = "gone"
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(asyncio.shield(finished), self.tick)
+                    break
+                except asyncio.TimeoutError as e:
+                    abandoned = check()
+                    if abandoned is not None:
+                        reason = abandoned
+                        raise self._abandoned(prediction, reason) from e
+            reason = None
+            return prediction.result()
+        finally:
+            self.release(prediction, reason)
+
+    def handle_webhook(self, token, payload):
+        """Apply a webhook delivery; False if it doesn't match a prediction
+        we are waiting on."""
+        with self.lock:
+            prediction = self.predictions.get(payload.get("id"))
+        if prediction is None or not secrets.compare_digest(token or "", prediction.token):
+            return False
+        if payload.get("status") in TERMINAL:
+            self._complete(prediction, payload["status"], payload.get("output"), payload.get("error"), via="webhook")
+        return True
+
+    def _complete(self, prediction, status, output=None, error=None, via="poll"):
+        with self.lock:
+            if prediction.done.is_set():
+                return
+            prediction.status = status
+            prediction.output = output
+            prediction.error = error
+            if self.in_flight.get(prediction.key) is prediction:
+                del self.in_flight[prediction.key]
+            self.predictions.pop(prediction.id, None)
+            callbacks, prediction.callbacks = prediction.callbacks, []
+            prediction.done.set()
+        metrics.PREDICTIONS.inc(status=status, via=via)
+        logger.info("Prediction %s %s (via %s)", prediction.id, status, via)
+        for callback in callbacks:
+            callback()
+
+    def _watch(self):
+        while True:
+            self.wakeup.wait(self.tick)
+            self.wakeup.clear()
+            with self.lock:
+                pending = [p for p in self.predictions.values() if not p.done.is_set()]
+            now = time.monotonic()
+            for prediction in pending:
+                with self.lock:
+                    if prediction.busy:
+                        continue
+                    if prediction.cancel_requested:
+                        task = self._cancel
+                    elif now >= prediction.next_poll:
+                        prediction.next_poll = now + self.poll_interval
+                        task = self._poll
+                    else:
+                        continue
+                    prediction.busy = True
+                self.pollers.submit(task, prediction)
+
+    def _poll(self, prediction):
+        try:
+            current = self.client.predictions.get(prediction.id)
+            if current.status in TERMINAL:
+                self._complete(prediction, current.status, current.output, current.error)
+        except Exception as e:
+            logger.error("Error in prediction watcher for %s: %s", prediction.id, e)
+            logger.error(traceback.format_exc())
+        finally:
+            prediction.busy = False
+            if prediction.cancel_requested:
+                # Released while its status was being fetched
+                self.wakeup.set()
+
+    def _cancel(self, prediction):
+        # Nobody is waiting any more, so it leaves the registry even if the
+        # cancel call fails; at worst Replicate finishes it for nothing
+        try:
+            self.client.predictions.cancel(prediction.id)
+        except Exception as e:
+            logger.warning("Cancelling prediction %s failed: %s", prediction.id, e)
+        self._complete(prediction, "canceled", via="cancel")
+        prediction.busy = False
+
+    def stats(self):
+        with self.lock:
+            predictions = [prediction.to_dict() for prediction in self.predictions.values()]
+        return {"in_flight": len(predictions), "predictions": predictions}
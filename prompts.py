@@ -0,0 +1,355 @@
+# Prompt builders and response parsing shared by StoryGenerator and
+# AsyncStoryGenerator, so both send exactly the same requests.
+
+CLAUDE_MODEL = "claude-3-5-sonnet-20240620"
+
+
+def char_style_prompt(protagonist_name, original_story, author):
+    return f"""Create a detailed character profile for a modern adaptation of {protagonist_name}, originally from {original_story} by {author}. Focus on the core essence of the character without directly referencing their original story, specific plot elements, or other characters from that story. Adapt their traits to a contemporary, relatable context:
+
+            1. Character Essence:
+               a) Core personality traits (list 3-5 key traits)
+               b) Fundamental motivations and values
+               c) Typical responses to challenges or setbacks
+               d) Communication style and social tendencies
+               e) Notable quirks or habits
+               f) Basic physical characteristics (age range, build, general appearance)
+
+            2. Inner Strength and Growth:
+               a) Sources of the character's inner strength
+               b) Areas where the character might struggle or feel unsure
+               c) How the character typically handles being underestimated by others
+               d) The character's unique approach to overcoming obstacles
+               e) Past experiences that have shaped the character's resilience
+
+            3. Modern Context:
+               a) Potential contemporary profession or lifestyle
+               b) How their core traits might manifest in today's world
+               c) Types of modern-day challenges they might face
+               d) Their relationship with technology and social media
+
+            4. First-Person Narration Voice:
+               a) Distinctive speech patterns or expressions (without using catchphrases from the original story)
+               b) Level of self-awareness as a narrator
+               c) Tendency towards introspection or external observation
+               d) Use of humor, sarcasm, or other stylistic elements
+               e) How their background and experiences influence their narration style
+               f) Examples of how they might describe feelings of uncertainty or determination
+
+            5. Writing Style Guidance:
+               a) Tone and mood that best suits the character (e.g., introspective, humorous, determined)
+               b) Pacing and rhythm of storytelling that matches the character's personality
+               c) Balance of dialogue, action, and internal monologue
+               d) Descriptive techniques that align with the character's perspective
+               e) Literary devices that would effectively convey the character's journey of personal growth
+
+            Ensure all descriptions are applicable to a realistic, modern-day setting and provide specific examples where possible. Focus on creating a unique and consistent character voice that captures the essence of {protagonist_name} without relying on specific elements from their original story, emphasizing their journey of personal growth and resilience."""
+
+
+# Shared by the multi-call prompts and the fused prompt
+STORY_GUIDELINES = """1. Write the story in a "cinematic first-person" viewpoint, using "I" as the narrator (the protagonist).
+            2. Use present tense to create a sense of immediacy.
+            3. Incorporate the specific first-person narration voice and writing style details provided in the character profile.
+            4. Create a compelling narrative arc focused on the protagonist's personal growth within the context of the given situation.
+            5. Establish the main conflict as an internal or external challenge that tests the protagonist's beliefs or capabilities.
+            6. Subtly showcase the protagonist's unique strengths and how they apply them to face the challenge.
+            7. Illustrate the character's internal struggle and growth through their actions, thoughts, and interactions.
+            8. Incorporate dialogue that reflects the character's unique voice and subtly reveals how others perceive them.
+            9. Explore the protagonist's inner thoughts and emotions as they navigate the challenges, without explicitly labeling their feelings.
+            10. Conclude with a satisfying resolution where the protagonist overcomes the challenge in a way that aligns with their core personality traits.
+            11. Ensure the story feels contemporary and relatable, avoiding any direct references to the character's original story or universe.
+            12. Focus on vivid descriptions of the setting and the protagonist's emotional state, as this will be used for image generation."""
+
+SNIPPET_GUIDELINES = """1. Start with a powerful, attention-grabbing sentence that introduces the protagonist's dilemma or the story's central conflict.
+            2. Use vivid, sensory language to quickly immerse the listener in the scene.
+            3. Maintain a cinematic first-person perspective, incorporating the character's unique voice.
+            4. Focus on a pivotal moment or decision that encapsulates the protagonist's journey.
+            5. Use short, punchy sentences interspersed with occasional longer ones for rhythm.
+            6. Incorporate one or two lines of impactful dialogue if relevant.
+            7. End with a compelling cliffhanger or thought-provoking statement that leaves the listener wanting more.
+            8. Aim for approximately 150-175 words to fit a ~1-minute read-aloud format.
+            9. Ensure the snippet feels complete enough to be satisfying, yet open-ended enough to intrigue.
+            10. Subtly showcase the protagonist's growth or internal struggle without explicitly stating it.
+            11. Use active voice and strong verbs to maintain a sense of immediacy and urgency.
+            12. Avoid any direct references to the character's original story or universe."""
+
+
+VISUAL_SUMMARY_FORMAT = """VISUAL SUMMARY:
+            - Setting: [Describe the main setting or settings]
+            - Protagonist: [Describe the protagonist's appearance and most notable visual characteristics]
+            - Key Object: [Describe an important object or symbol in the story that represents the character's struggle or growth]
+            - Action: [Describe a key action or scene that encapsulates the protagonist's moment of triumph or realization]
+            - Mood: [Describe the overall visual mood or atmosphere of the story, reflecting the character's emotional journey]"""
+
+# Everything the situation, story and snippet requests share apart from the
+# character: the story and snippet guidelines, moved out of the prompts
+# unchanged. It must stay byte-for-byte the same between requests, since it
+# is the first cached system block.
+STYLE_GUIDE = f"""Guidelines for the short story:
+            {STORY_GUIDELINES}
+
+            After writing the story, provide a brief summary of key visual elements in the following format:
+
+            {VISUAL_SUMMARY_FORMAT}
+
+            Ensure this visual summary captures the most striking and important visual aspects of your story, emphasizing the character's emotional journey without explicitly mentioning concepts like doubt or confidence.
+
+            Guidelines for the 1-minute read-aloud snippet, which should hook listeners scrolling through social media and compel them to stop and listen to the entire piece:
+            {SNIPPET_GUIDELINES}"""
+
+
+def character_system(char_style_info):
+    # The guide and the profile are the largest part of the situation, story
+    # and snippet requests. Sent as the same system blocks each time and
+    # marked for prompt caching, they are only billed in full by the first
+    # of them. The guide is just under Anthropic's 1024-token minimum on its
+    # own, so it is cached together with the profile rather than separately.
+    return [
+        {
+            "type": "text",
+            "text": STYLE_GUIDE,
+        },
+        {
+            "type": "text",
+            "text": f"Character Profile and Style:\n{char_style_info}",
+            "cache_control": {"type": "ephemeral"},
+        },
+    ]
+
+
+def situation_prompt(circumstance):
+    return f"""Create a vivid and detailed scenario for a 6-panel manga-style comic where a young adult with the traits from the character profile faces this circumstance in a modern Western city: {circumstance}
+
+            Provide:
+            1. Setting: Describe the specific location and time of day. What visual elements would be prominent?
+            2. Inciting Incident: What exactly happens to bring the character into this circumstance?
+            3. Character's Initial Reaction: How does the character physically and emotionally respond?
+            4. Immediate Conflict: What obstacle or dilemma does the character face right away?
+            5. Supporting Characters: Introduce 1-2 other characters who might be involved. How do they look and act?
+            6. Potential for Drama: What elements of this scenario could lead to interesting visual storytelling?
+
+            Important: When describing the character's actions and appearance, avoid mentioning their facial features or expressions. Instead, focus on body language, gestures, and other visual cues to convey emotions and reactions.
+
+            Describe the scenario in about 150 words, focusing on vivid, visual details and emotionally charged moments that would translate well to a comic format."""
+
+
+def story_prompt(situation_setup):
+    return f"""Write a high-quality short story of approximately 500 words based on the character profile and the following details:
+
+            Situation: {situation_setup}
+
+            Follow the guidelines for the short story, and end with the visual summary in the format given there."""
+
+
+def snippet_prompt(original_story, visual_summary):
+    return f"""Create a captivating 1-minute read-aloud snippet based on the character profile and the following story and visual summary. This snippet should hook listeners scrolling through social media, compelling them to stop and listen to the entire piece.
+
+            Original Story:
+            {original_story}
+
+            Visual Summary:
+            {visual_summary}
+
+            Follow the guidelines for the 1-minute read-aloud snippet. Create a gripping, fast-paced snippet that captures the essence of the story and character, designed to be irresistible when heard as a voice-over on social media."""
+
+
+VISUAL_SUMMARY_FIELDS = [
+    ("setting", "Setting", "The main setting or settings"),
+    ("protagonist", "Protagonist", "The protagonist's appearance and most notable visual characteristics"),
+    ("key_object", "Key Object", "An important object or symbol in the story that represents the character's struggle or growth"),
+    ("action", "Action", "A key action or scene that encapsulates the protagonist's moment of triumph or realization"),
+    ("mood", "Mood", "The overall visual mood or atmosphere of the story, reflecting the character's emotional journey"),
+]
+
+STORY_TOOL = {
+    "name": "submit_story",
+    "description": "Submit the finished short story, its visual summary and the 1-minute read-aloud snippet.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "story": {"type": "string", "description": "The full short story, without the visual summary"},
+            "visual_summary": {
+                "type": "object",
+                "properties": {key: {"type": "string", "description": description}
+                               for key, _, description in VISUAL_SUMMARY_FIELDS},
+                "required": [key for key, _, _ in VISUAL_SUMMARY_FIELDS],
+            },
+            "snippet": {"type": "string", "description": "The 1-minute read-aloud snippet"},
+        },
+        "required": ["story", "visual_summary", "snippet"],
+    },
+}
+
+
+def fused_story_prompt(situation_setup):
+    return f"""Write a high-quality short story of approximately 500 words based on the character profile and the following details, then a summary of its key visual elements and a 1-minute read-aloud snippet of it. Submit all three with the submit_story tool.
+
+            Situation: {situation_setup}
+
+            Follow the guidelines for the short story, the visual summary and the 1-minute read-aloud snippet. The story goes in the tool call without its visual summary, which has fields of its own."""
+
+
+def comic_prompt(visual_summary):
+    return f"""Create a single, family-friendly manga-style image image in the style of Tsutomu Nihei, inspired by this story concept and visual summary:
+
+            {visual_summary}
+
+            Image Specifications:
+            1. Style: Black and white manga art style inspired by Tsutomu Nihei's work, known for:
+               - Intricate, highly detailed architectural and mechanical designs
+               - Vast, often dystopian or post-apocalyptic settings
+               - Stark contrast between black and white elements
+               - Complex, biomechanical aesthetics
+            2. Composition: A single, full-page image that captures the essence of the story
+            3. Character Design: Create a protagonist based on the description, fitting Nihei's style:
+               - Intricate, often utilitarian or biomechanical outfits
+               - Stoic or intense expressions
+               - Integration with the surrounding environment
+            4. Setting: Develop a detailed, immersive background that reflects the story's setting:
+               - Vast, labyrinthine structures or cityscapes
+               - Blend of organic and mechanical elements
+               - Use of perspective to create a sense of scale and depth
+            5. Visual Storytelling: 
+               - Incorporate the key object and action described in the visual summary
+               - Use visual metaphors or symbolic elements to convey the story's essence
+               - Create a sense of action or tension through character positioning and environmental details
+            6. Lighting and Texture:
+               - Employ strong contrasts between light and shadow
+               - Use intricate textures and patterns to add depth and detail
+               - Create a mood that reflects the story's described atmosphere
+            7. NO TEXT: Do not include any speech bubbles, captions, or written elements of any kind.
+
+            Generate a single, highly detailed image that captures the essence of the story in Tsutomu Nihei's distinctive style, while accurately representing the specific elements described in the visual summary."""
+
+
+def character_image_prompts(key_traits):
+    # Base prompt template
+    base_prompt = """Create a tasteful, family-friendly manga-style image inspired by the art of Tsutomu Nihei. The image should be black and white, featuring a character with the following traits: {traits}
+
+            Image Specifications:
+            1. Black and white manga art style
+            2. Intricate details in clothing and background
+            3. Strong use of light and shadow
+            4. Minimal abstract background
+            5. Suitable for all audiences
+
+            The character should appear contemplative and determined, avoiding any aggressive or controversial poses or expressions."""
+
+    side_profile_prompt = base_prompt.format(traits=key_traits) + """
+            Additional details:
+            - Detailed side view of the character's face and upper body
+            - Character looking thoughtfully to the side
+
+            Generate a single, highly detailed side profile image in a respectful and artistic style."""
+
+    headshot_prompt = base_prompt.format(traits=key_traits) + """
+            Additional details:
+            - Close-up, front-facing view of the character's face and upper shoulders
+            - Character with a calm, focused expression
+
+            Generate a single, highly detailed headshot image in a respectful and artistic style."""
+
+    return side_profile_prompt, headshot_prompt
+
+
+def split_story(full_story):
+    # Split the story and visual summary
+    story_parts = full_story.split("VISUAL SUMMARY:")
+    original_story = story_parts[0].strip()
+    visual_summary = "VISUAL SUMMARY:" + story_parts[1].strip() if len(story_parts) > 1 else ""
+    return original_story, visual_summary
+
+
+class VisualSummary:
+
+    def __init__(self, setting, protagonist, key_object, action, mood):
+        self.setting = setting
+        self.protagonist = protagonist
+        self.key_object = key_object
+        self.action = action
+        self.mood = mood
+
+    def to_text(self):
+        # Same layout the multi-call story prompt asks for, so the comic
+        # prompt and API responses look alike whichever path produced them
+        return "VISUAL SUMMARY:\n" + "\n".join(
+            f"- {label}: {getattr(self, key)}" for key, label, _ in VISUAL_SUMMARY_FIELDS)
+
+
+class StoryResult:
+    """Story, visual summary and snippet produced by one generation."""
+
+    def __init__(self, story, visual_summary, snippet):
+        self.story = story
+        self.visual_summary = visual_summary
+        self.snippet = snippet
+
+    @property
+    def visual_summary_text(self):
+        if isinstance(self.visual_summary, VisualSummary):
+            return self.visual_summary.to_text()
+        return self.visual_summary
+
+    @property
+    def story_parts(self):
+        # (story, visual summary) as returned by split_story
+        return self.story, self.visual_summary_text
+
+    @classmethod
+    def from_tool_input(cls, tool_input):
+        """Validate a submit_story tool call against STORY_TOOL's schema.
+
+        Raises ValueError when a field is missing, empty or not a string,
+        e.g. because the response was cut off at max_tokens.
+        """
+        def text(value, name):
+            if not isinstance(value, str) or not value.strip():
+                raise ValueError(f"submit_story field {name} is missing or empty")
+            return value.strip()
+
+        if not isinstance(tool_input, dict):
+            raise ValueError("submit_story input is not an object")
+        summary = tool_input.get("visual_summary")
+        if not isinstance(summary, dict):
+            raise ValueError("submit_story field visual_summary is missing or not an object")
+        return cls(
+            story=text(tool_input.get("story"), "story"),
+            visual_summary=VisualSummary(**{key: text(summary.get(key), f"visual_summary.{key}")
+                                            for key, _, _ in VISUAL_SUMMARY_FIELDS}),
+            snippet=text(tool_input.get("snippet"), "snippet"),
+        )
+
+
+def story_result_from_message(message):
+    # The fused request forces the tool, so anything else is a failure
+    tool_use = next((block for block in message.content if getattr(block, "type", None) == "tool_use"), None)
+    if tool_use is None or tool_use.name != STORY_TOOL["name"]:
+        raise ValueError("Response did not call submit_story")
+    return StoryResult.from_tool_input(tool_use.input)
+
+
+def speculative_visual_summary(situation_setup, key_traits):
+    # Stands in for the story's visual summary when the comic is rendered
+    # before the story exists; same header so comic_prompt reads it alike
+    return f"""VISUAL SUMMARY:
+- Protagonist: {key_traits}
+- Scene: {situation_setup.strip()}"""
+
+
+def comic_visual_summary(story):
+    visual_summary_start = story.find("VISUAL SUMMARY:")
+    return story[visual_summary_start:].strip() if visual_summary_start != -1 else ""
+
+
+def extract_key_traits(char_style_info):
+    # Extract and summarize key traits from the character info
+    traits = []
+    if "Core personality traits" in char_style_info:
+        traits.extend(char_style_info.split("Core personality traits:")[1].split("\n")[1:4])
+    if "Basic physical characteristics" in char_style_info:
+        traits.append(char_style_info.split("Basic physical characteristics:")[1].split("\n")[1])
+    
+    # Filter out potentially problematic words
+    safe_traits = [trait for trait in traits if not any(word in trait.lower() for word in ["violent", "aggressive", "weapon", "blood", "gore", "explicit"])]
+    
+    return ", ".join(trait.strip() for trait in safe_traits if trait.strip())
@@ -0,0 +1,349 @@
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import sys
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    """Classic token bucket that may go into debt.
+
+    `reserve` always takes the tokens and returns how long the caller has
+    to wait before it is entitled to use them, which keeps callers in FIFO
+    order without a separate queue.
+    """
+
+    def __init__(self, capacity, per_second):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.per_second)
+        self.updated_at = now
+
+    def reserve(self, amount):
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.per_second
+
+    def refund(self, amount):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        # When the one call let through while half open started
+        self.probe_started = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                return "half_open"
+            return "open"
+
+    def before_call(self, name):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Circuit for {name} is open after {self.failures} consecutive failures")
+            # Half open: a single probe at a time. One that never reports
+            # back (e.g. a cancelled task) stops counting after reset_timeout
+            if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+                raise CircuitOpenError(f"Circuit for {name} is half open and already probing")
+            self.probe_started = now
+
+    def release_probe(self):
+        # The call failed for reasons that say nothing about the provider
+        with self.lock:
+            self.probe_started = None
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_started = None
+            # A failed probe in half-open state re-opens the circuit straight away
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class Limits:
+
+    def __init__(self, requests_per_minute=None, input_tokens_per_minute=None, output_tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.input_tokens_per_minute = input_tokens_per_minute
+        self.output_tokens_per_minute = output_tokens_per_minute
+
+    def buckets(self):
+        buckets = {}
+        for kind, per_minute in (("requests", self.requests_per_minute),
+                                 ("input_tokens", self.input_tokens_per_minute),
+                                 ("output_tokens", self.output_tokens_per_minute)):
+            if per_minute:
+                buckets[kind] = TokenBucket(per_minute, per_minute / 60.0)
+        return buckets
+
+
+def status_code(error):
+    for candidate in (error, getattr(error, "response", None)):
+        for attribute in ("status_code", "status"):
+            value = getattr(candidate, attribute, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    # Looked up rather than imported: if httpx was never loaded, no provider
+    # client exists that could have raised its errors
+    httpx = sys.modules.get("httpx")
+    if httpx is not None and isinstance(error, httpx.TransportError):
+        return True
+    # anthropic.APIConnectionError / APITimeoutError carry no status code
+    if type(error).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return True
+    return status_code(error) in RETRYABLE_STATUS
+
+
+class Scheduler:
+    """Single gate for every upstream call.
+
+    Calls wait on per-provider and per-model token buckets (requests,
+    input tokens and output tokens), retry transient failures with
+    jittered exponential backoff that honours Retry-After, and fail fast
+    while a provider's circuit breaker is open.
+    """
+
+    def __init__(self, provider_limits=None, model_limits=None, max_retries=4, base_delay=1.0, max_delay=60.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.buckets = {}
+        for provider, limits in (provider_limits or {}).items():
+            self.buckets[(provider, None)] = limits.buckets()
+        for (provider, model), limits in (model_limits or {}).items():
+            self.buckets[(provider, model)] = limits.buckets()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, environ=None):
+        environ = os.environ if environ is None else environ
+        provider_limits = {
+            "anthropic": Limits(
+                requests_per_minute=int(environ.get("ANTHROPIC_RPM", "50")),
+                input_tokens_per_minute=int(environ.get("ANTHROPIC_INPUT_TPM", "40000")),
+                # Calls reserve their max_tokens until they finish, about 5000
+                # per story, so this has to allow a few stories at once
+                output_tokens_per_minute=int(environ.get("ANTHROPIC_OUTPUT_TPM", "16000")),
+            ),
+            "replicate": Limits(requests_per_minute=int(environ.get("REPLICATE_RPM", "600"))),
+        }
+        return cls(provider_limits=provider_limits, max_retries=int(environ.get("UPSTREAM_MAX_RETRIES", "4")))
+
+    def breaker(self, provider):
+        with self.lock:
+            if provider not in self.breakers:
+                self.breakers[provider] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self.breakers[provider]
+
+    def _scoped_buckets(self, provider, model):
+        keys = [(provider, None)] + ([(provider, model)] if model is not None else [])
+        return [self.buckets[key] for key in keys if key in self.buckets]
+
+    def _reserve(self, provider, model, input_tokens, output_tokens):
+        # Take from every applicable bucket; the longest wait wins
+        delay = 0.0
+        for buckets in self._scoped_buckets(provider, model):
+            for kind, amount in (("requests", 1), ("input_tokens", input_tokens), ("output_tokens", output_tokens)):
+                if kind in buckets and amount:
+                    delay = max(delay, buckets[kind].reserve(amount))
+        return delay
+
+    def _refund(self, provider, model, input_tokens, output_tokens):
+        # A failed attempt gives its tokens back (the request still counts),
+        # so retries don't reserve them again on top
+        for buckets in self._scoped_buckets(provider, model):
+            for kind, amount in (("input_tokens", input_tokens), ("output_tokens", output_tokens)):
+                if kind in buckets and amount:
+                    buckets[kind].refund(amount)
+
+    def _settle(self, provider, model, result, input_tokens, output_tokens):
+        # Give back what the estimate over-reserved, e.g. unused max_tokens
+        usage = getattr(result, "usage", None)
+        if usage is None:
+            return
+        used_input = getattr(usage, "input_tokens", None)
+        if used_input is not None:
+            # With prompt caching input_tokens only covers the uncached part
+            used_input += (getattr(usage, "cache_creation_input_tokens", None) or 0) + \
+                (getattr(usage, "cache_read_input_tokens", None) or 0)
+        for buckets in self._scoped_buckets(provider, model):
+            for kind, reserved, used in (("input_tokens", input_tokens, used_input),
+                                         ("output_tokens", output_tokens, getattr(usage, "output_tokens", None))):
+                if kind in buckets and used is not None and used < reserved:
+                    buckets[kind].refund(reserved - used)
+
+    def _backoff(self, attempt, error):
+        delay = retry_after(error)
+        if delay is None:
+            delay = min(self.max_delay, self.base_delay * (2 ** attempt))
+            delay = random.uniform(0, delay)  # full jitter
+        return min(delay, self.max_delay)
+
+    def _should_retry(self, attempt, error, can_retry):
+        return attempt < self.max_retries and is_retryable(error) and (can_retry is None or can_retry())
+
+    def call(self, provider, model, func, input_tokens=0, output_tokens=0, can_retry=None):
+        """Run `func()` under the limits for provider/model.
+
+        `input_tokens` and `output_tokens` are estimates reserved up front;
+        when the result has an Anthropic-style `usage`, unused tokens are
+        returned to the buckets. `can_retry` lets streaming callers refuse
+        a retry once output has been handed on.
+        """
+        breaker = self.breaker(provider)
+        attempt = 0
+        queue_wait = 0.0
+        upstream_seconds = 0.0
+        while True:
+            breaker.before_call(provider)
+            delay = self._reserve(provider, model, input_tokens, output_tokens)
+            if delay:
+                logger.debug("Waiting %.2fs for %s/%s rate limit", delay, provider, model)
+                time.sleep(delay)
+                queue_wait += delay
+            start = time.perf_counter()
+            try:
+                result = func()
+            except Exception as e:
+                upstream_seconds += time.perf_counter() - start
+                self._refund(provider, model, input_tokens, output_tokens)
+                if is_retryable(e):
+                    breaker.record_failure()
+                else:
+                    breaker.release_probe()
+                if not self._should_retry(attempt, e, can_retry):
+                    metrics.record_upstream(provider, queue_wait, upstream_seconds, attempt)
+                    raise
+                backoff = self._backoff(attempt, e)
+                attempt += 1
+                logger.warning("%s/%s call failed (%s), retry %s of %s in %.1fs",
+                               provider, model, e, attempt, self.max_retries, backoff)
+                time.sleep(backoff)
+                continue
+            upstream_seconds += time.perf_counter() - start
+            breaker.record_success()
+            self._settle(provider, model, result, input_tokens, output_tokens)
+            metrics.record_upstream(provider, queue_wait, upstream_seconds, attempt, getattr(result, "usage", None))
+            return result
+
+    async def acall(self, provider, model, func, input_tokens=0, output_tokens=0, can_retry=None):
+        """Coroutine version of `call`; `func()` must return an awaitable."""
+        breaker = self.breaker(provider)
+        attempt = 0
+        queue_wait = 0.0
+        upstream_seconds = 0.0
+        while True:
+            breaker.before_call(provider)
+            delay = self._reserve(provider, model, input_tokens, output_tokens)
+            if delay:
+                logger.debug("Waiting %.2fs for %s/%s rate limit", delay, provider, model)
+                await asyncio.sleep(delay)
+                queue_wait += delay
+            start = time.perf_counter()
+            try:
+                result = await func()
+            except Exception as e:
+                upstream_seconds += time.perf_counter() - start
+                self._refund(provider, model, input_tokens, output_tokens)
+                if is_retryable(e):
+                    breaker.record_failure()
+                else:
+                    breaker.release_probe()
+                if not self._should_retry(attempt, e, can_retry):
+                    metrics.record_upstream(provider, queue_wait, upstream_seconds, attempt)
+                    raise
+                backoff = self._backoff(attempt, e)
+                attempt += 1
+                logger.warning("%s/%s call failed (%s), retry %s of %s in %.1fs",
+                               provider, model, e, attempt, self.max_retries, backoff)
+                await asyncio.sleep(backoff)
+                continue
+            upstream_seconds += time.perf_counter() - start
+            breaker.record_success()
+            self._settle(provider, model, result, input_tokens, output_tokens)
+            metrics.record_upstream(provider, queue_wait, upstream_seconds, attempt, getattr(result, "usage", None))
+            return result
+
+
+def estimate_tokens(messages, system=None):
+    # Roughly four characters per token for English prose
+    chars = 0
+    for content in [message["content"] for message in messages] + ([system] if system else []):
+        if isinstance(content, str):
+            chars += len(content)
+        else:
+            chars += sum(len(block.get("text", "")) for block in content)
+    return chars // 4
@@ -0,0 +1,184 @@
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+
+import metrics
+
+try:
+    import redis
+except ImportError:  # Optional; only needed for redis:// backends
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteBackend:
+    """Shared state in one SQLite file, for nodes on the same host or on a
+    volume they all mount. Values are bytes; keys may expire."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Other processes hold the write lock briefly, so wait for it
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS shared (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL
+            )"""
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS shared_expires_at ON shared (expires_at)")
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM shared WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time()),
+            ).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO shared (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl if ttl else None),
+            )
+            self.conn.execute("DELETE FROM shared WHERE expires_at <= ?", (now,))
+            self.conn.commit()
+
+    def add(self, key, value, ttl=None):
+        """Set `key` only if it is absent (or expired); True if it was set."""
+        now = time.time()
+        with self.lock:
+            # Both statements run in one write transaction, so two nodes
+            # can't both see the key as free
+            self.conn.execute("DELETE FROM shared WHERE key = ? AND expires_at <= ?", (key, now))
+            added = self.conn.execute(
+                "INSERT OR IGNORE INTO shared (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, now + ttl if ttl else None),
+            ).rowcount == 1
+            self.conn.commit()
+        return added
+
+    def delete(self, key):
+        with self.lock:
+            self.conn.execute("DELETE FROM shared WHERE key = ?", (key,))
+            self.conn.commit()
+
+    def delete_if(self, key, value):
+        """Delete `key` only while it still holds `value`."""
+        with self.lock:
+            deleted = self.conn.execute("DELETE FROM shared WHERE key = ? AND value = ?", (key, value)).rowcount == 1
+            self.conn.commit()
+        return deleted
+
+
+class RedisBackend:
+    """The same operations on Redis (or anything speaking its protocol), for
+    nodes on different hosts. Needs the optional redis package."""
+
+    def __init__(self, url, prefix="story:"):
+        if redis is None:
+            raise RuntimeError("The redis package is required for a redis:// shared backend")
+        self.url = url
+        self.prefix = prefix
+        # RESP2 is all these commands need, and every Redis-compatible server speaks it
+        self.client = redis.Redis.from_url(url, protocol=2, socket_timeout=5.0, socket_connect_timeout=5.0)
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix + key, value, px=int(ttl * 1000) if ttl else None)
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.prefix + key, value, nx=True, px=int(ttl * 1000) if ttl else None))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def delete_if(self, key, value):
+        key = self.prefix + key
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    # WATCH makes the DEL fail if the key changed after the GET
+                    pipe.watch(key)
+                    if pipe.get(key) != value:
+                        pipe.unwatch()
+                        return False
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+                    return True
+                except redis.WatchError:
+                    continue
+
+
+def backend_from_url(url):
+    """redis://, rediss:// or unix:// URLs use Redis; sqlite:///path or a
+    plain path uses a SQLite file."""
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    return SQLiteBackend(url[len("sqlite:///"):] if url.startswith("sqlite:///") else url)
+
+
+class SharedLocks:
+    """Single-flight across nodes: of all the callers that miss the same
+    key at once, whichever node takes the lock computes the value and the
+    rest wait for it to appear.
+
+    A lock expires after `ttl` seconds, so a node that dies while holding
+    one only delays the others. Waiters give up after `wait` seconds and
+    compute the value themselves, as they also do if the backend fails.
+    """
+
+    def __init__(self, backend, ttl=120.0, wait=None, poll_interval=0.05, max_poll_interval=0.5):
+        self.backend = backend
+        self.ttl = ttl
+        self.wait = ttl if wait is None else wait
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    def coalesce(self, key, lookup, create, name="shared"):
+        """Return `lookup()` once another node has filled it, otherwise
+        the result of `create()`, which should store the value for the
+        others to find."""
+        lock_key = f"lock:{key}"
+        token = secrets.token_hex(16).encode()
+        deadline = time.monotonic() + self.wait
+        delay = self.poll_interval
+        while True:
+            try:
+                acquired = self.backend.add(lock_key, token, self.ttl)
+            except Exception as e:
+                logger.warning("Shared lock for %s unavailable, computing locally: %s", key[:12], e)
+                return create()
+            if acquired:
+                try:
+                    # Whoever held the lock before may have just finished
+                    value = lookup()
+                    if value is not None:
+                        return value
+                    return create()
+                finally:
+                    try:
+                        self.backend.delete_if(lock_key, token)
+                    except Exception as e:
+                        logger.warning("Could not release shared lock for %s: %s", key[:12], e)
+
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+            value = lookup()
+            if value is not None:
+                metrics.COALESCED.inc(key=name, scope="cluster")
+                return value
+            if time.monotonic() >= deadline:
+                logger.warning("Gave up waiting for another node to compute %s", key[:12])
+                return create()
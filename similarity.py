@@ -0,0 +1,180 @@
+import logging
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Words that change the phrasing of a circumstance but not the situation,
+# e.g. "I just lost my job" vs "lost my job"
+STOPWORDS = frozenset("""
+    a an the i i'm im me my mine we our just really so very and or but that this to of in on at for with
+    has have had got been be is am are was were
+""".split())
+
+
+def normalize(text):
+    words = re.findall(r"[a-z0-9']+", text.lower())
+    return " ".join(word for word in words if word not in STOPWORDS)
+
+
+class HashingVectorizer:
+    """Cheap text embedding: word unigrams and character n-grams hashed
+    into a fixed number of buckets, L2-normalised so a dot product is the
+    cosine similarity."""
+
+    def __init__(self, dim=1024, ngram=3):
+        self.dim = dim
+        self.ngram = ngram
+
+    def features(self, text):
+        words = text.split()
+        features = [f"w:{word}" for word in words]
+        for word in words:
+            padded = f" {word} "
+            features.extend(f"c:{padded[i:i + self.ngram]}" for i in range(len(padded) - self.ngram + 1))
+        return features
+
+    def transform(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self.features(normalize(text)):
+            # crc32 rather than hash(), which is salted per process
+            vector[zlib.crc32(feature.encode("utf-8")) % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def similarity(self, text, other):
+        return float(self.transform(text) @ self.transform(other))
+
+
+class SimilarityIndex:
+    """Vectors and values for one protagonist, searched with a single
+    matrix-vector product. The least recently used entry is evicted once
+    `max_entries` is reached."""
+
+    def __init__(self, dim, max_entries=256, initial_capacity=16):
+        self.max_entries = max_entries
+        capacity = min(initial_capacity, max_entries)
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.created_at = np.zeros(capacity)
+        self.used_at = np.zeros(capacity)
+        self.values = []
+        self.texts = []
+        self.size = 0
+
+    def _grow(self):
+        # Doubling keeps appends cheap without reserving max_entries rows
+        # for protagonists that only ever see a few circumstances
+        capacity = min(len(self.vectors) * 2, self.max_entries)
+        self.vectors = np.resize(self.vectors, (capacity, self.vectors.shape[1]))
+        self.created_at = np.resize(self.created_at, capacity)
+        self.used_at = np.resize(self.used_at, capacity)
+
+    def search(self, vector, ttl=None):
+        if not self.size:
+            return None, 0.0
+        scores = self.vectors[:self.size] @ vector
+        if ttl:
+            scores[self.created_at[:self.size] <= time.time() - ttl] = -1.0
+        best = int(np.argmax(scores))
+        return best, float(scores[best])
+
+    def add(self, vector, text, value):
+        """Store an entry, returning True if an older one was evicted for it."""
+        evicted = self.size == self.max_entries
+        if evicted:
+            slot = int(np.argmin(self.used_at[:self.size]))
+            self.texts[slot] = text
+            self.values[slot] = value
+        else:
+            if self.size == len(self.vectors):
+                self._grow()
+            slot = self.size
+            self.texts.append(text)
+            self.values.append(value)
+            self.size += 1
+        self.vectors[slot] = vector
+        self.created_at[slot] = self.used_at[slot] = time.time()
+        return evicted
+
+    def touch(self, slot):
+        self.used_at[slot] = time.time()
+
+
+class SimilarityCache:
+    """Reuses results for circumstances that read the same as an earlier one.
+
+    Circumstances are normalised and embedded with `vectorizer`, and each
+    protagonist gets its own index, or one per `variant` for values that
+    depend on more than the circumstance (e.g. how a story was rendered).
+    A lookup hits when the best cosine similarity is at least `threshold`.
+    `mode` says what the callers keep here: "situation" for situation
+    setups or "story" for finished stories.
+    """
+
+    def __init__(self, threshold=0.85, max_entries=256, ttl=None, mode="situation", vectorizer=None,
+                 name="circumstance"):
+        if mode not in ("situation", "story"):
+            raise ValueError(f"Unknown similarity cache mode: {mode}")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.mode = mode
+        self.vectorizer = vectorizer or HashingVectorizer()
+        self.name = name
+        self.indexes = {}
+        self.lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def lookup(self, protagonist, circumstance, variant=None):
+        vector = self.vectorizer.transform(circumstance)
+        with self.lock:
+            index = self.indexes.get((protagonist, variant))
+            slot, score = index.search(vector, self.ttl) if index is not None else (None, 0.0)
+            hit = slot is not None and score >= self.threshold
+            self.counters["hits" if hit else "misses"] += 1
+            if hit:
+                index.touch(slot)
+                value, matched = index.values[slot], index.texts[slot]
+        metrics.record_cache(self.name, hit)
+        if slot is not None:
+            metrics.SIMILARITY_SCORE.observe(score, cache=self.name)
+        if not hit:
+            return None
+        logger.info("Reusing %s for %s: %r matched %r (%.2f)",
+                    self.mode, protagonist, circumstance[:50], matched[:50], score)
+        return value
+
+    def store(self, protagonist, circumstance, value, variant=None):
+        vector = self.vectorizer.transform(circumstance)
+        with self.lock:
+            index = self.indexes.get((protagonist, variant))
+            if index is None:
+                index = self.indexes[protagonist, variant] = SimilarityIndex(self.vectorizer.dim, self.max_entries)
+            if index.add(vector, circumstance, value):
+                self.counters["evictions"] += 1
+                metrics.CACHE_EVICTIONS.inc(cache=self.name)
+
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            entries = {}
+            for (protagonist, _), index in self.indexes.items():
+                entries[protagonist] = entries.get(protagonist, 0) + index.size
+        total = counters["hits"] + counters["misses"]
+        return {
+            "mode": self.mode,
+            "threshold": self.threshold,
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "hits": counters["hits"],
+            "misses": counters["misses"],
+            "hit_rate": counters["hits"] / total if total else 0.0,
+            "evictions": counters["evictions"],
+            "entries": entries,
+        }
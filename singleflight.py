@@ -0,0 +1,249 @@
+import asyncio
+import contextvars
+import logging
+import threading
+from concurrent.futures import Future
+
+import metrics
+from predictions import Consumer, PredictionCancelled, PredictionDeadlineExceeded, consuming, current_consumer
+
+logger = logging.getLogger(__name__)
+
+# What a shared call raises when the caller running it went away, rather
+# than because the work failed; the callers still waiting try again
+ABANDONED = (PredictionCancelled, PredictionDeadlineExceeded)
+
+
+class SingleFlight:
+    """One call per key at a time. Callers that arrive while a call is in
+    flight wait for it and get its result (or exception) instead of
+    making their own. The first caller runs the call on its own thread."""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func):
+        while True:
+            with self.lock:
+                call = self.calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self.calls[key] = Future()
+            if leader:
+                try:
+                    result = func()
+                    call.set_result(result)
+                    return result
+                except BaseException as e:
+                    call.set_exception(e)
+                    raise
+                finally:
+                    with self.lock:
+                        del self.calls[key]
+
+            metrics.COALESCED.inc(key=self.name, scope="node")
+            try:
+                return call.result()
+            except ABANDONED:
+                consumer = current_consumer()
+                if consumer is not None and consumer.gone.is_set():
+                    raise
+                logger.info("Shared %s call was abandoned by its caller, retrying", self.name)
+
+
+def shared_consumer():
+    """A consumer for work done on behalf of several callers, with the
+    current caller's deadline but not tied to its going away."""
+    consumer = current_consumer()
+    remaining = consumer.remaining() if consumer is not None else None
+    return Consumer(max(remaining, 0.001) if remaining is not None else None)
+
+
+class AsyncSingleFlight:
+    """Coroutine version of SingleFlight. The call runs as its own task
+    under its own prediction consumer, so it isn't given up when the
+    caller that started it goes; it is cancelled only when every caller
+    waiting on it has been."""
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = {}
+
+    @staticmethod
+    async def _run(factory, consumer):
+        with consuming(consumer):
+            return await factory()
+
+    async def do(self, key, factory):
+        entry = self.calls.get(key)
+        if entry is None:
+            task = asyncio.ensure_future(self._run(factory, shared_consumer()))
+            entry = self.calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self.calls.get(key) is entry and self.calls.pop(key))
+        else:
+            metrics.COALESCED.inc(key=self.name, scope="node")
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        except asyncio.CancelledError:
+            if entry[0].done():
+                raise
+            entry[1] -= 1
+            if entry[1] == 0:
+                entry[0].cancel()
+                if self.calls.get(key) is entry:
+                    del self.calls[key]
+            raise
+
+
+class Subscriber:
+
+    def __init__(self, callbacks):
+        self.callbacks = {name: callback for name, callback in callbacks.items() if callback is not None}
+        self.wake = threading.Event()
+        self.error = None
+
+
+class SharedRun:
+
+    def __init__(self, consumer, trace_id=None):
+        self.consumer = consumer
+        # Where the run records its stages, for every caller to merge into its own
+        self.trace = metrics.Trace(trace_id)
+        self.lock = threading.Lock()
+        self.subscribers = []
+        # Every callback made so far, replayed to callers that join late
+        self.history = []
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def emit(self, name, *args):
+        with self.lock:
+            self.history.append((name, args))
+            for subscriber in list(self.subscribers):
+                self._deliver(subscriber, name, args)
+
+    def _deliver(self, subscriber, name, args):
+        callback = subscriber.callbacks.get(name)
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            # e.g. a job cancelled from its on_start: it stops waiting,
+            # everyone else carries on
+            subscriber.error = e
+            self.subscribers.remove(subscriber)
+            subscriber.wake.set()
+
+    def join(self, subscriber):
+        with self.lock:
+            self.subscribers.append(subscriber)
+            for name, args in self.history:
+                if subscriber in self.subscribers:
+                    self._deliver(subscriber, name, args)
+            if self.done.is_set():
+                subscriber.wake.set()
+
+    def leave(self, subscriber):
+        with self.lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
+            return not self.subscribers and not self.done.is_set()
+
+    def finish(self, result=None, error=None):
+        with self.lock:
+            self.result = result
+            self.error = error
+            self.done.set()
+            for subscriber in self.subscribers:
+                subscriber.wake.set()
+
+
+class SharedRuns:
+    """Whole-request single-flight: identical generations share one run.
+
+    The run happens on its own thread under its own prediction consumer,
+    so it carries on while anyone still wants it and its images are
+    cancelled once nobody does. The callbacks passed by the first caller
+    decide which ones `start` gets; they reach every caller, and a caller
+    that joins late first gets the ones it missed. Each caller's trace
+    gets the run's stages, marked as coalesced for all but the first.
+    """
+
+    def __init__(self, name="request", tick=0.25):
+        self.name = name
+        self.tick = tick
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    def run(self, key, start, **callbacks):
+        """`start(**callbacks)` performs the work, reporting progress
+        through the callbacks it is given."""
+        consumer = current_consumer()
+        subscriber = Subscriber(callbacks)
+        with self.lock:
+            shared = self.runs.get(key)
+            leader = shared is None
+            if leader:
+                trace = metrics.current_trace()
+                shared = self.runs[key] = SharedRun(shared_consumer(), trace.id if trace is not None else None)
+            shared.join(subscriber)
+        if leader:
+            threading.Thread(target=contextvars.copy_context().run, args=(self._run, key, shared, start, callbacks),
+                             name=f"shared-{self.name}", daemon=True).start()
+        else:
+            metrics.COALESCED.inc(key=self.name, scope="node")
+            logger.info("Joining an identical %s already in flight", self.name)
+
+        reason = None
+        try:
+            while not subscriber.wake.wait(self.tick):
+                if consumer is None:
+                    continue
+                if consumer.gone.is_set():
+                    reason = "gone"
+                    raise PredictionCancelled(f"Caller of shared {self.name} is gone")
+                remaining = consumer.remaining()
+                if remaining is not None and remaining <= 0:
+                    reason = "deadline"
+                    raise PredictionDeadlineExceeded(f"Shared {self.name} missed its deadline")
+            if subscriber.error is not None:
+                reason = "error"
+                raise subscriber.error
+            trace = metrics.current_trace()
+            if trace is not None:
+                trace.merge(shared.trace, coalesced=not leader)
+            if shared.error is not None:
+                raise shared.error
+            return dict(shared.result)
+        finally:
+            if reason is not None:
+                self._leave(key, shared, subscriber)
+
+    def _leave(self, key, shared, subscriber):
+        with self.lock:
+            orphaned = shared.leave(subscriber)
+            if orphaned and self.runs.get(key) is shared:
+                # Nobody new may join a run that is being abandoned
+                del self.runs[key]
+        if orphaned:
+            logger.info("Abandoning shared %s, its last caller has gone", self.name)
+            shared.consumer.abandon()
+
+    def _run(self, key, shared, start, callbacks):
+        emitters = {name: (lambda *args, name=name: shared.emit(name, *args)) for name in callbacks}
+        # Runs in a copy of the first caller's context, so this doesn't touch its trace
+        metrics.set_trace(shared.trace)
+        try:
+            with consuming(shared.consumer):
+                shared.finish(result=start(**emitters))
+        except Exception as e:
+            shared.finish(error=e)
+        finally:
+            with self.lock:
+                if self.runs.get(key) is shared:
+                    del self.runs[key]
@@ -2,10 +2,18 @@ document.addEventListener('DOMContentLoaded', () => {
     const form = document.getElementById('storyForm');
     const comicContainer = document.getElementById('comicContainer');
     const storyElement = document.getElementById('story');
+    const snippetElement = document.getElementById('snippet');
     const visualSummaryElement = document.getElementById('visualSummary');
+    const statusElement = document.getElementById('status');
     const generateButton = document.getElementById('generateButton');
     const resultsContainer = document.getElementById('results');
 
+    const stageLabels = {
+        character_profile: 'Character profile ready. Setting the scene...',
+        situation: 'Scene ready. Writing the story...',
+        story: 'Story written. Drawing the comic and writing the snippet...',
+    };
+
     if (form) {
         form.addEventListener('submit', (event) => {
             event.preventDefault();
@@ -15,7 +23,93 @@ document.addEventListener('DOMContentLoaded', () => {
         console.error('Story form not found');
     }
 
-    function generateStory() {
+    // Mirrored images (/artifacts/<hash>.<ext>) come with WebP thumbnails
+    const thumbnailSizes = [256, 512];
+    const displayWidths = {'comic-image': '512px', 'character-image': '256px'};
+
+    function setImageSource(img, url) {
+        img.src = url;
+        const artifact = url.match(/^(\/artifacts\/[0-9a-f]{64})\.\w+$/);
+        if (artifact) {
+            img.srcset = thumbnailSizes.map((size) => `${artifact[1]}_${size}.webp ${size}w`).join(', ');
+            img.sizes = displayWidths[img.className] || '512px';
+        } else {
+            img.removeAttribute('srcset');
+        }
+    }
+
+    function addImage(url, alt, className) {
+        const img = document.createElement('img');
+        img.className = className;
+        setImageSource(img, url);
+        img.loading = 'lazy';
+        img.alt = alt;
+        comicContainer.appendChild(img);
+        return img;
+    }
+
+    // Drafts and speculative comics arrive as *_preview events and are
+    // swapped for the final image (often the same one) when it arrives; a
+    // preview that turns up after its final image is ignored
+    const images = {};
+    const finalImages = new Set();
+
+    function showImage(key, url, alt, className, preview) {
+        if (finalImages.has(key)) {
+            return;
+        }
+        if (!preview) {
+            finalImages.add(key);
+        }
+        const img = images[key];
+        if (!img) {
+            images[key] = addImage(url, alt, className);
+        } else if (img.src !== new URL(url, window.location.href).href) {
+            setImageSource(img, url);
+        }
+    }
+
+    function handleEvent(message) {
+        if (stageLabels[message.event]) {
+            statusElement.textContent = stageLabels[message.event];
+        }
+        switch (message.event) {
+            case 'story_delta':
+                storyElement.textContent += message.data;
+                break;
+            case 'story':
+                // Replace the raw stream, which still contains the visual summary
+                storyElement.textContent = message.data;
+                break;
+            case 'visual_summary':
+                visualSummaryElement.textContent = message.data;
+                break;
+            case 'snippet':
+                snippetElement.textContent = message.data;
+                break;
+            case 'comic_preview':
+            case 'comic_url':
+                showImage('comic', message.data, 'Generated Comic', 'comic-image', message.event === 'comic_preview');
+                break;
+            case 'side_profile_preview':
+            case 'side_profile_url':
+                showImage('side_profile', message.data, 'Character Side Profile', 'character-image',
+                          message.event === 'side_profile_preview');
+                break;
+            case 'headshot_preview':
+            case 'headshot_url':
+                showImage('headshot', message.data, 'Character Headshot', 'character-image',
+                          message.event === 'headshot_preview');
+                break;
+            case 'done':
+                statusElement.textContent = '';
+                break;
+            case 'error':
+                throw new Error(message.data);
+        }
+    }
+
+    async function generateStory() {
         const circumstance = document.getElementById('circumstance').value;
         const protagonist = document.getElementById('protagonist').value;
 
@@ -25,64 +119,57 @@ document.addEventListener('DOMContentLoaded', () => {
         }
 
         comicContainer.innerHTML = '';
-        storyElement.textContent = 'Generating...';
+        for (const key of Object.keys(images)) {
+            delete images[key];
+        }
+        finalImages.clear();
+        storyElement.textContent = '';
+        snippetElement.textContent = '';
         visualSummaryElement.textContent = '';
+        statusElement.textContent = 'Generating...';
         generateButton.disabled = true;
-        resultsContainer.style.display = 'none';
+        resultsContainer.style.display = 'block';
 
-        fetch('/generate', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/x-www-form-urlencoded',
-            },
-            body: new URLSearchParams({
-                'circumstance': circumstance,
-                'protagonist': protagonist
-            })
-        })
-        .then(response => {
+        try {
+            const response = await fetch('/generate/stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/x-www-form-urlencoded',
+                },
+                body: new URLSearchParams({
+                    'circumstance': circumstance,
+                    'protagonist': protagonist
+                })
+            });
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
-            return response.json();
-        })
-        .then(data => {
-            if (data.comic_url) {
-                const img = document.createElement('img');
-                img.src = data.comic_url;
-                img.alt = 'Generated Comic';
-                img.className = 'comic-image';
-                comicContainer.appendChild(img);
-            }
-            if (data.side_profile_url) {
-                const sideProfileImg = document.createElement('img');
-                sideProfileImg.src = data.side_profile_url;
-                sideProfileImg.alt = 'Character Side Profile';
-                sideProfileImg.className = 'character-image';
-                comicContainer.appendChild(sideProfileImg);
-            }
-            if (data.headshot_url) {
-                const headshotImg = document.createElement('img');
-                headshotImg.src = data.headshot_url;
-                headshotImg.alt = 'Character Headshot';
-                headshotImg.className = 'character-image';
-                comicContainer.appendChild(headshotImg);
-            }
-            if (data.story) {
-                storyElement.textContent = data.story;
-            }
-            if (data.visual_summary) {
-                visualSummaryElement.textContent = data.visual_summary;
+
+            // The response is newline-delimited JSON, one event per line
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            while (true) {
+                const { value, done } = await reader.read();
+                if (done) {
+                    break;
+                }
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                for (const line of lines) {
+                    if (line.trim()) {
+                        handleEvent(JSON.parse(line));
+                    }
+                }
             }
-            generateButton.disabled = false;
-            resultsContainer.style.display = 'block';
-        })
-        .catch(error => {
+        } catch (error) {
             console.error('Error:', error);
-            storyElement.textContent = `An error occurred: ${error.message}. Please try again.`;
+            statusElement.textContent = `An error occurred: ${error.message}. Please try again.`;
+        } finally {
             generateButton.disabled = false;
-        });
+        }
     }
 });
 
-console.log('Script loaded');
\ No newline at end of file
+console.log('Script loaded');
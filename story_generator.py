@@ -1,23 +1,71 @@
 import logging
-from anthropic import Anthropic
 import os
+import threading
 import traceback
 import time
-import replicate
+from pipeline import Pipeline
+from predictions import PredictionManager, PredictionCancelled
+from cache import make_cache_key
+import image_profiles
+import metrics
+import prompts
+from scheduler import Scheduler, estimate_tokens
+from singleflight import SharedRuns, SingleFlight
 
 logger = logging.getLogger(__name__)
 
+# What generate_all returns (besides visual_summary), in pipeline order
+OUTPUTS = ["char_style_info", "situation_setup", "story_parts", "derivative_story",
+           "comic_url", "side_profile_url", "headshot_url"]
+# Image outputs and the draft each is preceded by in progressive generation
+DRAFT_OUTPUTS = {"comic_url": "comic_draft_url", "side_profile_url": "side_profile_draft_url",
+                 "headshot_url": "headshot_draft_url"}
+
 class StoryGenerator:
 
-    def __init__(self):
+    def __init__(self, max_workers=4, profile_cache=None, character_store=None, scheduler=None, artifact_store=None,
+                 fused=False, circumstance_cache=None, speculative=False, speculative_rerender_below=None, predictions=None,
+                 portrait_cache=None, coalesce_stages=True, image_profile=image_profiles.DEFAULT_PROFILE):
         logger.info("Initializing StoryGenerator")
+        self.max_workers = max_workers
+        self.circumstance_cache = circumstance_cache
+        self.fused = fused
+        # Speculative comics are drawn from the situation setup while the
+        # story is still being written. With speculative_rerender_below set,
+        # one whose summary is less similar than that to the story's own
+        # visual summary is drawn again from the story.
+        self.speculative = speculative
+        self.speculative_rerender_below = speculative_rerender_below
+        self.summary_vectorizer = None
+        if speculative_rerender_below is not None:
+            # numpy is only loaded when speculative comics are checked
+            from similarity import HashingVectorizer
+            self.summary_vectorizer = HashingVectorizer()
+        self.profile_cache = profile_cache
+        # Portraits only depend on the character profile, so with a cached
+        # profile the same two images can be reused too
+        self.portrait_cache = portrait_cache
+        # Identical profile and portrait calls running at the same time share
+        # one upstream call; whole requests only do when generate_all is asked to
+        self.char_style_flights = SingleFlight("char_style") if coalesce_stages else None
+        self.portrait_flights = SingleFlight("portrait") if coalesce_stages else None
+        self.request_flights = SharedRuns("generate")
+        # Which of image_profiles.PROFILES renders images unless a call picks another
+        if image_profile not in image_profiles.PROFILES:
+            raise ValueError(f"Unknown image profile: {image_profile}")
+        self.image_profile = image_profile
+        self.character_store = character_store
+        self.artifact_store = artifact_store
+        self.scheduler = scheduler or Scheduler.from_env()
         
         # Initialize Anthropic
         anthropic_api_key = os.environ.get("ANTHROPIC_API_KEY")
         if not anthropic_api_key:
             logger.error("ANTHROPIC_API_KEY not found in environment variables")
             raise ValueError("ANTHROPIC_API_KEY is not set")
-        self.anthropic = Anthropic(api_key=anthropic_api_key)
+        self.anthropic_api_key = anthropic_api_key
+        self._anthropic = None
+        self._client_lock = threading.Lock()
         
         # Initialize Replicate
         replicate_api_token = os.environ.get("REPLICATE_API_TOKEN")
@@ -26,188 +74,163 @@ class StoryGenerator:
             raise ValueError("REPLICATE_API_TOKEN is not set")
         self.replicate_api_token = replicate_api_token
         os.environ["REPLICATE_API_TOKEN"] = replicate_api_token
+        # Tracks predictions so they can be shared, timed out and cancelled
+        self.predictions = predictions or PredictionManager()
         
         logger.info("StoryGenerator initialized successfully")
 
+    @property
+    def anthropic(self):
+        # The SDK is slow to import, so it is loaded with the first request
+        # (or /ready?warm=1) rather than at startup
+        if self._anthropic is None:
+            with self._client_lock:
+                if self._anthropic is None:
+                    from anthropic import Anthropic
+                    # Retries are handled by the scheduler, not by the client
+                    self._anthropic = Anthropic(api_key=self.anthropic_api_key, max_retries=0)
+        return self._anthropic
+
+    def warm(self):
+        """Build the provider clients and open a connection to each, so the
+        first request doesn't pay for imports or TLS handshakes."""
+        try:
+            # Any response will do; only the pooled connection matters
+            self.anthropic.get("/v1/models", cast_to=object)
+        except Exception as e:
+            logger.debug("Anthropic warm-up request: %s", e)
+        self.predictions.warm()
+
+    def _create_message(self, **params):
+        # The prompt-caching endpoint honours cache_control blocks and
+        # reports cache reads and writes in usage
+        return self.scheduler.call(
+            "anthropic", prompts.CLAUDE_MODEL,
+            lambda: self.anthropic.beta.prompt_caching.messages.create(model=prompts.CLAUDE_MODEL, **params),
+            input_tokens=estimate_tokens(params["messages"], params.get("system")),
+            output_tokens=params["max_tokens"],
+        )
+
+    @metrics.instrumented("char_style")
     def generate_char_style_info(self, protagonist_name, original_story, author):
         try:
-            logger.info(f"Generating character style info for {protagonist_name}")
-            char_style_prompt = f"""Create a detailed character profile for a modern adaptation of {protagonist_name}, originally from {original_story} by {author}. Focus on the core essence of the character without directly referencing their original story, specific plot elements, or other characters from that story. Adapt their traits to a contemporary, relatable context:
-
-            1. Character Essence:
-               a) Core personality traits (list 3-5 key traits)
-               b) Fundamental motivations and values
-               c) Typical responses to challenges or setbacks
-               d) Communication style and social tendencies
-               e) Notable quirks or habits
-               f) Basic physical characteristics (age range, build, general appearance)
-
-            2. Inner Strength and Growth:
-               a) Sources of the character's inner strength
-               b) Areas where the character might struggle or feel unsure
-               c) How the character typically handles being underestimated by others
-               d) The character's unique approach to overcoming obstacles
-               e) Past experiences that have shaped the character's resilience
-
-            3. Modern Context:
-               a) Potential contemporary profession or lifestyle
-               b) How their core traits might manifest in today's world
-               c) Types of modern-day challenges they might face
-               d) Their relationship with technology and social media
-
-            4. First-Person Narration Voice:
-               a) Distinctive speech patterns or expressions (without using catchphrases from the original story)
-               b) Level of self-awareness as a narrator
-               c) Tendency towards introspection or external observation
-               d) Use of humor, sarcasm, or other stylistic elements
-               e) How their background and experiences influence their narration style
-               f) Examples of how they might describe feelings of uncertainty or determination
-
-            5. Writing Style Guidance:
-               a) Tone and mood that best suits the character (e.g., introspective, humorous, determined)
-               b) Pacing and rhythm of storytelling that matches the character's personality
-               c) Balance of dialogue, action, and internal monologue
-               d) Descriptive techniques that align with the character's perspective
-               e) Literary devices that would effectively convey the character's journey of personal growth
-
-            Ensure all descriptions are applicable to a realistic, modern-day setting and provide specific examples where possible. Focus on creating a unique and consistent character voice that captures the essence of {protagonist_name} without relying on specific elements from their original story, emphasizing their journey of personal growth and resilience."""
-
-            logger.debug(f"Character style prompt: {char_style_prompt[:200]}...")
-            char_style_response = self.anthropic.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=1000,
-                messages=[
-                    {"role": "user", "content": char_style_prompt}
-                ]
-            )
-            logger.info(f"Character style info generated: {char_style_response.content[0].text[:100]}...")
-            return char_style_response.content[0].text
+            logger.info("Generating character style info for %s", protagonist_name)
+            char_style_prompt = prompts.char_style_prompt(protagonist_name, original_story, author)
+
+            logger.debug("Character style prompt: %s...", char_style_prompt[:200])
+
+            def create():
+                char_style_response = self._create_message(
+                    max_tokens=1000,
+                    messages=[
+                        {"role": "user", "content": char_style_prompt}
+                    ]
+                )
+                return char_style_response.content[0].text
+
+            cache_key = make_cache_key(prompts.CLAUDE_MODEL, char_style_prompt, max_tokens=1000)
+
+            def lookup():
+                if self.profile_cache is None:
+                    return create()
+                return self.profile_cache.get_or_create(cache_key, create)
+
+            if self.char_style_flights is None:
+                char_style_info = lookup()
+            else:
+                char_style_info = self.char_style_flights.do(cache_key, lookup)
+            logger.info("Character style info generated: %s...", char_style_info[:100])
+            return char_style_info
         except Exception as e:
-            logger.error(f"Error in generate_char_style_info: {str(e)}")
+            logger.error("Error in generate_char_style_info: %s", e)
             logger.error(traceback.format_exc())
             raise
 
+    @metrics.instrumented("situation")
     def generate_situation_setup(self, circumstance, char_style_info):
         try:
-            logger.info(f"Generating situation setup for circumstance: {circumstance[:50]}...")
-            situation_prompt = f"""Create a vivid and detailed scenario for a 6-panel manga-style comic where a young adult with the following traits faces this circumstance in a modern Western city: {circumstance}
-
-            Character traits: {char_style_info}
-
-            Provide:
-            1. Setting: Describe the specific location and time of day. What visual elements would be prominent?
-            2. Inciting Incident: What exactly happens to bring the character into this circumstance?
-            3. Character's Initial Reaction: How does the character physically and emotionally respond?
-            4. Immediate Conflict: What obstacle or dilemma does the character face right away?
-            5. Supporting Characters: Introduce 1-2 other characters who might be involved. How do they look and act?
-            6. Potential for Drama: What elements of this scenario could lead to interesting visual storytelling?
+            logger.info("Generating situation setup for circumstance: %s...", circumstance[:50])
+            situation_prompt = prompts.situation_prompt(circumstance)
 
-            Important: When describing the character's actions and appearance, avoid mentioning their facial features or expressions. Instead, focus on body language, gestures, and other visual cues to convey emotions and reactions.
-
-            Describe the scenario in about 150 words, focusing on vivid, visual details and emotionally charged moments that would translate well to a comic format."""
-
-            logger.debug(f"Situation setup prompt: {situation_prompt[:200]}...")
-            situation_response = self.anthropic.messages.create(
-                model="claude-3-5-sonnet-20240620",
+            logger.debug("Situation setup prompt: %s...", situation_prompt[:200])
+            situation_response = self._create_message(
                 max_tokens=300,
+                system=prompts.character_system(char_style_info),
                 messages=[
                     {"role": "user", "content": situation_prompt}
                 ]
             )
-            logger.info(f"Situation setup generated: {situation_response.content[0].text[:100]}...")
+            logger.info("Situation setup generated: %s...", situation_response.content[0].text[:100])
             return situation_response.content[0].text
         except Exception as e:
-            logger.error(f"Error in generate_situation_setup: {str(e)}")
+            logger.error("Error in generate_situation_setup: %s", e)
             logger.error(traceback.format_exc())
             raise
 
-    def generate_story(self, char_style_info, situation_setup, author):
+    @metrics.instrumented("story")
+    def generate_story(self, char_style_info, situation_setup, on_text=None):
         try:
             logger.info("Starting story generation")
-            story_prompt = f"""Write a high-quality short story of approximately 500 words based on the following details:
-
-            Character Profile and Style: {char_style_info}
-            Situation: {situation_setup}
-
-            Guidelines:
-            1. Write the story in a "cinematic first-person" viewpoint, using "I" as the narrator (the protagonist).
-            2. Use present tense to create a sense of immediacy.
-            3. Incorporate the specific first-person narration voice and writing style details provided in the character profile.
-            4. Create a compelling narrative arc focused on the protagonist's personal growth within the context of the given situation.
-            5. Establish the main conflict as an internal or external challenge that tests the protagonist's beliefs or capabilities.
-            6. Subtly showcase the protagonist's unique strengths and how they apply them to face the challenge.
-            7. Illustrate the character's internal struggle and growth through their actions, thoughts, and interactions.
-            8. Incorporate dialogue that reflects the character's unique voice and subtly reveals how others perceive them.
-            9. Explore the protagonist's inner thoughts and emotions as they navigate the challenges, without explicitly labeling their feelings.
-            10. Conclude with a satisfying resolution where the protagonist overcomes the challenge in a way that aligns with their core personality traits.
-            11. Ensure the story feels contemporary and relatable, avoiding any direct references to the character's original story or universe.
-            12. Focus on vivid descriptions of the setting and the protagonist's emotional state, as this will be used for image generation.
-
-            After writing the story, provide a brief summary of key visual elements in the following format:
-
-            VISUAL SUMMARY:
-            - Setting: [Describe the main setting or settings]
-            - Protagonist: [Describe the protagonist's appearance and most notable visual characteristics]
-            - Key Object: [Describe an important object or symbol in the story that represents the character's struggle or growth]
-            - Action: [Describe a key action or scene that encapsulates the protagonist's moment of triumph or realization]
-            - Mood: [Describe the overall visual mood or atmosphere of the story, reflecting the character's emotional journey]
-
-            Ensure this visual summary captures the most striking and important visual aspects of your story, emphasizing the character's emotional journey without explicitly mentioning concepts like doubt or confidence."""
-
-            logger.debug(f"Story generation prompt: {story_prompt[:200]}...")
-
-            response = self.anthropic.messages.create(
-                model="claude-3-5-sonnet-20240620",
-                max_tokens=2500,
-                temperature=0.7,
-                messages=[
+            story_prompt = prompts.story_prompt(situation_setup)
+            system = prompts.character_system(char_style_info)
+
+            logger.debug("Story generation prompt: %s...", story_prompt[:200])
+
+            if on_text is not None:
+                messages = [
                     {"role": "user", "content": story_prompt}
                 ]
-            )
+                emitted = []
+
+                # Stream the story so callers can forward tokens as they arrive
+                def stream_story():
+                    with self.anthropic.beta.prompt_caching.messages.stream(
+                        model=prompts.CLAUDE_MODEL,
+                        max_tokens=2500,
+                        temperature=0.7,
+                        system=system,
+                        messages=messages
+                    ) as stream:
+                        for text in stream.text_stream:
+                            emitted.append(text)
+                            on_text(text)
+                        return stream.get_final_message()
+
+                # Once tokens have reached the caller a retry would repeat them
+                response = self.scheduler.call(
+                    "anthropic", prompts.CLAUDE_MODEL, stream_story,
+                    input_tokens=estimate_tokens(messages, system), output_tokens=2500,
+                    can_retry=lambda: not emitted,
+                )
+            else:
+                response = self._create_message(
+                    max_tokens=2500,
+                    temperature=0.7,
+                    system=system,
+                    messages=[
+                        {"role": "user", "content": story_prompt}
+                    ]
+                )
             logger.info("Story generated successfully")
             return response.content[0].text
 
         except Exception as e:
-            logger.error(f"Unexpected error in generate_story: {str(e)}")
+            logger.error("Unexpected error in generate_story: %s", e)
             logger.error(traceback.format_exc())
             raise
 
+    @metrics.instrumented("derivative")
     def generate_derivative_story(self, original_story, visual_summary, char_style_info):
         try:
             logger.info("Starting generation of 1-minute read-aloud snippet")
-            snippet_prompt = f"""Create a captivating 1-minute read-aloud snippet based on the following story and visual summary. This snippet should hook listeners scrolling through social media, compelling them to stop and listen to the entire piece.
-
-            Original Story:
-            {original_story}
-
-            Visual Summary:
-            {visual_summary}
+            snippet_prompt = prompts.snippet_prompt(original_story, visual_summary)
 
-            Character Profile and Style:
-            {char_style_info}
+            logger.debug("1-minute snippet generation prompt: %s...", snippet_prompt[:200])
 
-            Guidelines for the 1-minute read-aloud snippet:
-            1. Start with a powerful, attention-grabbing sentence that introduces the protagonist's dilemma or the story's central conflict.
-            2. Use vivid, sensory language to quickly immerse the listener in the scene.
-            3. Maintain a cinematic first-person perspective, incorporating the character's unique voice.
-            4. Focus on a pivotal moment or decision that encapsulates the protagonist's journey.
-            5. Use short, punchy sentences interspersed with occasional longer ones for rhythm.
-            6. Incorporate one or two lines of impactful dialogue if relevant.
-            7. End with a compelling cliffhanger or thought-provoking statement that leaves the listener wanting more.
-            8. Aim for approximately 150-175 words to fit a ~1-minute read-aloud format.
-            9. Ensure the snippet feels complete enough to be satisfying, yet open-ended enough to intrigue.
-            10. Subtly showcase the protagonist's growth or internal struggle without explicitly stating it.
-            11. Use active voice and strong verbs to maintain a sense of immediacy and urgency.
-            12. Avoid any direct references to the character's original story or universe.
-
-            Create a gripping, fast-paced snippet that captures the essence of the story and character, designed to be irresistible when heard as a voice-over on social media."""
-
-            logger.debug(f"1-minute snippet generation prompt: {snippet_prompt[:200]}...")
-
-            response = self.anthropic.messages.create(
-                model="claude-3-5-sonnet-20240620",
+            response = self._create_message(
                 max_tokens=1000,
                 temperature=0.7,
+                system=prompts.character_system(char_style_info),
                 messages=[
                     {"role": "user", "content": snippet_prompt}
                 ]
@@ -216,158 +239,436 @@ class StoryGenerator:
             return response.content[0].text
 
         except Exception as e:
-            logger.error(f"Unexpected error in generate_derivative_story: {str(e)}")
+            logger.error("Unexpected error in generate_derivative_story: %s", e)
             logger.error(traceback.format_exc())
             raise
 
-    def generate_image_with_replicate(self, prompt):
+    @metrics.instrumented("fused_story")
+    def generate_fused_story(self, char_style_info, situation_setup):
         try:
-            logger.info(f"Generating image with Replicate. Prompt: {prompt[:100]}...")
-            output = replicate.run(
-                "black-forest-labs/flux-dev",  # Remove the version hash
-                input={
-                    "prompt": prompt,
-                    "num_outputs": 1,
-                    "aspect_ratio": "1:1",
-                    "guidance": 3,
-                    "num_inference_steps": 28
-                }
+            logger.info("Starting fused story, visual summary and snippet generation")
+            fused_prompt = prompts.fused_story_prompt(situation_setup)
+
+            logger.debug("Fused story prompt: %s...", fused_prompt[:200])
+
+            response = self._create_message(
+                max_tokens=4000,
+                temperature=0.7,
+                system=prompts.character_system(char_style_info),
+                tools=[prompts.STORY_TOOL],
+                tool_choice={"type": "tool", "name": prompts.STORY_TOOL["name"]},
+                messages=[
+                    {"role": "user", "content": fused_prompt}
+                ]
             )
-            image_url = output[0]
-            logger.info(f"Image generated successfully. URL: {image_url}")
-            return image_url
         except Exception as e:
-            logger.error(f"Error in generate_image_with_replicate: {str(e)}")
+            logger.error("Error in generate_fused_story: %s", e)
             logger.error(traceback.format_exc())
             raise
 
-    def extract_key_traits(self, char_style_info):
-        # Extract and summarize key traits from the character info
-        traits = []
-        if "Core personality traits" in char_style_info:
-            traits.extend(char_style_info.split("Core personality traits:")[1].split("\n")[1:4])
-        if "Basic physical characteristics" in char_style_info:
-            traits.append(char_style_info.split("Basic physical characteristics:")[1].split("\n")[1])
-        
-        # Filter out potentially problematic words
-        safe_traits = [trait for trait in traits if not any(word in trait.lower() for word in ["violent", "aggressive", "weapon", "blood", "gore", "explicit"])]
-        
-        return ", ".join(trait.strip() for trait in safe_traits if trait.strip())
+        # A ValueError here means the tool input failed validation
+        story_result = prompts.story_result_from_message(response)
+        logger.info("Fused story generated successfully")
+        return story_result
+
+    def generate_story_result(self, char_style_info, situation_setup, on_text=None, fused=None):
+        # One tool-use call for story, visual summary and snippet; if its
+        # output doesn't validate, the separate calls produce the same result
+        if self.fused if fused is None else fused:
+            try:
+                story_result = self.generate_fused_story(char_style_info, situation_setup)
+                metrics.FUSED_RESULTS.inc(result="ok")
+                return story_result
+            except ValueError as e:
+                metrics.FUSED_RESULTS.inc(result="fallback")
+                logger.warning("Fused generation failed validation, falling back to separate calls: %s", e)
+
+        full_story = self.generate_story(char_style_info, situation_setup, on_text=on_text)
+        original_story, visual_summary = self.split_story(full_story)
+        snippet = self.generate_derivative_story(original_story, visual_summary, char_style_info)
+        return prompts.StoryResult(original_story, visual_summary, snippet)
+
+    def generate_image_with_replicate(self, prompt, role="comic", profile=None):
+        try:
+            profile = profile or self.image_profile
+            spec = image_profiles.image_spec(profile, role)
+            logger.info("Generating %s %s image with %s. Prompt: %s...", profile, role, spec.model, prompt[:100])
+            started = time.perf_counter()
+            output = self.scheduler.call(
+                "replicate", spec.model,
+                lambda: self.predictions.run(spec.model, spec.input(prompt))
+            )
+            metrics.record_image(profile, role, spec.model, time.perf_counter() - started, spec.cost)
+            # Newer replicate clients return FileOutput objects rather than URL strings
+            image_url = str(output[0])
+            logger.info("Image generated successfully. URL: %s", image_url)
+            return self.mirror_image(image_url)
+        except PredictionCancelled as e:
+            # Expected when the request that wanted the image has gone away
+            logger.info("Image generation stopped: %s", e)
+            raise
+        except Exception as e:
+            logger.error("Error in generate_image_with_replicate: %s", e)
+            logger.error(traceback.format_exc())
+            raise
 
-    def generate_character_images(self, char_style_info):
+    def mirror_image(self, image_url):
+        # Replicate delivery URLs expire, so keep our own copy when we can;
+        # a failed download still leaves the story with a working link
+        if self.artifact_store is None:
+            return image_url
         try:
-            logger.info("Starting character image generation with Replicate")
+            with metrics.stage("mirror"):
+                return self.artifact_store.mirror(image_url)
+        except Exception as e:
+            logger.warning("Keeping upstream URL, mirroring failed: %s", e)
+            return image_url
 
-            # Extract key information from char_style_info
-            key_traits = self.extract_key_traits(char_style_info)
+    def generate_portrait(self, prompt, role, profile=None):
+        with metrics.stage(role):
+            spec = image_profiles.image_spec(profile or self.image_profile, role)
+            cache_key = make_cache_key(spec.model, spec.input(prompt))
 
-            # Base prompt template
-            base_prompt = """Create a tasteful, family-friendly manga-style image inspired by the art of Tsutomu Nihei. The image should be black and white, featuring a character with the following traits: {traits}
+            def render():
+                return self.generate_image_with_replicate(prompt, role, profile)
 
-            Image Specifications:
-            1. Black and white manga art style
-            2. Intricate details in clothing and background
-            3. Strong use of light and shadow
-            4. Minimal abstract background
-            5. Suitable for all audiences
+            def lookup():
+                if self.portrait_cache is None:
+                    return render()
+                return self.portrait_cache.get_or_create(cache_key, render)
 
-            The character should appear contemplative and determined, avoiding any aggressive or controversial poses or expressions."""
+            if self.portrait_flights is None:
+                return lookup()
+            return self.portrait_flights.do(cache_key, lookup)
 
-            side_profile_prompt = base_prompt.format(traits=key_traits) + """
-            Additional details:
-            - Detailed side view of the character's face and upper body
-            - Character looking thoughtfully to the side
+    def extract_key_traits(self, char_style_info):
+        return prompts.extract_key_traits(char_style_info)
 
-            Generate a single, highly detailed side profile image in a respectful and artistic style."""
+    def character_image_prompts(self, char_style_info):
+        return prompts.character_image_prompts(self.extract_key_traits(char_style_info))
 
-            headshot_prompt = base_prompt.format(traits=key_traits) + """
-            Additional details:
-            - Close-up, front-facing view of the character's face and upper shoulders
-            - Character with a calm, focused expression
+    def draft_image(self, render):
+        # A failed draft only means the final image arrives without one
+        try:
+            return render()
+        except Exception as e:
+            logger.warning("Draft image failed: %s", e)
+            return None
+
+    def generate_character_images(self, char_style_info, profile=None):
+        try:
+            logger.info("Starting character image generation with Replicate")
 
-            Generate a single, highly detailed headshot image in a respectful and artistic style."""
+            side_profile_prompt, headshot_prompt = self.character_image_prompts(char_style_info)
 
-            side_profile_url = self.generate_image_with_replicate(side_profile_prompt)
-            headshot_url = self.generate_image_with_replicate(headshot_prompt)
+            # The two portraits are independent, so render them side by side
+            results = (
+                Pipeline(max_workers=2)
+                .add_step("side_profile_url", lambda: self.generate_portrait(side_profile_prompt, "side_profile", profile))
+                .add_step("headshot_url", lambda: self.generate_portrait(headshot_prompt, "headshot", profile))
+                .run()
+            )
 
             logger.info("Character images generated successfully with Replicate")
-            return side_profile_url, headshot_url
+            return results["side_profile_url"], results["headshot_url"]
 
         except Exception as e:
-            logger.error(f"Error in generate_character_images: {str(e)}")
+            logger.error("Error in generate_character_images: %s", e)
             logger.error(traceback.format_exc())
             raise
 
+    def split_story(self, full_story):
+        return prompts.split_story(full_story)
+
+    def build_pipeline(self, protagonist_name=None, original_story=None, author=None, circumstance=None, on_story_text=None,
+                       fused=None, speculative=None, image_profile=None, progressive=False):
+        # Each step starts as soon as the steps it depends on have finished:
+        # the portraits only need the character profile, the comic only needs
+        # the story, and the snippet needs the story split from its summary.
+        pipeline = Pipeline(max_workers=self.max_workers)
+        speculative = self.speculative if speculative is None else speculative
+        image_profile = image_profile or self.image_profile
+        pipeline.add_step(
+            "char_style_info",
+            lambda: self.generate_char_style_info(protagonist_name, original_story, author))
+        pipeline.add_step(
+            "situation_setup",
+            lambda char_style_info: self.situation_setup_for(protagonist_name, circumstance, char_style_info),
+            deps=["char_style_info"])
+        if self.fused if fused is None else fused:
+            # Story, summary and snippet arrive together from one call
+            pipeline.add_step(
+                "story_result",
+                lambda char_style_info, situation_setup: self.generate_story_result(
+                    char_style_info, situation_setup, on_text=on_story_text, fused=True),
+                deps=["char_style_info", "situation_setup"])
+            pipeline.add_step(
+                "story_parts",
+                lambda story_result: story_result.story_parts,
+                deps=["story_result"])
+            pipeline.add_step(
+                "derivative_story",
+                lambda story_result: story_result.snippet,
+                deps=["story_result"])
+            if not speculative:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda story_parts: self.generate_comic(story_parts[1], image_profile),
+                    deps=["story_parts"])
+        else:
+            pipeline.add_step(
+                "full_story",
+                lambda char_style_info, situation_setup: self.generate_story(char_style_info, situation_setup, on_text=on_story_text),
+                deps=["char_style_info", "situation_setup"])
+            pipeline.add_step(
+                "story_parts",
+                lambda full_story: self.split_story(full_story),
+                deps=["full_story"])
+            pipeline.add_step(
+                "derivative_story",
+                lambda story_parts, char_style_info: self.generate_derivative_story(story_parts[0], story_parts[1], char_style_info),
+                deps=["story_parts", "char_style_info"])
+            if not speculative:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda full_story: self.generate_comic(full_story, image_profile),
+                    deps=["full_story"])
+        if speculative:
+            # The comic only waits for the situation setup, so the story call
+            # is no longer on its critical path
+            pipeline.add_step(
+                "speculative_comic_url",
+                lambda char_style_info, situation_setup: self.generate_speculative_comic(situation_setup, char_style_info,
+                                                                                         image_profile),
+                deps=["char_style_info", "situation_setup"])
+            if self.speculative_rerender_below is None:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda speculative_comic_url: self.accept_speculative_comic(speculative_comic_url),
+                    deps=["speculative_comic_url"])
+            else:
+                pipeline.add_step(
+                    "comic_url",
+                    lambda speculative_comic_url, story_parts, situation_setup, char_style_info: self.check_speculative_comic(
+                        speculative_comic_url, situation_setup, char_style_info, story_parts[1], image_profile),
+                    deps=["speculative_comic_url", "story_parts", "situation_setup", "char_style_info"])
+        pipeline.add_step(
+            "character_prompts",
+            lambda char_style_info: self.character_image_prompts(char_style_info),
+            deps=["char_style_info"])
+        pipeline.add_step(
+            "side_profile_url",
+            lambda character_prompts: self.generate_portrait(character_prompts[0], "side_profile", image_profile),
+            deps=["character_prompts"])
+        pipeline.add_step(
+            "headshot_url",
+            lambda character_prompts: self.generate_portrait(character_prompts[1], "headshot", image_profile),
+            deps=["character_prompts"])
+        if progressive:
+            # Quick drafts of the same images, to show until the real ones
+            # arrive; none for an image the profile renders as fast anyway
+            draft = image_profiles.DRAFT_PROFILE
+            if image_profiles.drafts_faster(image_profile, "comic") and speculative:
+                pipeline.add_step(
+                    "comic_draft_url",
+                    lambda char_style_info, situation_setup: self.draft_image(
+                        lambda: self.generate_speculative_comic(situation_setup, char_style_info, draft)),
+                    deps=["char_style_info", "situation_setup"])
+            elif image_profiles.drafts_faster(image_profile, "comic"):
+                pipeline.add_step(
+                    "comic_draft_url",
+                    lambda story_parts: self.draft_image(lambda: self.generate_comic(story_parts[1], draft)),
+                    deps=["story_parts"])
+            if image_profiles.drafts_faster(image_profile, "side_profile"):
+                pipeline.add_step(
+                    "side_profile_draft_url",
+                    lambda character_prompts: self.draft_image(
+                        lambda: self.generate_portrait(character_prompts[0], "side_profile", draft)),
+                    deps=["character_prompts"])
+            if image_profiles.drafts_faster(image_profile, "headshot"):
+                pipeline.add_step(
+                    "headshot_draft_url",
+                    lambda character_prompts: self.draft_image(
+                        lambda: self.generate_portrait(character_prompts[1], "headshot", draft)),
+                    deps=["character_prompts"])
+        return pipeline
+
+    def stored_character_artifacts(self, protagonist_name, image_profile=None):
+        # Profiles and portraits precomputed by warmup.py; whatever is found
+        # here is fed into the pipeline as already-finished steps
+        if self.character_store is None:
+            return {}
+        record = self.character_store.get(protagonist_name, image_profile or self.image_profile) or {}
+        metrics.record_cache("character_store", bool(record))
+        artifacts = {name: record[name] for name in ("char_style_info", "side_profile_url", "headshot_url") if name in record}
+        if artifacts:
+            logger.info("Using stored %s for %s", ', '.join(artifacts), protagonist_name)
+        return artifacts
+
+    def situation_setup_for(self, protagonist_name, circumstance, char_style_info):
+        # Near-identical circumstances for the same protagonist share a setup
+        cache = self.circumstance_cache
+        if cache is None or cache.mode != "situation" or protagonist_name is None:
+            return self.generate_situation_setup(circumstance, char_style_info)
+        situation_setup = cache.lookup(protagonist_name, circumstance)
+        if situation_setup is None:
+            situation_setup = self.generate_situation_setup(circumstance, char_style_info)
+            cache.store(protagonist_name, circumstance, situation_setup)
+        return situation_setup
+
+    def cached_story(self, protagonist_name, circumstance, fused, image_profile):
+        # Stories rendered another way (fused, or with another image
+        # profile) are kept apart, as they are when coalescing
+        if self.circumstance_cache is None or self.circumstance_cache.mode != "story":
+            return None
+        return self.circumstance_cache.lookup(protagonist_name, circumstance, variant=(fused, image_profile))
+
+    def generate_all(self, protagonist_name, original_story, author, circumstance, on_result=None, on_story_text=None, on_start=None,
+                     fused=None, speculative=None, coalesce=False, variety=None, image_profile=None, progressive=False,
+                     on_finish=None):
+        """With `coalesce`, a call identical to one already running waits
+        for that one's results (and callbacks) instead of starting its own.
+        Calls with a different `variety`, e.g. a user id, are never merged,
+        and neither are calls that stream the story text with ones that
+        don't, since streaming gives up on retries.
+
+        `on_finish(results)` is called once the results are complete, and
+        whatever it returns (e.g. an archive id) is added to them. Coalesced
+        calls share the first caller's, so it runs once for all of them.
+
+        `image_profile` names the image_profiles.PROFILES entry to render
+        with; with `progressive`, draft renders of each image are reported
+        to on_result (as DRAFT_OUTPUTS, None if one failed) before the
+        final ones."""
+        try:
+            logger.info("Starting full generation pipeline for %s", protagonist_name)
+            fused = self.fused if fused is None else fused
+            image_profile = image_profile or self.image_profile
+            cached = self.cached_story(protagonist_name, circumstance, fused, image_profile)
+            if cached is not None:
+                if on_result is not None:
+                    for name in OUTPUTS:
+                        on_result(name, cached[name])
+                return self.finish(dict(cached, visual_summary=cached["story_parts"][1]), on_finish)
+
+            if coalesce:
+                speculative = self.speculative if speculative is None else speculative
+                key = make_cache_key("generate_all", [protagonist_name, original_story, author, circumstance],
+                                     fused=fused, speculative=speculative, variety=variety, image_profile=image_profile,
+                                     progressive=progressive, streaming=on_story_text is not None)
+                callbacks = {"on_result": on_result, "on_start": on_start}
+                if on_story_text is not None:
+                    callbacks["on_story_text"] = on_story_text
+                return self.request_flights.run(
+                    key,
+                    lambda **callbacks: self.generate_all(protagonist_name, original_story, author, circumstance,
+                                                          fused=fused, speculative=speculative,
+                                                          image_profile=image_profile, progressive=progressive,
+                                                          on_finish=on_finish, **callbacks),
+                    **callbacks)
+
+            stored = self.stored_character_artifacts(protagonist_name, image_profile)
+            if on_result is not None:
+                for name, value in stored.items():
+                    on_result(name, value)
+
+            pipeline = self.build_pipeline(protagonist_name, original_story, author, circumstance, on_story_text=on_story_text,
+                                           fused=fused, speculative=speculative, image_profile=image_profile,
+                                           progressive=progressive)
+            outputs = list(OUTPUTS)
+            if progressive:
+                # No draft for an image that is already stored
+                outputs += [DRAFT_OUTPUTS[name] for name in DRAFT_OUTPUTS
+                            if name not in stored and DRAFT_OUTPUTS[name] in pipeline.steps]
+            results = pipeline.run(
+                inputs=stored,
+                outputs=outputs,
+                on_result=on_result,
+                on_start=on_start,
+            )
+            if self.circumstance_cache is not None and self.circumstance_cache.mode == "story":
+                self.circumstance_cache.store(protagonist_name, circumstance, {name: results[name] for name in OUTPUTS},
+                                              variant=(fused, image_profile))
+            results["visual_summary"] = results["story_parts"][1]
+            logger.info("Full generation pipeline finished")
+            return self.finish(results, on_finish)
+        except Exception as e:
+            logger.error("Error in generate_all: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    @staticmethod
+    def finish(results, on_finish):
+        if on_finish is not None:
+            results.update(on_finish(results) or {})
+        return results
+
     def generate_story_and_images(self, char_style_info, situation_setup, author):
         try:
             logger.info("Starting story and image generation")
             
-            # Generate the original story with visual summary
-            full_story = self.generate_story(char_style_info, situation_setup, author)
-            
-            # Split the story and visual summary
-            story_parts = full_story.split("VISUAL SUMMARY:")
-            original_story = story_parts[0].strip()
-            visual_summary = "VISUAL SUMMARY:" + story_parts[1].strip() if len(story_parts) > 1 else ""
-            
-            # Generate the derivative story
-            derivative_story = self.generate_derivative_story(original_story, visual_summary, char_style_info)
-            
-            # Generate the comic image
-            comic_url = self.generate_comic(full_story)
-            
-            # Generate character images
-            side_profile_url, headshot_url = self.generate_character_images(char_style_info)
+            results = self.build_pipeline(author=author).run(
+                inputs={"char_style_info": char_style_info, "situation_setup": situation_setup}
+            )
+            comic_url = results["comic_url"]
+            derivative_story = results["derivative_story"]
+            visual_summary = results["story_parts"][1]
+            side_profile_url = results["side_profile_url"]
+            headshot_url = results["headshot_url"]
             
             return comic_url, derivative_story, visual_summary, side_profile_url, headshot_url
         except Exception as e:
-            logger.error(f"Error in generate_story_and_images: {str(e)}")
+            logger.error("Error in generate_story_and_images: %s", e)
             logger.error(traceback.format_exc())
             raise
 
-    def generate_comic(self, story):
+    @metrics.instrumented("comic")
+    def generate_comic(self, story, profile=None):
         try:
             logger.info("Starting comic generation with Replicate")
 
-            visual_summary_start = story.find("VISUAL SUMMARY:")
-            visual_summary = story[visual_summary_start:].strip() if visual_summary_start != -1 else ""
-
-            prompt = f"""Create a single, family-friendly manga-style image image in the style of Tsutomu Nihei, inspired by this story concept and visual summary:
-
-            {visual_summary}
-
-            Image Specifications:
-            1. Style: Black and white manga art style inspired by Tsutomu Nihei's work, known for:
-               - Intricate, highly detailed architectural and mechanical designs
-               - Vast, often dystopian or post-apocalyptic settings
-               - Stark contrast between black and white elements
-               - Complex, biomechanical aesthetics
-            2. Composition: A single, full-page image that captures the essence of the story
-            3. Character Design: Create a protagonist based on the description, fitting Nihei's style:
-               - Intricate, often utilitarian or biomechanical outfits
-               - Stoic or intense expressions
-               - Integration with the surrounding environment
-            4. Setting: Develop a detailed, immersive background that reflects the story's setting:
-               - Vast, labyrinthine structures or cityscapes
-               - Blend of organic and mechanical elements
-               - Use of perspective to create a sense of scale and depth
-            5. Visual Storytelling: 
-               - Incorporate the key object and action described in the visual summary
-               - Use visual metaphors or symbolic elements to convey the story's essence
-               - Create a sense of action or tension through character positioning and environmental details
-            6. Lighting and Texture:
-               - Employ strong contrasts between light and shadow
-               - Use intricate textures and patterns to add depth and detail
-               - Create a mood that reflects the story's described atmosphere
-            7. NO TEXT: Do not include any speech bubbles, captions, or written elements of any kind.
-
-            Generate a single, highly detailed image that captures the essence of the story in Tsutomu Nihei's distinctive style, while accurately representing the specific elements described in the visual summary."""
-
-            comic_url = self.generate_image_with_replicate(prompt)
+            visual_summary = prompts.comic_visual_summary(story)
+
+            prompt = prompts.comic_prompt(visual_summary)
+
+            comic_url = self.generate_image_with_replicate(prompt, "comic", profile)
             logger.info("Comic image generated successfully with Replicate")
             return comic_url
 
         except Exception as e:
-            logger.error(f"Error in generate_comic: {str(e)}")
+            logger.error("Error in generate_comic: %s", e)
             logger.error(traceback.format_exc())
-            raise
\ No newline at end of file
+            raise
+
+    def speculative_visual_summary(self, situation_setup, char_style_info):
+        return prompts.speculative_visual_summary(situation_setup, self.extract_key_traits(char_style_info))
+
+    @metrics.instrumented("speculative_comic")
+    def generate_speculative_comic(self, situation_setup, char_style_info, profile=None):
+        try:
+            logger.info("Starting speculative comic generation from the situation setup")
+            prompt = prompts.comic_prompt(self.speculative_visual_summary(situation_setup, char_style_info))
+            comic_url = self.generate_image_with_replicate(prompt, "comic", profile)
+            logger.info("Speculative comic image generated successfully with Replicate")
+            return comic_url
+
+        except Exception as e:
+            logger.error("Error in generate_speculative_comic: %s", e)
+            logger.error(traceback.format_exc())
+            raise
+
+    def accept_speculative_comic(self, speculative_comic_url):
+        metrics.SPECULATIVE_COMICS.inc(result="unchecked")
+        return speculative_comic_url
+
+    def check_speculative_comic(self, speculative_comic_url, situation_setup, char_style_info, visual_summary, profile=None):
+        similarity = self.summary_vectorizer.similarity(
+            self.speculative_visual_summary(situation_setup, char_style_info), visual_summary)
+        metrics.SPECULATIVE_SIMILARITY.observe(similarity)
+        if similarity >= self.speculative_rerender_below:
+            metrics.SPECULATIVE_COMICS.inc(result="kept")
+            return speculative_comic_url
+        logger.info("Re-rendering comic from the story, speculative summary similarity %.2f is below %s",
+                    similarity, self.speculative_rerender_below)
+        metrics.SPECULATIVE_COMICS.inc(result="rerendered")
+        return self.generate_comic(visual_summary, profile)
@@ -0,0 +1,91 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+import main
+from bench.fake_backends import fake_anthropic, fake_replicate
+
+
+@pytest.fixture
+def replicate_latency():
+    return "fixed:0.05"
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch, replicate_latency):
+    anthropic_backend = fake_anthropic(latency="fixed:0.02").start()
+    replicate_backend = fake_replicate(latency=replicate_latency).start()
+    monkeypatch.chdir(tmp_path)
+    for name, value in {"ANTHROPIC_API_KEY": "test", "ANTHROPIC_BASE_URL": anthropic_backend.url,
+                        "REPLICATE_API_TOKEN": "test", "REPLICATE_BASE_URL": replicate_backend.url,
+                        "PREDICTION_POLL_INTERVAL": "0.02", "ARTIFACT_STORE_PATH": "",
+                        "STORY_ARCHIVE_PATH": str(tmp_path / "stories.db")}.items():
+        monkeypatch.setenv(name, value)
+    yield main.create_app().test_client()
+    anthropic_backend.stop()
+    replicate_backend.stop()
+
+
+def test_stream_sends_each_artifact_as_a_line_and_ends_with_done(client):
+    protagonist = main.protagonists[0]["Protagonist"]
+    response = client.post("/generate/stream", data={"protagonist": protagonist, "circumstance": "lost the keys"})
+    assert response.mimetype == "application/x-ndjson"
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    names = [event["event"] for event in events]
+    assert names[-1] == "done" and "error" not in names
+    for name in ("character_profile", "situation", "story", "visual_summary", "snippet", "comic_url"):
+        assert name in names
+    # Each artifact is sent once it exists, not in one lump at the end
+    assert names.index("situation") < names.index("story") < names.index("comic_url")
+    assert events[-1]["data"]["story_id"]
+
+
+def test_stream_rejects_unknown_protagonists(client):
+    response = client.post("/generate/stream", data={"protagonist": "Nobody", "circumstance": "x"})
+    assert response.status_code == 400
+
+
+def test_generate_returns_its_trace_on_request_and_metrics_count_it(client):
+    protagonist = main.protagonists[0]["Protagonist"]
+    response = client.post("/generate?trace=1", data={"protagonist": protagonist, "circumstance": "lost the keys"},
+                           headers={"X-Request-ID": "request-1"})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["trace_id"] == "request-1" and body["usage"]["input_tokens"] > 0
+    assert {"char_style", "story", "comic"} <= {stage["stage"] for stage in body["trace"]["stages"]}
+    assert 'story_request_duration_seconds_count{route="/generate"}' in client.get("/metrics").get_data(as_text=True)
+
+
+def test_creating_the_app_does_not_load_the_provider_sdks(tmp_path):
+    script = "import sys, main; main.create_app(); print(sorted({'anthropic', 'replicate'} & set(sys.modules)))"
+    env = dict(os.environ, ANTHROPIC_API_KEY="test", REPLICATE_API_TOKEN="test", ARTIFACT_STORE_PATH="",
+               STORY_ARCHIVE_PATH="", PYTHONPATH=os.pathsep.join(filter(None, [
+                   os.path.dirname(os.path.abspath(__file__)), os.environ.get("PYTHONPATH")])))
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.strip().splitlines()[-1] == "[]"
+
+
+def test_ready_reports_whether_the_clients_are_warm(client):
+    assert client.get("/ready").get_json() == {"ready": True, "warm": False}
+    assert client.get("/ready?warm=1").get_json() == {"ready": True, "warm": True}
+
+
+# Slow enough that the 4-step draft beats the 40-step hero render by far
+# more than a poll interval
+@pytest.mark.parametrize("replicate_latency", ["fixed:0.5"])
+def test_progressive_stream_sends_a_draft_comic_before_the_final_one(client):
+    protagonist = main.protagonists[0]["Protagonist"]
+    response = client.post("/generate/stream?progressive=1&image_profile=hero",
+                           data={"protagonist": protagonist, "circumstance": "lost the keys"})
+    names = [json.loads(line)["event"] for line in response.get_data(as_text=True).splitlines()]
+    assert names.index("comic_preview") < names.index("comic_url")
+
+
+def test_unknown_image_profiles_are_rejected(client):
+    protagonist = main.protagonists[0]["Protagonist"]
+    response = client.post("/generate?image_profile=poster", data={"protagonist": protagonist, "circumstance": "x"})
+    assert response.status_code == 400
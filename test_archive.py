@@ -0,0 +1,80 @@
+import pytest
+
+import main
+from archive import MAX_PAGE_SIZE, StoryArchive
+
+RESULTS = {"story_parts": ["The keys were in the fridge.", "VISUAL SUMMARY"], "derivative_story": "Fridge.",
+           "comic_url": "https://example.com/comic.png"}
+
+
+@pytest.fixture
+def archive(tmp_path):
+    return StoryArchive(str(tmp_path / "stories.db"))
+
+
+def test_saved_stories_can_be_read_back(archive):
+    story_id = archive.save("Ada", "lost the keys", RESULTS, trace={"stages": []})
+    story = archive.get(story_id)
+    assert story["story"] == "The keys were in the fridge."
+    assert story["trace"] == {"stages": []}
+
+
+def test_pages_follow_the_cursor_newest_first(archive):
+    ids = [archive.save("Ada", f"circumstance {i}", RESULTS) for i in range(5)]
+    first = archive.list(limit=3)
+    second = archive.list(limit=3, cursor=first["next_cursor"])
+    assert [story["id"] for story in first["stories"] + second["stories"]] == ids[::-1]
+    assert second["next_cursor"] is None
+
+
+@pytest.mark.parametrize("limit, expected", [(0, 1), (-5, 1), (MAX_PAGE_SIZE + 50, MAX_PAGE_SIZE)])
+def test_limits_are_clamped(archive, limit, expected):
+    for i in range(MAX_PAGE_SIZE + 1):
+        archive.save("Ada", f"circumstance {i}", RESULTS)
+    assert len(archive.list(limit=limit)["stories"]) == expected
+    assert len(archive.search("fridge", limit=limit, offset=-1)["stories"]) == expected
+
+
+def test_exact_repeats_ignore_case_and_spacing(archive):
+    archive.save("Ada", "Lost  the keys", RESULTS)
+    archive.save("Ada", "lost the car", RESULTS)
+    archive.save("Bob", "lost the keys", RESULTS)
+    stories = archive.list(protagonist="Ada", circumstance="lost the KEYS")["stories"]
+    assert [story["circumstance"] for story in stories] == ["Lost  the keys"]
+
+
+def test_search_treats_queries_as_plain_words(archive):
+    archive.save("Ada", "lost the keys", RESULTS)
+    found = archive.search('fridge" OR')
+    assert found["total"] == 0
+    found = archive.search("fridge")
+    assert found["total"] == 1 and "[" in found["stories"][0]["excerpt"]
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name, value in {"ANTHROPIC_API_KEY": "test", "REPLICATE_API_TOKEN": "test", "ARTIFACT_STORE_PATH": "",
+                        "STORY_ARCHIVE_PATH": str(tmp_path / "stories.db")}.items():
+        monkeypatch.setenv(name, value)
+    return main.create_app().test_client()
+
+
+@pytest.mark.parametrize("url, status", [
+    ("/stories?limit=0", 200),
+    ("/stories?limit=-3", 200),
+    ("/stories?limit=ten", 400),
+    ("/stories?cursor=nonsense", 400),
+    ("/stories/search?q=keys&limit=0", 200),
+    ("/stories/search?q=keys&offset=ten", 400),
+])
+def test_story_routes_clamp_limits_and_reject_bad_input(client, url, status):
+    assert client.get(url).status_code == status
+
+
+def test_permalinks_serve_archived_stories_with_a_long_cache_lifetime(client):
+    story_id = client.application.extensions["story"].story_archive.save("Ada", "lost the keys", RESULTS)
+    response = client.get(f"/stories/{story_id}")
+    assert response.get_json()["circumstance"] == "lost the keys"
+    assert response.headers["Cache-Control"] == "public, max-age=86400"
+    assert client.get("/stories/unknown").status_code == 404
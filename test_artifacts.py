@@ -0,0 +1,33 @@
+import pytest
+
+from artifacts import ArtifactStore
+from bench.fake_backends import fake_replicate
+
+
+@pytest.fixture
+def image_url():
+    backend = fake_replicate().start()
+    yield f"{backend.url}/outputs/first.png"
+    backend.stop()
+
+
+def test_identical_images_are_stored_once_under_their_hash(tmp_path, image_url):
+    store = ArtifactStore(tmp_path, thumbnail_sizes=(4,))
+    url = store.mirror(image_url)
+    assert store.mirror(image_url.replace("first", "second")) == url
+    name = url.rsplit("/", 1)[-1]
+    assert url == f"/artifacts/{name}"
+    assert store.resolve(name).read_bytes()[:4] == b"\x89PNG"
+    assert store.resolve(name.replace(".png", "_4.webp")).exists()
+
+
+def test_oversized_images_are_refused_and_leave_nothing_behind(tmp_path, image_url):
+    store = ArtifactStore(tmp_path, max_bytes=10)
+    with pytest.raises(ValueError, match="larger than 10 bytes"):
+        store.mirror(image_url)
+    assert not [path for path in tmp_path.rglob("*") if path.is_file()]
+
+
+@pytest.mark.parametrize("name", ["../secret.png", "a" * 64 + ".gif", "a" * 64 + "_999.webp", "a" * 64 + ".png"])
+def test_only_stored_names_and_configured_sizes_resolve(tmp_path, name):
+    assert ArtifactStore(tmp_path, thumbnail_sizes=(256,)).resolve(name) is None
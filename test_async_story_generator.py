@@ -0,0 +1,73 @@
+import asyncio
+
+import pytest
+import replicate
+
+from async_story_generator import AsyncStoryGenerator
+from bench.fake_backends import fake_anthropic, fake_replicate
+from predictions import PredictionManager
+from scheduler import Scheduler
+
+
+@pytest.fixture
+def backends(monkeypatch):
+    anthropic_backend = fake_anthropic(latency="fixed:0.02").start()
+    replicate_backend = fake_replicate(latency="fixed:0.05").start()
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", anthropic_backend.url)
+    monkeypatch.setenv("REPLICATE_API_TOKEN", "test")
+    yield anthropic_backend, replicate_backend
+    anthropic_backend.stop()
+    replicate_backend.stop()
+
+
+def generate(replicate_backend, calls, prepare=None, **options):
+    async def main():
+        client = replicate.Client(api_token="test", base_url=replicate_backend.url)
+        generator = AsyncStoryGenerator(scheduler=Scheduler(), **options,
+                                        predictions=PredictionManager(client, poll_interval=0.02, tick=0.02))
+        if prepare is not None:
+            prepare(generator)
+        try:
+            return await asyncio.gather(*(generator.generate_all(*call["args"], **call.get("kwargs", {}))
+                                          for call in calls))
+        finally:
+            await generator.aclose()
+    return asyncio.run(main())
+
+
+def test_generate_all_streams_the_story_and_returns_every_artifact(backends):
+    _, replicate_backend = backends
+    deltas, started = [], []
+    [results] = generate(replicate_backend, [{
+        "args": ("Ada", "A Story", "An Author", "lost the keys"),
+        "kwargs": {"on_story_text": deltas.append, "on_start": started.append},
+    }])
+    assert results["story_parts"][0].strip() in "".join(deltas)
+    for name in ("char_style_info", "situation_setup", "derivative_story", "comic_url", "headshot_url"):
+        assert results[name]
+    assert results["comic_url"].startswith(replicate_backend.url)
+    assert started.index("situation_setup") < started.index("comic_url")
+
+
+def test_concurrent_generations_stay_within_the_anthropic_limit(backends):
+    _, replicate_backend = backends
+    in_flight, peak = [0], [0]
+
+    def prepare(generator):
+        messages = generator.anthropic.beta.prompt_caching.messages
+        create = messages.create
+
+        async def counted(**params):
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+            try:
+                return await create(**params)
+            finally:
+                in_flight[0] -= 1
+        messages.create = counted
+
+    calls = [{"args": ("Ada", "A Story", "An Author", f"lost the keys {i}")} for i in range(4)]
+    results = generate(replicate_backend, calls, prepare, anthropic_concurrency=2)
+    assert all(result["comic_url"] for result in results)
+    assert peak[0] == 2
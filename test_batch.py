@@ -0,0 +1,65 @@
+import threading
+import time
+
+import pytest
+
+from batch import BatchManager, BatchRunner
+
+PROTAGONISTS = [{"Protagonist": "Ada", "Original Story": "A Story", "Author": "An Author"}]
+
+
+@pytest.mark.parametrize("items, message", [
+    ("Ada", "list of objects"),
+    (["Ada"], "list of objects"),
+    ([{"protagonist": "Ada", "circumstance": "x"}, None], "list of objects"),
+    ([{"protagonist": "Bob", "circumstance": "x"}], "Unknown protagonists: Bob"),
+    ([{"protagonist": "Ada"}], "needs a circumstance"),
+    ([{"protagonist": "Ada", "circumstance": ""}], "needs a circumstance"),
+])
+def test_validate_rejects_bad_items(items, message):
+    with pytest.raises(ValueError, match=message):
+        BatchRunner(None, PROTAGONISTS).validate(items)
+
+
+def test_validate_rejects_unknown_image_profile():
+    with pytest.raises(ValueError, match="Unknown image profile"):
+        BatchRunner(None, PROTAGONISTS, image_profile="poster").validate([{"protagonist": "Ada", "circumstance": "x"}])
+
+
+def test_validate_accepts_good_items():
+    BatchRunner(None, PROTAGONISTS, image_profile="draft").validate([{"protagonist": "Ada", "circumstance": "x"}])
+
+
+def test_finished_batches_are_evicted_after_ttl(tmp_path):
+    manager = BatchManager(None, PROTAGONISTS, tmp_path, finished_ttl=60)
+    manager.batches = {
+        "old": {"status": "finished", "runner": BatchRunner(None, PROTAGONISTS), "total": 1, "error": None,
+                "created_at": 0.0, "finished_at": 1.0},
+        "running": {"status": "running", "runner": BatchRunner(None, PROTAGONISTS), "total": 1, "error": None,
+                    "created_at": 0.0, "finished_at": None},
+    }
+    assert manager.get("old") is None
+    assert manager.get("running")["status"] == "running"
+
+
+def test_batches_beyond_max_batches_wait_their_turn(tmp_path, monkeypatch):
+    running, peak = [], []
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def run(self, items, output):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        release.wait(5)
+        with lock:
+            running.pop()
+    monkeypatch.setattr(BatchRunner, "run", run)
+    manager = BatchManager(None, PROTAGONISTS, tmp_path, max_batches=2)
+    batch_ids = [manager.submit([{"protagonist": "Ada", "circumstance": "x"}]) for _ in range(5)]
+    time.sleep(0.1)
+    assert sorted(manager.get(batch_id)["status"] for batch_id in batch_ids) == ["queued"] * 3 + ["running"] * 2
+    release.set()
+    manager.executor.shutdown(wait=True)
+    assert max(peak) == 2
+    assert all(manager.get(batch_id)["status"] == "finished" for batch_id in batch_ids)
@@ -0,0 +1,58 @@
+from cache import MemoryTier, ResponseCache, SQLiteTier, make_cache_key
+
+
+def test_key_is_stable_and_ignores_argument_order():
+    key = make_cache_key("model", "prompt", max_tokens=1000, temperature=0.5)
+    assert key == make_cache_key("model", "prompt", temperature=0.5, max_tokens=1000)
+    assert len(key) == 64
+
+
+def test_nested_prompts_are_keyed_by_content():
+    messages = [{"role": "user", "content": "hi"}]
+    assert make_cache_key("model", messages) == make_cache_key("model", [{"content": "hi", "role": "user"}])
+
+
+def test_any_difference_changes_the_key():
+    key = make_cache_key("model", "prompt", max_tokens=1000)
+    assert key != make_cache_key("other", "prompt", max_tokens=1000)
+    assert key != make_cache_key("model", "prompt ", max_tokens=1000)
+    assert key != make_cache_key("model", "prompt", max_tokens=1001)
+    assert key != make_cache_key("model", "prompt")
+
+
+def test_get_or_create_creates_once_and_counts_lookups():
+    cache = ResponseCache()
+    calls = []
+
+    def create():
+        calls.append(1)
+        return "profile"
+    assert cache.get_or_create("key", create) == "profile"
+    assert cache.get_or_create("key", create) == "profile"
+    assert len(calls) == 1
+    assert cache.stats()["keys"] == {"key": {"hits": 1, "misses": 1}}
+
+
+def test_persistent_tier_survives_a_restart(tmp_path):
+    path = str(tmp_path / "profiles.db")
+    ResponseCache(persistent=SQLiteTier(path)).set("key", {"profile": "Ada"})
+    assert ResponseCache(persistent=SQLiteTier(path)).get("key") == {"profile": "Ada"}
+
+
+def test_variants_fill_a_pool_before_any_hit():
+    cache = ResponseCache(variants=2)
+    cache.set("key", "first")
+    assert cache.get("key") is None
+    cache.set("key", "second")
+    assert cache.get("key") in ("first", "second")
+
+
+def test_memory_tier_drops_least_recently_used_and_expired_entries():
+    tier = MemoryTier(max_entries=2)
+    tier.set("a", 1)
+    tier.set("b", 2)
+    tier.get("a")
+    tier.set("c", 3)
+    assert (tier.get("a"), tier.get("b"), tier.get("c")) == (1, None, 3)
+    tier.set("d", 4, ttl=-1)
+    assert tier.get("d") is None
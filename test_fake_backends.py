@@ -0,0 +1,56 @@
+import json
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+
+from bench.fake_backends import fake_anthropic, fake_replicate, parse_latency
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"}, method="POST")
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return json.loads(response.read())
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.loads(response.read())
+
+
+@pytest.mark.parametrize("spec", ["fixed:2", "uniform:1,3", "lognormal:2,0.5"])
+def test_latency_specs(spec):
+    assert parse_latency(spec)() > 0
+
+
+def test_unknown_latency_spec_is_rejected():
+    with pytest.raises(ValueError, match="Unknown latency distribution"):
+        parse_latency("gamma:1")
+
+
+def test_rate_limited_requests_carry_retry_after():
+    backend = fake_anthropic(latency="fixed:0", rate_limit_rate=1.0, retry_after=2.0).start()
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post(f"{backend.url}/v1/messages", {"messages": [], "max_tokens": 10})
+    finally:
+        backend.stop()
+    assert error.value.code == 429
+    assert error.value.headers["Retry-After"] == "2.0"
+    assert backend.behaviour.counts == {"requests": 1, "errors": 0, "rate_limited": 1, "webhooks": 0}
+
+
+def test_predictions_start_and_succeed_after_their_latency():
+    backend = fake_replicate(latency="fixed:0.1").start()
+    try:
+        prediction = post(f"{backend.url}/v1/models/owner/model/predictions", {"input": {"prompt": "x"}})
+        assert prediction["status"] == "starting"
+        time.sleep(0.15)
+        prediction = get(prediction["urls"]["get"])
+        with urllib.request.urlopen(prediction["output"][0], timeout=5) as image:
+            assert image.headers["Content-Type"] == "image/png"
+    finally:
+        backend.stop()
+    assert prediction["status"] == "succeeded"
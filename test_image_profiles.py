@@ -0,0 +1,29 @@
+import pytest
+
+import image_profiles
+
+
+def test_every_profile_covers_every_role():
+    for profile in image_profiles.PROFILES.values():
+        assert set(profile) == set(image_profiles.ROLES)
+
+
+def test_unset_options_are_left_to_the_model():
+    params = image_profiles.image_spec("standard", "comic").input("a lighthouse")
+    assert params == {"prompt": "a lighthouse", "num_outputs": 1, "aspect_ratio": "1:1", "num_inference_steps": 28,
+                      "guidance": 3}
+
+
+@pytest.mark.parametrize("profile, role, faster", [
+    ("draft", "comic", False),
+    ("standard", "headshot", False),
+    ("standard", "comic", True),
+    ("hero", "side_profile", True),
+])
+def test_drafts_only_when_they_arrive_sooner(profile, role, faster):
+    assert image_profiles.drafts_faster(profile, role) is faster
+
+
+def test_unknown_profiles_are_rejected():
+    with pytest.raises(ValueError, match="Unknown image profile: poster"):
+        image_profiles.image_spec("poster", "comic")
@@ -0,0 +1,91 @@
+import queue
+import time
+
+import pytest
+
+import metrics
+from jobs import FAILED, QUEUED, RUNNING, SUCCEEDED, Job, JobManager, QueueFullError, SQLiteJobStore
+from pipeline import Pipeline
+
+PROTAGONISTS = [{"Protagonist": "Ada", "Original Story": "A Story", "Author": "An Author"}]
+
+
+class StubGenerator:
+    """Stands in for StoryGenerator: a two-step pipeline, no upstream calls."""
+
+    def build_pipeline(self, image_profile=None):
+        pipeline = Pipeline()
+        pipeline.add_step("char_style_info", lambda: "profile")
+        pipeline.add_step("comic_url", lambda char_style_info: "https://example.com/comic.png",
+                          deps=["char_style_info"])
+        pipeline.add_step("headshot_url", lambda char_style_info: "https://example.com/headshot.png",
+                          deps=["char_style_info"])
+        return pipeline
+
+    def generate_all(self, protagonist_name, original_story, author, circumstance, on_result=None, on_start=None,
+                     image_profile=None, on_finish=None):
+        # As if the headshot had been stored already
+        results = self.build_pipeline().run(inputs={"headshot_url": "https://example.com/stored.png"},
+                                            outputs=["comic_url", "headshot_url"],
+                                            on_result=on_result, on_start=on_start)
+        if on_finish is not None:
+            results.update(on_finish(results) or {})
+        return results
+
+
+def wait_for_status(manager, job_id, status, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while manager.get(job_id).status != status:
+        assert time.monotonic() < deadline, manager.get(job_id).to_dict()
+        time.sleep(0.01)
+    return manager.get(job_id)
+
+
+def test_job_stages_follow_the_pipeline():
+    manager = JobManager(StubGenerator(), PROTAGONISTS, workers=1)
+    job = manager.submit("Ada", "lost the keys")
+    assert list(job.stages) == ["char_style_info", "comic_url", "headshot_url"]
+    job = wait_for_status(manager, job.id, SUCCEEDED)
+    assert job.stages == {"char_style_info": "done", "comic_url": "done", "headshot_url": "skipped"}
+    assert job.result["comic_url"] == "https://example.com/comic.png"
+
+
+def test_unfinished_jobs_are_recovered_on_startup(tmp_path):
+    store = SQLiteJobStore(str(tmp_path / "jobs.db"))
+    queued = Job({"protagonist": "Ada", "circumstance": "a", "image_profile": None}, status=QUEUED)
+    running = Job({"protagonist": "Ada", "circumstance": "b", "image_profile": None}, status=RUNNING)
+    store.save(queued)
+    store.save(running)
+
+    manager = JobManager(StubGenerator(), PROTAGONISTS, store=store, workers=1)
+    assert wait_for_status(manager, queued.id, SUCCEEDED)
+    interrupted = manager.get(running.id)
+    assert interrupted.status == FAILED
+    assert interrupted.error == "Interrupted by a restart"
+    assert store.unfinished() == []
+
+
+def test_finished_jobs_are_archived_with_their_trace():
+    archived = []
+
+    def archiver(protagonist, circumstance):
+        def on_finish(results):
+            archived.append((protagonist, circumstance, metrics.current_trace()))
+            return {"story_id": "story-1"}
+        return on_finish
+
+    manager = JobManager(StubGenerator(), PROTAGONISTS, workers=1, archiver=archiver)
+    job = wait_for_status(manager, manager.submit("Ada", "lost the keys").id, SUCCEEDED)
+    assert job.result["story_id"] == "story-1"
+    [(protagonist, circumstance, trace)] = archived
+    assert (protagonist, circumstance) == ("Ada", "lost the keys")
+    assert trace is not None and trace.id == job.id
+
+
+def test_a_full_queue_refuses_the_job_and_forgets_it():
+    manager = JobManager(StubGenerator(), PROTAGONISTS, workers=0, max_queue=1)
+    manager.submit("Ada", "a")
+    with pytest.raises(QueueFullError) as refused:
+        manager.submit("Ada", "b")
+    assert isinstance(refused.value.__cause__, queue.Full)
+    assert len(manager.store.jobs) == 1
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+import metrics
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("test_seconds", "Test", labelnames=("stage",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value, stage="story")
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="story",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="story",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="story",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="story"} 3' in lines
+
+
+def test_label_values_are_escaped():
+    counter = metrics.Counter("test_total", "Test", labelnames=("stage",))
+    counter.inc(stage='say "hi"\n')
+    assert counter.render()[-1] == 'test_total{stage="say \\"hi\\"\\n"} 1'
+
+
+@pytest.fixture
+def trace():
+    yield metrics.start_trace()
+    metrics.set_trace(None)
+
+
+def test_upstream_usage_is_attributed_to_the_current_stage(trace):
+    with metrics.stage("story"):
+        metrics.record_upstream("anthropic", 0.5, 1.5, 1, SimpleNamespace(input_tokens=100, output_tokens=20,
+                                                                          cache_read_input_tokens=80))
+    with pytest.raises(ValueError), metrics.stage("comic"):
+        raise ValueError("upstream")
+    result = trace.to_dict()
+    story, comic = result["stages"]
+    assert (story["stage"], story["queue_wait"], story["retries"]) == ("story", 0.5, 1)
+    assert comic["error"] == "upstream"
+    assert result["usage"]["input_tokens"] == 100 and result["usage"]["cache_read_tokens"] == 80
+
+
+def test_merged_traces_remember_who_made_the_work():
+    trace, shared = metrics.Trace(), metrics.Trace()
+    shared.add(metrics.StageSpan("story"))
+    trace.merge(shared, coalesced=True)
+    assert trace.to_dict()["coalesced_from"] == shared.id
+    assert [stage["stage"] for stage in trace.to_dict()["stages"]] == ["story"]
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+import pytest
+import replicate
+
+from bench.fake_backends import fake_anthropic, fake_replicate
+from pipeline import AsyncPipeline, Pipeline
+from predictions import PredictionManager
+from scheduler import Scheduler
+from story_generator import StoryGenerator
+
+
+def recorder():
+    events = []
+    lock = threading.Lock()
+
+    def record(kind):
+        def callback(name, *args):
+            with lock:
+                events.append((kind, name))
+        return callback
+    return events, record("start"), record("result")
+
+
+def assert_dependency_order(pipeline, events):
+    """Every step started only after all of its dependencies finished."""
+    finished = set()
+    for kind, name in events:
+        if kind == "start":
+            missing = [dep for dep in pipeline.steps[name].deps if dep in pipeline.steps and dep not in finished]
+            assert not missing, f"{name} started before {', '.join(missing)}"
+        else:
+            finished.add(name)
+
+
+def diamond():
+    pipeline = Pipeline()
+    pipeline.add_step("a", lambda: 1)
+    pipeline.add_step("b", lambda a: a + 1, deps=["a"])
+    pipeline.add_step("c", lambda a: a * 10, deps=["a"])
+    pipeline.add_step("d", lambda b, c: b + c, deps=["b", "c"])
+    return pipeline
+
+
+def test_steps_run_after_their_dependencies():
+    pipeline = diamond()
+    events, on_start, on_result = recorder()
+    results = pipeline.run(on_start=on_start, on_result=on_result)
+    assert results == {"a": 1, "b": 2, "c": 10, "d": 12}
+    assert_dependency_order(pipeline, events)
+
+
+def test_independent_steps_run_concurrently():
+    both_running = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline()
+    pipeline.add_step("left", lambda: both_running.wait())
+    pipeline.add_step("right", lambda: both_running.wait())
+    # Would time out the barrier if the two ran one after the other
+    pipeline.run()
+
+
+def test_outputs_prune_the_graph_and_inputs_skip_steps():
+    pipeline = diamond()
+    events, on_start, on_result = recorder()
+    results = pipeline.run(inputs={"a": 5}, outputs=["b"], on_start=on_start, on_result=on_result)
+    assert results == {"a": 5, "b": 6}
+    assert events == [("start", "b"), ("result", "b")]
+
+
+def test_cycles_are_rejected_before_anything_runs():
+    ran = []
+    pipeline = Pipeline()
+    pipeline.add_step("first", lambda: ran.append("first"))
+    pipeline.add_step("x", lambda y: y, deps=["y"])
+    pipeline.add_step("y", lambda x: x, deps=["x"])
+    with pytest.raises(ValueError, match="cycle between: x, y"):
+        pipeline.run()
+    assert ran == []
+
+
+@pytest.mark.parametrize("build, message", [
+    (lambda p: p.add_step("a", lambda: 1).add_step("a", lambda: 2), "Duplicate pipeline step: a"),
+    (lambda p: p.add_step("a", lambda b: b, deps=["b"]).run(), "unknown step 'b'"),
+    (lambda p: p.add_step("a", lambda: 1).run(outputs=["b"]), "Unknown pipeline output: b"),
+])
+def test_malformed_graphs_are_rejected(build, message):
+    with pytest.raises(ValueError, match=message):
+        build(Pipeline())
+
+
+def test_a_failing_step_fails_the_run():
+    pipeline = Pipeline()
+    pipeline.add_step("broken", lambda: 1 / 0)
+    pipeline.add_step("after", lambda broken: broken, deps=["broken"])
+    with pytest.raises(ZeroDivisionError):
+        pipeline.run()
+
+
+def test_async_pipeline_follows_the_same_order():
+    async def step(value):
+        await asyncio.sleep(0.01)
+        return value
+
+    pipeline = AsyncPipeline()
+    pipeline.add_step("a", lambda: step(1))
+    pipeline.add_step("b", lambda a: step(a + 1), deps=["a"])
+    pipeline.add_step("c", lambda a: step(a * 10), deps=["a"])
+    pipeline.add_step("d", lambda b, c: step(b + c), deps=["b", "c"])
+    events, on_start, on_result = recorder()
+    results = asyncio.run(pipeline.run(on_start=on_start, on_result=on_result))
+    assert results == {"a": 1, "b": 2, "c": 10, "d": 12}
+    assert_dependency_order(pipeline, events)
+
+
+@pytest.fixture
+def make_generator(monkeypatch):
+    anthropic_backend = fake_anthropic(latency="fixed:0.02").start()
+    replicate_backend = fake_replicate(latency="fixed:0.05").start()
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", anthropic_backend.url)
+    monkeypatch.setenv("REPLICATE_API_TOKEN", "test")
+    client = replicate.Client(api_token="test", base_url=replicate_backend.url)
+
+    def make(**options):
+        return StoryGenerator(scheduler=Scheduler(), predictions=PredictionManager(client, poll_interval=0.02, tick=0.02),
+                              **options)
+    yield make
+    anthropic_backend.stop()
+    replicate_backend.stop()
+
+
+@pytest.fixture
+def generator(make_generator):
+    return make_generator()
+
+
+@pytest.mark.parametrize("fused", [False, True])
+def test_generate_all_runs_stages_in_dependency_order(generator, fused):
+    events, on_start, on_result = recorder()
+    results = generator.generate_all("Ada", "A Story", "An Author", "lost the keys",
+                                     on_start=on_start, on_result=on_result, fused=fused)
+    assert results["comic_url"] and results["story_parts"][0]
+    assert_dependency_order(generator.build_pipeline("Ada", "A Story", "An Author", "lost the keys", fused=fused),
+                            events)
+
+
+def test_speculative_comic_does_not_wait_for_the_story(make_generator):
+    generator = make_generator(speculative=True)
+    events, on_start, on_result = recorder()
+    results = generator.generate_all("Ada", "A Story", "An Author", "lost the keys",
+                                     on_start=on_start, on_result=on_result)
+    assert events.index(("start", "speculative_comic_url")) < events.index(("result", "full_story"))
+    assert results["comic_url"] == results["speculative_comic_url"]
+
+
+@pytest.mark.parametrize("rerender_below, kept", [(0.0, True), (1.01, False)])
+def test_speculative_comic_is_redrawn_when_the_story_drifts(make_generator, rerender_below, kept):
+    generator = make_generator(speculative=True, speculative_rerender_below=rerender_below)
+    results = generator.generate_all("Ada", "A Story", "An Author", "lost the keys")
+    assert (results["comic_url"] == results["speculative_comic_url"]) is kept
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import replicate
+
+from bench.fake_backends import fake_replicate
+from predictions import Consumer, PredictionCancelled, PredictionDeadlineExceeded, PredictionManager
+
+MODEL = "black-forest-labs/flux-schnell"
+
+
+@pytest.fixture
+def backend():
+    server = fake_replicate(latency="fixed:0.3").start()
+    yield server
+    server.stop()
+
+
+def manager_for(backend, **options):
+    client = replicate.Client(api_token="test", base_url=backend.url)
+    return PredictionManager(client, tick=0.02, **options)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+@pytest.fixture
+def webhook_receiver():
+    # Forwards deliveries to whichever manager the test points it at
+    target = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            accepted = target["manager"].handle_webhook(query.get("token", [None])[0], payload)
+            self.send_response(200 if accepted else 404)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    target["url"] = f"http://127.0.0.1:{httpd.server_address[1]}/replicate/webhook"
+    yield target
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_run_polls_until_the_prediction_succeeds(backend):
+    manager = manager_for(backend, poll_interval=0.05)
+    output = manager.run(MODEL, {"prompt": "a lighthouse"}, Consumer(5))
+    assert output[0].startswith(backend.url)
+    assert manager.stats()["in_flight"] == 0
+
+
+def test_webhook_completes_the_prediction(backend, webhook_receiver):
+    # Polling is far too slow to finish in time, so only the webhook can
+    manager = manager_for(backend, webhook_url=webhook_receiver["url"], webhook_poll_interval=60)
+    webhook_receiver["manager"] = manager
+    output = manager.run(MODEL, {"prompt": "a lighthouse"}, Consumer(5))
+    assert output[0].startswith(backend.url)
+    assert wait_for(lambda: backend.behaviour.counts["webhooks"] == 1)
+
+
+def test_webhook_with_a_wrong_token_is_ignored(backend):
+    manager = manager_for(backend, poll_interval=60)
+    prediction = manager.acquire(MODEL, {"prompt": "a lighthouse"})
+    assert not manager.handle_webhook("wrong", {"id": prediction.id, "status": "succeeded", "output": ["x"]})
+    assert not prediction.done.is_set()
+    manager.release(prediction)
+
+
+def test_identical_inputs_share_one_prediction(backend):
+    manager = manager_for(backend, poll_interval=0.05)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.run(MODEL, {"prompt": "same"}, Consumer(5))))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(results) == 3 and len(set(map(tuple, results))) == 1
+    assert len(backend.httpd.predictions) == 1
+
+
+def test_deadline_cancels_the_prediction(backend):
+    manager = manager_for(backend, poll_interval=0.05)
+    with pytest.raises(PredictionDeadlineExceeded):
+        manager.run(MODEL, {"prompt": "slow"}, Consumer(0.05))
+    assert wait_for(lambda: backend.httpd.cancelled == 1)
+
+
+def test_caller_without_a_deadline_gives_up_after_max_wait(backend):
+    manager = manager_for(backend, poll_interval=60, max_wait=0.1)
+    started = time.monotonic()
+    with pytest.raises(PredictionDeadlineExceeded):
+        manager.run(MODEL, {"prompt": "slow"})
+    assert time.monotonic() - started < 1
+
+
+def test_consumer_gone_cancels_the_prediction(backend):
+    manager = manager_for(backend, poll_interval=60)
+    consumer = Consumer()
+    threading.Timer(0.05, consumer.abandon).start()
+    with pytest.raises(PredictionCancelled):
+        manager.run(MODEL, {"prompt": "unwanted"}, consumer)
+    assert wait_for(lambda: backend.httpd.cancelled == 1)
+    assert wait_for(lambda: manager.stats()["in_flight"] == 0)
+
+
+def test_prediction_survives_while_another_consumer_waits(backend):
+    manager = manager_for(backend, poll_interval=0.05)
+    leaving = Consumer()
+    outcome = {}
+    thread = threading.Thread(target=lambda: outcome.update(output=manager.run(MODEL, {"prompt": "shared"}, Consumer(5))))
+    thread.start()
+    threading.Timer(0.05, leaving.abandon).start()
+    with pytest.raises(PredictionCancelled):
+        manager.run(MODEL, {"prompt": "shared"}, leaving)
+    thread.join()
+    assert outcome["output"][0].startswith(backend.url)
+    assert backend.httpd.cancelled == 0
+
+
+def test_arun_notices_a_consumer_that_has_gone(backend):
+    manager = manager_for(backend, poll_interval=60)
+    consumer = Consumer()
+
+    async def main():
+        asyncio.get_running_loop().call_later(0.05, consumer.abandon)
+        await manager.arun(MODEL, {"prompt": "unwanted"}, consumer)
+
+    started = time.monotonic()
+    with pytest.raises(PredictionCancelled):
+        asyncio.run(main())
+    assert time.monotonic() - started < 1
+    assert wait_for(lambda: backend.httpd.cancelled == 1)
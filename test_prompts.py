@@ -0,0 +1,66 @@
+import pytest
+import replicate
+
+import metrics
+import prompts
+from bench.fake_backends import CANNED_PROFILE, CANNED_TOOL_INPUT, fake_anthropic, fake_replicate
+from predictions import PredictionManager
+from scheduler import Scheduler
+from story_generator import StoryGenerator
+
+
+def test_character_system_is_the_same_blocks_every_time():
+    system = prompts.character_system("profile")
+    assert system == prompts.character_system("profile")
+    assert system[0]["text"] == prompts.STYLE_GUIDE
+    # One breakpoint, after the profile, caches the guide and profile together
+    assert [("cache_control" in block) for block in system] == [False, True]
+
+
+def test_prompts_do_not_repeat_the_cached_guide():
+    for prompt in (prompts.story_prompt("setup"), prompts.situation_prompt("lost the keys"),
+                   prompts.snippet_prompt("story", "summary")):
+        assert prompts.STORY_GUIDELINES not in prompt
+        assert prompts.SNIPPET_GUIDELINES not in prompt
+
+
+@pytest.fixture
+def generator(monkeypatch):
+    anthropic_backend = fake_anthropic(latency="fixed:0").start()
+    replicate_backend = fake_replicate(latency="fixed:0").start()
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "test")
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", anthropic_backend.url)
+    monkeypatch.setenv("REPLICATE_API_TOKEN", "test")
+    client = replicate.Client(api_token="test", base_url=replicate_backend.url)
+    yield StoryGenerator(scheduler=Scheduler(), predictions=PredictionManager(client))
+    anthropic_backend.stop()
+    replicate_backend.stop()
+    metrics.set_trace(None)
+
+
+def test_later_calls_for_a_profile_read_its_cached_prefix(generator):
+    trace = metrics.start_trace()
+    situation_setup = generator.generate_situation_setup("lost the keys", CANNED_PROFILE)
+    generator.generate_story(CANNED_PROFILE, situation_setup)
+    situation, story = trace.to_dict()["stages"]
+    assert situation["cache_write_tokens"] > 0 and situation["cache_read_tokens"] == 0
+    assert story["cache_read_tokens"] == situation["cache_write_tokens"]
+
+
+def test_fused_visual_summary_has_the_multi_call_layout():
+    story, visual_summary = prompts.StoryResult.from_tool_input(CANNED_TOOL_INPUT).story_parts
+    assert story == CANNED_TOOL_INPUT["story"]
+    assert visual_summary.splitlines() == ["VISUAL SUMMARY:"] + [
+        f"- {label}: {CANNED_TOOL_INPUT['visual_summary'][key]}" for key, label, _ in prompts.VISUAL_SUMMARY_FIELDS]
+
+
+@pytest.mark.parametrize("tool_input, message", [
+    ("story", "not an object"),
+    ({**CANNED_TOOL_INPUT, "story": " "}, "field story"),
+    ({**CANNED_TOOL_INPUT, "visual_summary": "VISUAL SUMMARY"}, "visual_summary is missing or not an object"),
+    ({**CANNED_TOOL_INPUT, "visual_summary": {"setting": "a platform"}}, "visual_summary.protagonist"),
+    ({key: value for key, value in CANNED_TOOL_INPUT.items() if key != "snippet"}, "field snippet"),
+])
+def test_incomplete_tool_input_is_rejected(tool_input, message):
+    with pytest.raises(ValueError, match=message):
+        prompts.StoryResult.from_tool_input(tool_input)
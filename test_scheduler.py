@@ -0,0 +1,106 @@
+import threading
+
+import pytest
+
+from scheduler import CircuitBreaker, CircuitOpenError, Limits, Scheduler, TokenBucket
+
+
+class Overloaded(Exception):
+
+    def __init__(self, retry_after=None):
+        super().__init__("overloaded")
+        self.status_code = 529
+        self.response = type("Response", (), {"headers": {"retry-after": retry_after} if retry_after else {}})()
+
+
+def fails(times, error=Overloaded):
+    calls = []
+
+    def func():
+        calls.append(1)
+        if len(calls) <= times:
+            raise error()
+        return "ok"
+    return func, calls
+
+
+def test_bucket_is_free_until_empty_then_charges_the_wait():
+    bucket = TokenBucket(capacity=10, per_second=5)
+    assert bucket.reserve(10) == 0.0
+    # In debt: the caller waits for the refill that covers its share
+    assert bucket.reserve(5) == pytest.approx(1.0, abs=0.05)
+    assert bucket.reserve(5) == pytest.approx(2.0, abs=0.05)
+
+
+def test_bucket_reservation_is_capped_at_capacity():
+    bucket = TokenBucket(capacity=10, per_second=10)
+    assert bucket.reserve(50) == 0.0
+    assert bucket.reserve(10) == pytest.approx(1.0, abs=0.05)
+
+
+def test_bucket_refills_over_time_and_refunds_up_to_capacity():
+    bucket = TokenBucket(capacity=10, per_second=100)
+    bucket.reserve(10)
+    threading.Event().wait(0.05)
+    assert bucket.reserve(4) == 0.0
+    bucket.refund(100)
+    assert bucket.tokens == 10
+
+
+def test_failed_attempts_give_their_tokens_back():
+    scheduler = Scheduler({"anthropic": Limits(input_tokens_per_minute=1000, output_tokens_per_minute=1000)},
+                          base_delay=0, max_retries=3)
+    func, calls = fails(2)
+    assert scheduler.call("anthropic", None, func, input_tokens=300, output_tokens=300) == "ok"
+    assert len(calls) == 3
+    buckets = scheduler.buckets[("anthropic", None)]
+    # Only the successful attempt's reservation is still held
+    assert 690 <= buckets["input_tokens"].tokens <= 710
+    assert 690 <= buckets["output_tokens"].tokens <= 710
+
+
+def test_retry_after_is_capped_by_max_delay():
+    scheduler = Scheduler(max_delay=0.5)
+    assert scheduler._backoff(0, Overloaded(retry_after="3600")) == 0.5
+    assert scheduler._backoff(0, Overloaded(retry_after="0.1")) == 0.1
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.before_call("anthropic")
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call("anthropic")
+
+
+def test_half_open_breaker_lets_one_probe_through():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+    breaker.record_failure()
+    threading.Event().wait(0.02)
+    assert breaker.state == "half_open"
+    breaker.before_call("anthropic")
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call("anthropic")
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.before_call("anthropic")
+    breaker.before_call("anthropic")
+
+
+def test_failed_probe_reopens_the_breaker():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=0.01)
+    for _ in range(3):
+        breaker.record_failure()
+    threading.Event().wait(0.02)
+    breaker.before_call("anthropic")
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_non_retryable_errors_are_not_retried():
+    scheduler = Scheduler(base_delay=0)
+    func, calls = fails(1, error=ValueError)
+    with pytest.raises(ValueError):
+        scheduler.call("anthropic", None, func)
+    assert len(calls) == 1
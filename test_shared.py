@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+from artifacts import ArtifactStore
+from async_story_generator import AsyncStoryGenerator
+from bench.fake_backends import fake_replicate
+from cache import ResponseCache, SharedTier
+from shared import SharedLocks, SQLiteBackend
+
+
+def node_cache(backend):
+    # Each node has its own memory tier in front of the shared one
+    return ResponseCache(persistent=SharedTier(backend, "profile:"), locks=SharedLocks(backend, poll_interval=0.01))
+
+
+def test_nodes_share_one_computation(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "shared.db"))
+    caches = [node_cache(backend) for _ in range(2)]
+    calls = []
+    lock = threading.Lock()
+
+    def create():
+        with lock:
+            calls.append(1)
+        threading.Event().wait(0.2)
+        return "profile"
+
+    results = []
+    threads = [threading.Thread(target=lambda cache=cache: results.append(cache.get_or_create("key", create)))
+               for cache in caches]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["profile", "profile"]
+    assert len(calls) == 1
+
+
+def test_async_workers_share_one_computation(tmp_path):
+    # Two ASGI workers, each with its own event loop and cache
+    backend = SQLiteBackend(str(tmp_path / "shared.db"))
+    calls = []
+
+    async def create():
+        calls.append(1)
+        await asyncio.sleep(0.2)
+        return "profile"
+
+    results = []
+
+    def worker():
+        cache = node_cache(backend)
+        results.append(asyncio.run(AsyncStoryGenerator.get_or_create(cache, "key", create)))
+
+    threads = [threading.Thread(target=worker) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert results == ["profile", "profile"]
+    assert len(calls) == 1
+
+
+def test_any_node_serves_an_artifact_another_node_mirrored(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / "shared.db"))
+    first, second = (ArtifactStore(tmp_path / node, thumbnail_sizes=(), shared=backend) for node in ("a", "b"))
+    replicate_backend = fake_replicate().start()
+    try:
+        name = first.mirror(f"{replicate_backend.url}/outputs/image.png").rsplit("/", 1)[-1]
+    finally:
+        replicate_backend.stop()
+    assert second.resolve(name).read_bytes() == first.resolve(name).read_bytes()
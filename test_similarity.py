@@ -0,0 +1,44 @@
+import pytest
+
+from similarity import SimilarityCache, normalize
+
+
+def test_filler_words_and_case_do_not_count():
+    assert normalize("I just LOST my job!") == normalize("lost job")
+
+
+def test_rephrased_circumstances_hit_and_different_ones_miss():
+    cache = SimilarityCache()
+    cache.store("Ada", "I just lost my job", "setup")
+    assert cache.lookup("Ada", "Lost my job") == "setup"
+    assert cache.lookup("Ada", "found a stray dog") is None
+    assert cache.lookup("Bob", "lost my job") is None
+
+
+def test_variants_are_kept_apart():
+    cache = SimilarityCache(mode="story")
+    cache.store("Ada", "lost my job", "draft story", variant=(False, "draft"))
+    assert cache.lookup("Ada", "lost my job", variant=(False, "hero")) is None
+    assert cache.lookup("Ada", "lost my job", variant=(False, "draft")) == "draft story"
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SimilarityCache(max_entries=2)
+    cache.store("Ada", "lost my job", 1)
+    cache.store("Ada", "found a stray dog", 2)
+    cache.lookup("Ada", "lost my job")
+    cache.store("Ada", "missed the last train home", 3)
+    assert cache.lookup("Ada", "found a stray dog") is None
+    assert cache.lookup("Ada", "lost my job") == 1
+    assert cache.counters["evictions"] == 1
+
+
+def test_expired_entries_never_match():
+    cache = SimilarityCache(ttl=-1)
+    cache.store("Ada", "lost my job", "setup")
+    assert cache.lookup("Ada", "lost my job") is None
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError, match="Unknown similarity cache mode"):
+        SimilarityCache(mode="comic")
@@ -0,0 +1,219 @@
+import asyncio
+import threading
+
+import pytest
+import replicate
+
+import metrics
+from bench.fake_backends import fake_replicate
+from predictions import Consumer, PredictionCancelled, PredictionManager, consuming, current_consumer
+from singleflight import AsyncSingleFlight, SharedRuns, SingleFlight
+
+
+def in_threads(count, target):
+    results = [None] * count
+
+    def run(i):
+        results[i] = target()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    return results
+
+
+def gated(result="ok"):
+    """A call that holds until released, counting how often it is made."""
+    calls = []
+    entered = threading.Event()
+    release = threading.Event()
+
+    def func(**_callbacks):
+        calls.append(1)
+        entered.set()
+        release.wait(5)
+        return result
+    return func, calls, entered, release
+
+
+def test_concurrent_callers_share_one_call():
+    flight = SingleFlight("test")
+    func, calls, entered, release = gated()
+    threading.Timer(0.1, release.set).start()
+    assert in_threads(4, lambda: flight.do("key", func)) == ["ok"] * 4
+    assert len(calls) == 1
+    assert flight.calls == {}
+
+
+def test_different_keys_do_not_share():
+    flight = SingleFlight("test")
+    calls = []
+    for key in ("a", "b"):
+        flight.do(key, lambda key=key: calls.append(key))
+    assert calls == ["a", "b"]
+
+
+def test_waiters_get_the_leaders_exception():
+    flight = SingleFlight("test")
+    entered, release = threading.Event(), threading.Event()
+
+    def fail():
+        entered.set()
+        release.wait(5)
+        raise ValueError("upstream")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("key", fail)
+        except ValueError as e:
+            errors.append(e)
+    leader = threading.Thread(target=call)
+    leader.start()
+    entered.wait(5)
+    waiter = threading.Thread(target=call)
+    waiter.start()
+    threading.Timer(0.1, release.set).start()
+    leader.join(5)
+    waiter.join(5)
+    assert len(errors) == 2 and errors[0] is errors[1]
+
+
+def test_async_callers_share_one_task():
+    flight = AsyncSingleFlight("test")
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "ok"
+
+    async def main():
+        return await asyncio.gather(*(flight.do("key", work) for _ in range(3)))
+
+    assert asyncio.run(main()) == ["ok"] * 3
+    assert len(calls) == 1
+
+
+def test_async_call_is_cancelled_only_with_its_last_caller():
+    flight = AsyncSingleFlight("test")
+    cancelled = []
+
+    async def work():
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(1)
+            raise
+
+    async def main():
+        first = asyncio.ensure_future(flight.do("key", work))
+        second = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled
+        second.cancel()
+        await asyncio.sleep(0.01)
+        assert cancelled == [1]
+        assert flight.calls == {}
+
+    asyncio.run(main())
+
+
+def test_async_call_survives_the_caller_that_started_it():
+    # As in asgi.py: a disconnected client's task is cancelled and its
+    # consumer ends, while a coalesced caller still waits for the images
+    backend = fake_replicate(latency="fixed:0.2").start()
+    manager = PredictionManager(replicate.Client(api_token="test", base_url=backend.url), poll_interval=0.05,
+                                tick=0.02)
+    flight = AsyncSingleFlight("test")
+
+    async def render():
+        return await manager.arun("black-forest-labs/flux-schnell", {"prompt": "a lighthouse"})
+
+    async def request():
+        with consuming(Consumer(5)):
+            return await flight.do("key", render)
+
+    async def main():
+        leader = asyncio.ensure_future(request())
+        await asyncio.sleep(0.05)
+        follower = asyncio.ensure_future(request())
+        await asyncio.sleep(0.05)
+        leader.cancel()
+        return await follower
+
+    try:
+        output = asyncio.run(main())
+    finally:
+        backend.stop()
+    assert output[0].startswith(backend.url)
+    assert backend.httpd.cancelled == 0
+
+
+def test_shared_run_replays_callbacks_to_late_joiners():
+    runs = SharedRuns("test", tick=0.01)
+    entered, release = threading.Event(), threading.Event()
+
+    def start(on_result):
+        on_result("first", 1)
+        entered.set()
+        release.wait(5)
+        on_result("second", 2)
+        return {"done": True}
+
+    seen = {"leader": [], "joiner": []}
+
+    def run(who):
+        return runs.run("key", start, on_result=lambda *args: seen[who].append(args))
+    leader = threading.Thread(target=run, args=("leader",))
+    leader.start()
+    entered.wait(5)
+    threading.Timer(0.1, release.set).start()
+    assert run("joiner") == {"done": True}
+    leader.join(5)
+    assert seen["leader"] == seen["joiner"] == [("first", 1), ("second", 2)]
+
+
+def test_shared_run_traces_are_merged_into_every_caller():
+    runs = SharedRuns("test", tick=0.01)
+    func, calls, entered, release = gated({"story": "x"})
+    traces = []
+
+    def run():
+        trace = metrics.Trace()
+        metrics.set_trace(trace)
+        runs.run("key", func)
+        traces.append(trace.to_dict())
+    leader = threading.Thread(target=run)
+    leader.start()
+    entered.wait(5)
+    joiner = threading.Thread(target=run)
+    joiner.start()
+    threading.Timer(0.1, release.set).start()
+    leader.join(5)
+    joiner.join(5)
+    assert len(calls) == 1
+    joiner, first = sorted(traces, key=lambda trace: "coalesced_from" not in trace)
+    assert "coalesced_from" not in first
+    assert joiner["coalesced_from"] == first["trace_id"]
+
+
+def test_shared_run_is_abandoned_when_its_only_caller_goes():
+    runs = SharedRuns("test", tick=0.01)
+    seen = {}
+
+    def start():
+        seen["consumer"] = current_consumer()
+        seen["consumer"].gone.wait(5)
+        return {}
+
+    consumer = Consumer()
+    threading.Timer(0.05, consumer.abandon).start()
+    with consuming(consumer), pytest.raises(PredictionCancelled):
+        runs.run("key", start)
+    assert seen["consumer"].gone.is_set()
+    assert runs.runs == {}
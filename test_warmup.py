@@ -0,0 +1,66 @@
+import pytest
+
+from character_store import CharacterStore
+from warmup import WarmupJob
+
+ROSTER = [{"Protagonist": name, "Original Story": "A Story", "Author": "An Author"} for name in ("Ada", "Bob")]
+
+
+class Generator:
+    """Records every call; fails each name in `broken` once."""
+
+    def __init__(self, artifact_store=None, broken=()):
+        self.artifact_store = artifact_store
+        self.broken = set(broken)
+        self.calls = []
+
+    def generate_char_style_info(self, name, story, author):
+        self.calls.append(("profile", name))
+        return f"profile of {name}"
+
+    def extract_key_traits(self, char_style_info):
+        self.calls.append(("traits", char_style_info))
+        return "traits"
+
+    def character_image_prompts(self, char_style_info):
+        return f"side {char_style_info}", f"head {char_style_info}"
+
+    def generate_portrait(self, prompt, role, image_profile):
+        name = prompt.rsplit(" ", 1)[-1]
+        if role == "headshot" and name in self.broken:
+            self.broken.discard(name)
+            raise RuntimeError("upstream")
+        self.calls.append((role, name))
+        return f"https://example.com/{image_profile}/{role}/{name}.png"
+
+
+@pytest.fixture
+def store(tmp_path):
+    return CharacterStore(str(tmp_path / "characters.db"))
+
+
+def test_a_rerun_resumes_from_the_first_missing_artifact(store):
+    generator = Generator(artifact_store=object(), broken=["Bob"])
+    assert WarmupJob(generator, store).run(ROSTER) == ["Bob"]
+    assert "headshot_url" not in store.get("Bob", "standard")
+
+    generator.calls.clear()
+    assert WarmupJob(generator, store).run(ROSTER) == []
+    assert generator.calls == [("headshot", "Bob")]
+    assert all(WarmupJob(generator, store).is_complete(p["Protagonist"]) for p in ROSTER)
+
+
+def test_portraits_are_only_stored_when_mirrored(store):
+    generator = Generator()
+    assert WarmupJob(generator, store).run(ROSTER[:1]) == []
+    assert store.get("Ada", "standard") == {"char_style_info": "profile of Ada", "key_traits": "traits"}
+
+
+def test_portraits_are_kept_per_image_profile(store):
+    store.update("Ada", char_style_info="profile")
+    store.update("Ada", "draft", headshot_url="draft.png")
+    store.update("Ada", "hero", headshot_url="hero.png")
+    assert store.get("Ada", "draft")["headshot_url"] == "draft.png"
+    assert store.get("Ada", "standard") == {"char_style_info": "profile"}
+    with pytest.raises(ValueError, match="per image profile"):
+        store.update("Ada", headshot_url="x.png")
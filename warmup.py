@@ -0,0 +1,135 @@
+import argparse
+import logging
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+import image_profiles
+from artifacts import ArtifactStore
+from character_store import CharacterStore
+from protagonists import protagonists
+from story_generator import StoryGenerator
+
+logger = logging.getLogger(__name__)
+
+# Same environment file as main.py
+env_path = Path(__file__).resolve().parent / 'jawn.env'
+
+
+class WarmupJob:
+    """Fills the character store for a roster. API calls go through the
+    story generator's scheduler, which already retries transient errors.
+
+    Portraits are only stored when the generator mirrors them into an
+    artifact store: Replicate's own URLs expire within the hour, which
+    would leave the store handing out dead links.
+    """
+
+    def __init__(self, story_generator, store, image_profile=image_profiles.DEFAULT_PROFILE):
+        self.story_generator = story_generator
+        self.store = store
+        self.image_profile = image_profile
+        self.portraits = story_generator.artifact_store is not None
+        self.lock = threading.Lock()
+        self.done = 0
+        self.failed = []
+
+    def warm_character(self, protagonist_info):
+        name = protagonist_info['Protagonist']
+        record = self.store.get(name, self.image_profile) or {}
+
+        # Each artifact is saved as soon as it exists, so a rerun after a
+        # crash picks up from the first missing one
+        if 'char_style_info' not in record:
+            record['char_style_info'] = self.story_generator.generate_char_style_info(
+                name, protagonist_info['Original Story'], protagonist_info['Author'])
+            self.store.update(name, char_style_info=record['char_style_info'])
+
+        if 'key_traits' not in record:
+            record['key_traits'] = self.story_generator.extract_key_traits(record['char_style_info'])
+            self.store.update(name, key_traits=record['key_traits'])
+
+        if not self.portraits:
+            return
+        side_profile_prompt, headshot_prompt = self.story_generator.character_image_prompts(record['char_style_info'])
+        for field, prompt, role in (('side_profile_url', side_profile_prompt, "side_profile"),
+                                    ('headshot_url', headshot_prompt, "headshot")):
+            if field not in record:
+                record[field] = self.story_generator.generate_portrait(prompt, role, self.image_profile)
+                self.store.update(name, self.image_profile, **{field: record[field]})
+
+    def is_complete(self, name):
+        record = self.store.get(name, self.image_profile) or {}
+        fields = ('char_style_info', 'key_traits') + (('side_profile_url', 'headshot_url') if self.portraits else ())
+        return all(field in record for field in fields)
+
+    def run(self, roster, concurrency=4, force=False):
+        if force:
+            for protagonist_info in roster:
+                self.store.delete(protagonist_info['Protagonist'])
+        if not self.portraits:
+            logger.warning("No artifact store, so only character profiles are stored: "
+                           "Replicate's portrait URLs would expire within the hour")
+
+        todo = [p for p in roster if not self.is_complete(p['Protagonist'])]
+        skipped = len(roster) - len(todo)
+        logger.info("Warming %s characters (%s already complete) with concurrency %s", len(todo), skipped, concurrency)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {executor.submit(self.warm_character, p): p['Protagonist'] for p in todo}
+            for future in as_completed(futures):
+                name = futures[future]
+                with self.lock:
+                    self.done += 1
+                    try:
+                        future.result()
+                        logger.info("[%s/%s] Warmed %s", self.done, len(todo), name)
+                    except Exception as e:
+                        self.failed.append(name)
+                        logger.error("[%s/%s] Failed to warm %s: %s", self.done, len(todo), name, e)
+                        logger.debug(traceback.format_exc())
+
+        return self.failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute character profiles and portraits for the protagonist roster")
+    parser.add_argument("--db", default="characters.db", help="Path of the character store (SQLite)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Characters warmed at the same time")
+    parser.add_argument("--image-profile", default=image_profiles.DEFAULT_PROFILE, choices=sorted(image_profiles.PROFILES),
+                        help="Image profile the portraits are rendered with")
+    parser.add_argument("--only", action="append", help="Only warm this protagonist (repeatable)")
+    parser.add_argument("--artifacts", default="artifacts",
+                        help="Directory portraits are mirrored into (empty to store profiles only)")
+    parser.add_argument("--force", action="store_true", help="Discard stored artifacts and regenerate them")
+    args = parser.parse_args(argv)
+    load_dotenv(dotenv_path=env_path)
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s: %(message)s',
+                        handlers=[logging.StreamHandler(sys.stdout)])
+
+    roster = protagonists
+    if args.only:
+        roster = [p for p in protagonists if p['Protagonist'] in args.only]
+        missing = set(args.only) - {p['Protagonist'] for p in roster}
+        if missing:
+            parser.error(f"Unknown protagonists: {', '.join(sorted(missing))}")
+
+    # Stored portraits outlive Replicate's delivery URLs only if mirrored
+    story_generator = StoryGenerator(artifact_store=ArtifactStore(args.artifacts) if args.artifacts else None)
+    job = WarmupJob(story_generator, CharacterStore(args.db), image_profile=args.image_profile)
+    failed = job.run(roster, concurrency=args.concurrency, force=args.force)
+    if failed:
+        logger.error("%s characters failed, rerun to resume: %s", len(failed), ', '.join(failed))
+        return 1
+    logger.info("Warm-up complete")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())